@@ -0,0 +1,75 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Benchmark of the SJTU Pay XML codec.
+
+Compares the codec with the xmltodict/dict2xml path it replaced, which
+need to be installed to run this (``pip install xmltodict dict2xml``).
+
+    python benchmarks/codec_bench.py [--number 20000]
+"""
+
+import argparse
+import timeit
+
+import xmltodict
+from dict2xml import dict2xml
+
+from indico_payment_sjtu.codec import parse_pay_result, parse_query_result, serialize_billinfo
+
+PAY_RESULT = ('<?xml version="1.0" encoding="GBK"?><payResult><billno>nVp9bZz8Q3mBkgL2v0Y5Ng==</billno>'
+              '<billamt>1200.00</billamt><trade_no>2023071012345678</trade_no><paytime>20230710120000</paytime>'
+              '<payway>1</payway><remark></remark></payResult>')
+QUERY_RESULT = ('<?xml version="1.0" encoding="GBK"?><QueryResult><State><returncode>0000</returncode>'
+                '<returnmsg>success</returnmsg></State><Billinfo>' +
+                '<billdetail><billno>nVp9bZz8Q3mBkgL2v0Y5Ng==</billno><billamt>1200.00</billamt>'
+                '<paystate>1</paystate></billdetail>' * 3 +
+                '</Billinfo></QueryResult>')
+BILLINFO = {
+    'billno': 'nVp9bZz8Q3mBkgL2v0Y5Ng==',
+    'orderinfono': '...',
+    'orderinfoname': 'Guinea Pig',
+    'returnURL': 'https://indico.example.com/event/1/registrations/1/payment/sjtu/success',
+    'billremark': '会议名称：Conference；参会人员：Guinea Pig；',
+    'tax_code': '',
+    'zz_unit': '',
+    'zz_mobile': '',
+    'zz_email': '',
+    'type_no': '',
+    'billdtl': {'feeitemid': '1169', 'feeord': 1, 'amt': 1200.0, 'dtlremark': '', 'unit': '项'},
+}
+
+
+def legacy_serialize_billinfo(d):
+    xml = dict2xml(d, wrap='billinfo', indent="").replace("\n", "")
+    return f"""<?xml version="1.0" encoding="GBK"?>{xml}"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    assert serialize_billinfo(BILLINFO) == legacy_serialize_billinfo(BILLINFO)
+    assert parse_pay_result(PAY_RESULT).fields == dict(xmltodict.parse(PAY_RESULT)['payResult'])
+
+    cases = [
+        ('payResult', lambda: xmltodict.parse(PAY_RESULT)['payResult'], lambda: parse_pay_result(PAY_RESULT)),
+        ('QueryResult', lambda: xmltodict.parse(QUERY_RESULT)['QueryResult'],
+         lambda: parse_query_result(QUERY_RESULT)),
+        ('billinfo', lambda: legacy_serialize_billinfo(BILLINFO), lambda: serialize_billinfo(BILLINFO)),
+    ]
+    print(f'{args.number} documents, best of 3')
+    for name, legacy, codec in cases:
+        legacy_time = min(timeit.repeat(legacy, number=args.number, repeat=3)) / args.number
+        codec_time = min(timeit.repeat(codec, number=args.number, repeat=3)) / args.number
+        print(f'{name:>12}: xmltodict/dict2xml {legacy_time * 1e6:7.1f} us, '
+              f'codec {codec_time * 1e6:7.1f} us ({legacy_time / codec_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
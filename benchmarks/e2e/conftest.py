@@ -0,0 +1,154 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Harness of the end-to-end benchmarks of the payment handlers.
+
+The benchmarks run with the Indico test fixtures (an ephemeral database
+and redis) against the portal simulator::
+
+    pytest benchmarks/e2e -o python_files='*_bench.py' --no-cov
+
+Each benchmark records its latency and the time spent in the stages
+wrapped with :meth:`Benchmark.stage`.  The results are written to
+``benchmarks/e2e/results.json`` and compared with ``baseline.json`` in
+the same directory; a benchmark whose mean latency exceeds the baseline
+by more than ``SJTU_BENCHMARK_TOLERANCE`` (default 0.25) fails, and so
+does a benchmark without a baseline.  Run with ``SJTU_BENCHMARK_SAVE=1``
+to store the results as the new baseline.
+"""
+
+import functools
+import json
+import os
+import statistics
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+from indico_payment_sjtu.testing.fixtures import *  # noqa: F401,F403
+
+
+BASELINE_PATH = Path(__file__).parent / 'baseline.json'
+RESULTS_PATH = Path(__file__).parent / 'results.json'
+ITERATIONS = int(os.environ.get('SJTU_BENCHMARK_ITERATIONS', 50))
+TOLERANCE = float(os.environ.get('SJTU_BENCHMARK_TOLERANCE', 0.25))
+
+_results = {}
+
+
+def _load_baseline():
+    try:
+        return json.loads(BASELINE_PATH.read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Benchmark:
+    """Collect the latency of one benchmark and the time of its stages."""
+
+    def __init__(self, name, monkeypatch):
+        self.name = name
+        self.iterations = ITERATIONS
+        self.latencies = []
+        self.stages = defaultdict(float)
+        self._monkeypatch = monkeypatch
+        self._measuring = False
+
+    def stage(self, name, target, attribute):
+        """Time calls to ``target.attribute`` as the stage `name`.
+
+        Only calls made inside :meth:`measure` are counted.  Nested stages
+        are timed inclusively, e.g. the portal stage contains the XML
+        parsing of the response.
+        """
+        func = getattr(target, attribute)
+
+        @functools.wraps(func)
+        def _timed(*args, **kwargs):
+            with self.timed(name):
+                return func(*args, **kwargs)
+
+        self._monkeypatch.setattr(target, attribute, _timed)
+
+    @contextmanager
+    def timed(self, name):
+        """Time a block as (part of) the stage `name`."""
+        if not self._measuring:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    @contextmanager
+    def measure(self):
+        """Record the latency of one iteration."""
+        self._measuring = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+            self._measuring = False
+
+    def summary(self):
+        total = sum(self.latencies)
+        count = len(self.latencies)
+        return {
+            'iterations': count,
+            'throughput': count / total if total else 0,
+            'mean_ms': statistics.mean(self.latencies) * 1000,
+            'p50_ms': _percentile(self.latencies, 50) * 1000,
+            'p95_ms': _percentile(self.latencies, 95) * 1000,
+            'stages_ms': {name: value / count * 1000 for name, value in sorted(self.stages.items())},
+        }
+
+    def assert_no_regression(self):
+        summary = _results[self.name] = self.summary()
+        if os.environ.get('SJTU_BENCHMARK_SAVE'):
+            return
+        baseline = _load_baseline().get(self.name)
+        if baseline is None:
+            pytest.fail(f'{self.name}: no baseline in {BASELINE_PATH.name}, store one by running the benchmarks '
+                        f'with SJTU_BENCHMARK_SAVE=1', pytrace=False)
+        limit = baseline['mean_ms'] * (1 + TOLERANCE)
+        assert summary['mean_ms'] <= limit, (f'{self.name}: mean {summary["mean_ms"]:.2f}ms exceeds the baseline '
+                                             f'{baseline["mean_ms"]:.2f}ms by more than {TOLERANCE:.0%}')
+
+
+@pytest.fixture
+def sjtu_benchmark(request, monkeypatch):
+    """A :class:`Benchmark` named after the test."""
+    return Benchmark(request.node.name, monkeypatch)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if not _results:
+        return
+    RESULTS_PATH.write_text(json.dumps(_results, indent=2, sort_keys=True))
+    if os.environ.get('SJTU_BENCHMARK_SAVE'):
+        BASELINE_PATH.write_text(json.dumps({**_load_baseline(), **_results}, indent=2, sort_keys=True))
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _results:
+        return
+    terminalreporter.section('SJTU Pay handler benchmarks')
+    for name, summary in sorted(_results.items()):
+        stages = ', '.join(f'{stage} {value:.2f}ms' for stage, value in summary['stages_ms'].items())
+        terminalreporter.write_line(f'{name}: {summary["throughput"]:.1f}/s, mean {summary["mean_ms"]:.2f}ms, '
+                                    f'p95 {summary["p95_ms"]:.2f}ms ({stages})')
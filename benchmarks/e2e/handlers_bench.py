@@ -0,0 +1,123 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""End-to-end benchmarks of the request handlers run during a payment.
+
+Every iteration uses a new registration, so the query cache and the
+duplicate checks do not short-circuit the handlers.
+"""
+
+import urllib.parse
+
+import pytest
+from flask import request
+from flask_pluginengine import render_plugin_template
+
+from indico_payment_sjtu import controllers
+from indico_payment_sjtu.billno import uuid_to_billno
+from indico_payment_sjtu.controllers import RHSJTUBase, RHSJTUCallback, RHSJTUQuery, RHSJTURefund, RHSJTUSuccess
+from indico_payment_sjtu.plugin import SJTUPaymentPlugin
+from indico_payment_sjtu.signing import SJTUSigner
+
+
+@pytest.fixture
+def stages(sjtu_benchmark):
+    """Time the stages shared by the handlers."""
+    sjtu_benchmark.stage('sign', SJTUSigner, 'sign')
+    sjtu_benchmark.stage('sign', SJTUSigner, 'sign_many')
+    for parse in ('parse_pay_result', 'parse_query_result', 'parse_refund_result', 'parse_billinfo'):
+        sjtu_benchmark.stage('xml parse', controllers, parse)
+    sjtu_benchmark.stage('db lookup', RHSJTUBase, '_init_registration')
+    sjtu_benchmark.stage('transaction', RHSJTUBase, '_register_transaction')
+    sjtu_benchmark.stage('portal', RHSJTUBase, '_query_sjtu_portal')
+    return sjtu_benchmark
+
+
+@pytest.fixture
+def no_flash(mocker):
+    mocker.patch('indico_payment_sjtu.controllers.url_for', return_value='/')
+    mocker.patch('indico_payment_sjtu.controllers.flash')
+
+
+def _paid_result(portal, registration):
+    sign, data = portal.pay(uuid_to_billno(registration.uuid), '100.00')
+    return {'sign': sign, 'data': data}
+
+
+@pytest.mark.usefixtures('request_context')
+def test_callback(stages, sjtu_portal, create_sjtu_registration):
+    for __ in range(stages.iterations):
+        result = _paid_result(sjtu_portal, create_sjtu_registration())
+        request.args = {}
+        request.form = {'sign': result['sign'], 'data': urllib.parse.quote_plus(result['data'])}
+        with stages.measure(), SJTUPaymentPlugin.instance.plugin_context():
+            rh = RHSJTUCallback()
+            rh._process_args()
+            assert rh._process() == '1'
+    stages.assert_no_regression()
+
+
+@pytest.mark.usefixtures('request_context', 'no_flash')
+def test_success(stages, sjtu_portal, create_sjtu_registration):
+    for __ in range(stages.iterations):
+        request.args = _paid_result(sjtu_portal, create_sjtu_registration())
+        request.form = {}
+        with stages.measure(), SJTUPaymentPlugin.instance.plugin_context():
+            rh = RHSJTUSuccess()
+            rh._process_args()
+            rh._process()
+    stages.assert_no_regression()
+
+
+@pytest.mark.usefixtures('request_context')
+def test_query(stages, sjtu_event, create_sjtu_registration):
+    signer = SJTUSigner('sysid', 'subsysid', 'cert')
+    for __ in range(stages.iterations):
+        registration = create_sjtu_registration()
+        with SJTUPaymentPlugin.instance.plugin_context():
+            data = {'event': sjtu_event, 'registration': registration, 'amount': 100,
+                    'event_settings': SJTUPaymentPlugin.event_settings.get_all(sjtu_event)}
+            data['billno'] = uuid_to_billno(registration.uuid)
+            data['return_url'] = data['query_url'] = 'https://indico.example.com'
+            billinfo = SJTUPaymentPlugin.generate_payment_data(data)
+        request.form = {'sign': signer.sign(billinfo), 'data': billinfo}
+        with stages.measure(), SJTUPaymentPlugin.instance.plugin_context():
+            rh = RHSJTUQuery()
+            rh._process_args()
+            assert rh._process().json['success']
+    stages.assert_no_regression()
+
+
+@pytest.mark.usefixtures('request_context', 'no_flash')
+def test_refund(stages, sjtu_portal, create_sjtu_registration):
+    for __ in range(stages.iterations):
+        registration = create_sjtu_registration()
+        sjtu_portal.pay(uuid_to_billno(registration.uuid), '100.00')
+        rh = RHSJTURefund()
+        rh.registration = registration
+        with SJTUPaymentPlugin.instance.plugin_context():
+            rh._init_plugin_settings()
+            assert rh._register_paid_bill(rh._query_sjtu_bill(uuid_to_billno(registration.uuid)))
+        with stages.measure(), SJTUPaymentPlugin.instance.plugin_context():
+            assert rh._process_POST().json['success']
+    stages.assert_no_regression()
+
+
+@pytest.mark.usefixtures('request_context')
+def test_payment_form(stages, sjtu_event, create_sjtu_registration):
+    plugin = SJTUPaymentPlugin.instance
+    for __ in range(stages.iterations):
+        registration = create_sjtu_registration()
+        # the same data as built by indico's RHPaymentForm
+        data = {'event': sjtu_event, 'registration': registration, 'amount': registration.price,
+                'currency': registration.currency, 'plugin': plugin,
+                'settings': plugin.settings.get_all(), 'event_settings': plugin.event_settings.get_all(sjtu_event)}
+        with stages.measure(), plugin.plugin_context():
+            plugin.adjust_payment_form_data(data)
+            with stages.timed('template render'):
+                render_plugin_template('event_payment_form.html', **data)
+    stages.assert_no_regression()
@@ -0,0 +1,80 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Benchmark of the registration list in the management area.
+
+Builds and renders the first page of the list of a form with many
+registrations, with the Bill Number / Trade Number columns added when the
+list generator is constructed (``init``) and, for comparison, by the
+``__getattribute__`` hook used before (``getattribute``).  The size of the
+list is set with ``SJTU_BENCHMARK_REGISTRATIONS`` (default 10000).
+"""
+
+import os
+
+import pytest
+
+from indico.core.db import db
+from indico.modules.events.registration.lists import RegistrationListGenerator
+from indico.modules.events.registration.models.registrations import Registration, RegistrationState
+
+from indico_payment_sjtu import _
+from indico_payment_sjtu.billno import uuid_to_billno
+from indico_payment_sjtu.monkey_patch import _registration_list_generator_init
+
+
+REGISTRATIONS = int(os.environ.get('SJTU_BENCHMARK_REGISTRATIONS', 10000))
+# rendering the whole list takes seconds, so it is not repeated ITERATIONS times
+REGLIST_ITERATIONS = int(os.environ.get('SJTU_BENCHMARK_REGLIST_ITERATIONS', 5))
+LIST_ITEMS = ('title', 'email', 'affiliation', 'reg_date', 'state', 'billno', 'trade_no')
+
+
+def legacy_getattribute(self, item):
+    """The hook which used to add the columns on every attribute access."""
+    result = super(RegistrationListGenerator, self).__getattribute__(item)
+    if item == "static_items" and not hasattr(self, "monkey_patched"):
+        self.monkey_patched = True
+        result["billno"] = {
+            'title': _('Bill Number'),
+        }
+        result["trade_no"] = {
+            'title': _('Trade Number')
+        }
+    return result
+
+
+@pytest.fixture
+def large_regform(db, dummy_regform):
+    db.session.add_all(Registration(registration_form=dummy_regform, first_name='Guinea', last_name=f'Pig {i}',
+                                    email=f'guinea.pig{i}@example.com', currency='CNY', base_price=100,
+                                    state=RegistrationState.unpaid)
+                       for i in range(REGISTRATIONS))
+    db.session.flush()
+    return dummy_regform
+
+
+@pytest.mark.usefixtures('request_context')
+@pytest.mark.parametrize('columns', ('init', 'getattribute'))
+def test_reglist(sjtu_benchmark, monkeypatch, large_regform, columns):
+    if columns == 'getattribute':
+        monkeypatch.setattr(RegistrationListGenerator, '__init__', _registration_list_generator_init)
+        monkeypatch.setattr(RegistrationListGenerator, '__getattribute__', legacy_getattribute, raising=False)
+    # the list generator reads the columns from the session
+    monkeypatch.setattr(RegistrationListGenerator, '_get_config',
+                        lambda self: dict(self.default_list_config, items=LIST_ITEMS))
+    sjtu_benchmark.iterations = REGLIST_ITERATIONS
+    sjtu_benchmark.stage('query', RegistrationListGenerator, 'get_list_page_kwargs')
+    first = min(large_regform.registrations, key=lambda r: (r.last_name.lower(), r.first_name.lower(), r.friendly_id))
+    for __ in range(sjtu_benchmark.iterations):
+        db.session.expire_all()
+        with sjtu_benchmark.measure():
+            with sjtu_benchmark.timed('build'):
+                generator = RegistrationListGenerator(large_regform)
+            with sjtu_benchmark.timed('render'):
+                html = generator.render_list()['html']
+        assert uuid_to_billno(first.uuid) in html
+    sjtu_benchmark.assert_no_regression()
@@ -0,0 +1,85 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Benchmark of the registration export row generation.
+
+Compares the compiled column plan with the previous per-row dict
+building, using in-memory stand-ins for registrations (no database).
+
+    python benchmarks/export_bench.py [--registrations 50000] [--fields 40]
+"""
+
+import argparse
+import time
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+from indico.util.spreadsheets import unique_col
+
+from indico_payment_sjtu.monkey_patch import generate_spreadsheet_from_registrations, special_item_mapping
+
+STATIC_ITEMS = ['reg_date', 'state', 'price', 'checked_in', 'payment_date', 'billno', 'trade_no']
+
+
+def legacy_rows(registrations, regform_items, static_items):
+    """The dict-based row generation the column plan replaced."""
+    for registration in registrations:
+        data = registration.data_by_field
+        registration_dict = {
+            'ID': registration.friendly_id,
+            'Name': f'{registration.first_name} {registration.last_name}'
+        }
+        for item in regform_items:
+            key = unique_col(item.title, item.id)
+            registration_dict[key] = data[item.id].friendly_data if item.id in data else ''
+        for name, (title, fn) in special_item_mapping.items():
+            if name not in static_items:
+                continue
+            registration_dict[title] = fn(registration, data)
+        yield registration_dict
+
+
+def make_registrations(count, fields):
+    regform_items = [SimpleNamespace(id=i, title=f'Field {i}', input_type='text') for i in range(fields)]
+    state = SimpleNamespace(title='Completed')
+    transaction = SimpleNamespace(status=None, provider='sjtu', timestamp=datetime.now(), data={'trade_no': '1'})
+    registrations = []
+    for i in range(count):
+        data_by_field = {item.id: SimpleNamespace(friendly_data=f'value {i}/{item.id}') for item in regform_items}
+        registrations.append(SimpleNamespace(
+            friendly_id=i, first_name='Guinea', last_name=f'Pig {i}', data_by_field=data_by_field,
+            submitted_dt=datetime.now(), state=state, render_price=lambda: '100 CNY', checked_in=False,
+            checked_in_dt=None, transaction=transaction, tags=[], uuid=str(uuid.uuid4())))
+    return regform_items, registrations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--registrations', type=int, default=50000)
+    parser.add_argument('--fields', type=int, default=40)
+    args = parser.parse_args()
+
+    regform_items, registrations = make_registrations(args.registrations, args.fields)
+    print(f'{args.registrations} registrations x {args.fields} fields')
+
+    start = time.perf_counter()
+    for __ in legacy_rows(registrations, regform_items, STATIC_ITEMS):
+        pass
+    legacy = time.perf_counter() - start
+    print(f'{"per-row dicts":>15}: {legacy:6.2f} s')
+
+    start = time.perf_counter()
+    headers, rows = generate_spreadsheet_from_registrations(registrations, regform_items, STATIC_ITEMS)
+    for __ in rows:
+        pass
+    compiled = time.perf_counter() - start
+    print(f'{"column plan":>15}: {compiled:6.2f} s ({legacy / compiled:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
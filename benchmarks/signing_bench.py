@@ -0,0 +1,59 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Micro-benchmark of the SJTU Pay signing engine.
+
+Compares the precomputed-prefix signer with hashing the concatenated
+string from scratch, for single signatures and for a batch of bill numbers.
+
+    python benchmarks/signing_bench.py [--bills 10000] [--repeat 5]
+"""
+
+import argparse
+import base64
+import timeit
+import uuid
+from hashlib import md5
+
+from indico_payment_sjtu.signing import SJTUSigner
+
+SYSID = 'sysid-0123456789'
+SUBSYSID = 'subsysid-0123456789'
+CERT = 'c' * 64
+
+
+def naive_sign(data):
+    md5_string = SYSID + SUBSYSID + CERT + data
+    return md5(md5_string.encode("utf-8")).hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bills', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    signer = SJTUSigner(SYSID, SUBSYSID, CERT)
+    billnos = [base64.urlsafe_b64encode(uuid.uuid4().bytes).decode("ascii") for __ in range(args.bills)]
+    signs = signer.sign_many(billnos)
+    assert signs == [naive_sign(billno) for billno in billnos]
+
+    cases = {
+        'naive sign': lambda: [naive_sign(billno) for billno in billnos],
+        'signer.sign': lambda: [signer.sign(billno) for billno in billnos],
+        'signer.sign_many': lambda: signer.sign_many(billnos),
+        'naive verify': lambda: [naive_sign(billno) == sign for billno, sign in zip(billnos, signs)],
+        'signer.verify_many': lambda: signer.verify_many(zip(billnos, signs)),
+    }
+    print(f'{args.bills} bills, best of {args.repeat}')
+    for name, func in cases.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f'{name:>20}: {best * 1000:8.2f} ms  {best / args.bills * 1e9:8.0f} ns/bill')
+
+
+if __name__ == '__main__':
+    main()
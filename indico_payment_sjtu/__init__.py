@@ -8,5 +8,3 @@
 from indico.util.i18n import make_bound_gettext
 
 _ = make_bound_gettext('payment_sjtu')
-
-import indico_payment_sjtu.monkey_patch
@@ -0,0 +1,81 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Attachments of the registration emails.
+
+The iCal document of an event is the same for all its registrants, so it
+is cached under the version of the event (see
+:func:`~indico_payment_sjtu.cache.get_event_version`) and built again
+only after the event has been updated.  Tickets are personal and are
+generated by the task sending the emails, which looks up the ticket
+template of each form only once per batch.
+"""
+
+from indico.core import signals
+from indico.core.cache import make_scoped_cache
+from indico.core.config import config
+from indico.modules.core.settings import core_settings
+from indico.modules.events.ical import MIMECalendar, event_to_ical
+
+from indico_payment_sjtu.cache import get_event_version, get_or_compute
+
+ICAL_TTL = 86400
+# how long other workers wait for an iCal document being built
+ICAL_LOCK_TIMEOUT = 30
+
+ical_cache = make_scoped_cache('payment-sjtu-ical')
+
+
+def _build_event_ical(event):
+    return event_to_ical(event, method='REQUEST', skip_access_check=True,
+                         organizer=(core_settings.get('site_title'), config.NO_REPLY_EMAIL))
+
+
+def get_event_ical(event):
+    """Get the iCal document sent to the registrants of an event."""
+    return get_or_compute(ical_cache, f'{event.id}-{get_event_version(event)}', lambda: _build_event_ical(event),
+                          timeout=ICAL_TTL, lock_timeout=ICAL_LOCK_TIMEOUT)
+
+
+class RegistrationAttachments:
+    """Build the attachments of the registration emails sent in one batch."""
+
+    def __init__(self):
+        self._ticket_templates = {}
+
+    def get_ticket_template(self, regform):
+        try:
+            return self._ticket_templates[regform.id]
+        except KeyError:
+            from indico.modules.designer.util import get_default_ticket_on_category
+            template = regform.ticket_template or get_default_ticket_on_category(regform.event.category)
+            self._ticket_templates[regform.id] = template
+            return template
+
+    def generate_ticket(self, registration):
+        """Generate the ticket PDF of a registration, like Indico's ``generate_ticket``."""
+        from indico.modules.events.registration.badges import (RegistrantsListToBadgesPDF,
+                                                               RegistrantsListToBadgesPDFFoldable)
+        from indico.modules.events.registration.controllers.management.tickets import \
+            DEFAULT_TICKET_PRINTING_SETTINGS
+        regform = registration.registration_form
+        template = self.get_ticket_template(regform)
+        registrations = [registration]
+        signals.event.designer.print_badge_template.send(template, regform=regform, registrations=registrations)
+        pdf_class = RegistrantsListToBadgesPDFFoldable if template.backside_template else RegistrantsListToBadgesPDF
+        pdf = pdf_class(template, DEFAULT_TICKET_PRINTING_SETTINGS, registration.event, registrations)
+        return pdf.get_pdf()
+
+    def get(self, registration, *, ticket=False, ical=False):
+        """Get the attachments of an email sent to a registrant."""
+        attachments = []
+        if ticket:
+            with registration.event.force_event_locale(registration.user):
+                attachments.append(('Ticket.pdf', self.generate_ticket(registration).getvalue()))
+        if ical:
+            attachments.append(MIMECalendar('event.ics', get_event_ical(registration.event)))
+        return attachments
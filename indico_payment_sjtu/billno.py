@@ -0,0 +1,71 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Convert between registration uuids and SJTU Pay bill numbers.
+
+SJTU Pay only supports bill numbers of up to 30 characters, but a uuid is
+36 characters long, so the bill number of a registration is the url-safe
+base64 encoding of the 16 bytes of its uuid.  Both directions are cached
+since the same registrations are converted over and over again by the
+registration list, the exports and the payment handlers.
+"""
+
+import base64
+import re
+from functools import lru_cache
+from uuid import UUID
+
+
+BILLNO_CACHE_SIZE = 16384
+
+_billno_re = re.compile(r'^[A-Za-z0-9_-]{21}[AQgw]==$')
+
+
+class InvalidBillNumber(ValueError):
+    """A string is not the bill number of a registration."""
+
+
+def is_valid_billno(billno):
+    """Check whether a string has the format of a bill number.
+
+    Only the canonical encoding of a uuid is accepted: 22 characters of the
+    url-safe base64 alphabet, whose last one leaves no unused bits set,
+    followed by two padding characters.
+    """
+    return isinstance(billno, str) and _billno_re.match(billno) is not None
+
+
+@lru_cache(maxsize=BILLNO_CACHE_SIZE)
+def uuid_to_billno(token):
+    """Get the bill number of a registration uuid (a string or a :class:`~uuid.UUID`)."""
+    if not isinstance(token, UUID):
+        token = UUID(token)
+    return base64.urlsafe_b64encode(token.bytes).decode('ascii')
+
+
+@lru_cache(maxsize=BILLNO_CACHE_SIZE)
+def billno_to_uuid(billno):
+    """Get the registration uuid, as a string, of a bill number.
+
+    :raise InvalidBillNumber: if `billno` is not a valid bill number
+    """
+    if not is_valid_billno(billno):
+        raise InvalidBillNumber(f'Invalid bill number: {billno!r}')
+    return str(UUID(bytes=base64.urlsafe_b64decode(billno)))
+
+
+def uuids_to_billnos(tokens):
+    """Get the bill numbers of a sequence of registration uuids."""
+    return list(map(uuid_to_billno, tokens))
+
+
+def billnos_to_uuids(billnos):
+    """Get the registration uuids of a sequence of bill numbers.
+
+    :raise InvalidBillNumber: if one of the `billnos` is not valid
+    """
+    return list(map(billno_to_uuid, billnos))
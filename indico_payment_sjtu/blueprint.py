@@ -7,9 +7,10 @@
 
 from indico.core.plugins import IndicoPluginBlueprint
 
+from indico_payment_sjtu.billno import uuid_to_billno
 from indico_payment_sjtu.controllers import RHSJTUSuccess, RHSJTUQuery, RHSJTUInvoice, RHSJTUInvoicePDF, \
-    RHSJTUCallback, RHSJTUSetRefund, RHSJTURefund
-from indico_payment_sjtu.util import uuid_to_billno
+    RHSJTUCallback, RHSJTUSetRefund, RHSJTURefund, RHSJTUMetrics, RHSJTUBulkRefund, RHSJTURefundBatch, \
+    RHSJTURefundBatchStatus, RHSJTURefundBatchRetry, RHSJTURegistrationListPage
 
 blueprint = IndicoPluginBlueprint(
     'payment_sjtu', __name__,
@@ -30,6 +31,7 @@ blueprint.add_url_rule(
     'invoice_pdf', RHSJTUInvoicePDF, methods=('GET',))
 blueprint.add_url_rule('/payment/sjtu/callback', 'callback', RHSJTUCallback,
                        methods=('GET', 'POST'))
+blueprint.add_url_rule('/payment/sjtu/metrics', 'metrics', RHSJTUMetrics)
 
 blueprint.add_url_rule(
     '/event/<int:event_id>/registrations/<int:reg_form_id>/payment/sjtu/set_refund',
@@ -37,6 +39,21 @@ blueprint.add_url_rule(
 blueprint.add_url_rule(
     '/event/<int:event_id>/registrations/<int:reg_form_id>/payment/sjtu/refund',
     'refund', RHSJTURefund, methods=('GET', 'POST'))
+blueprint.add_url_rule(
+    '/event/<int:event_id>/manage/registration/<int:reg_form_id>/sjtu/registrations',
+    'registration_list_page', RHSJTURegistrationListPage)
+blueprint.add_url_rule(
+    '/event/<int:event_id>/manage/registration/<int:reg_form_id>/sjtu/refunds',
+    'bulk_refund', RHSJTUBulkRefund, methods=('POST',))
+blueprint.add_url_rule(
+    '/event/<int:event_id>/manage/registration/<int:reg_form_id>/sjtu/refunds/<int:batch_id>',
+    'refund_batch', RHSJTURefundBatch)
+blueprint.add_url_rule(
+    '/event/<int:event_id>/manage/registration/<int:reg_form_id>/sjtu/refunds/<int:batch_id>/status',
+    'refund_batch_status', RHSJTURefundBatchStatus)
+blueprint.add_url_rule(
+    '/event/<int:event_id>/manage/registration/<int:reg_form_id>/sjtu/refunds/<int:batch_id>/retry',
+    'refund_batch_retry', RHSJTURefundBatchRetry, methods=('POST',))
 
 # Used by PayPal to send an asynchronous notification for the transaction (pending, successful, etc)
 # blueprint.add_url_rule('/ipn', 'notify', RHSJTUIPN, methods=('POST',))
@@ -0,0 +1,142 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import time
+from functools import partial
+
+from indico.core.cache import make_scoped_cache
+
+from indico_payment_sjtu.util import call_after_commit
+
+# how long a "not paid" answer of the portal is reused
+QUERY_RESULT_TTL = 10
+# how long a "paid" answer is reused; later requests see the paid registration
+QUERY_PAID_TTL = 60
+# how long other requests wait for a running query of the same bill before
+# they query the portal themselves
+QUERY_LOCK_TIMEOUT = 3
+# how often waiting requests check for the result
+POLL_INTERVAL = 0.1
+# how long the e-tickets of a bill are reused, and how long the portal is
+# not asked again after it reported that no ticket has been issued yet
+TICKETS_TTL = 86400
+TICKETS_NOT_ISSUED_TTL = 300
+# seconds between the payment and the first ticket query
+TICKETS_PREFETCH_DELAY = 60
+
+event_cache = make_scoped_cache('payment-sjtu-events')
+query_cache = make_scoped_cache('payment-sjtu-query')
+ticket_cache = make_scoped_cache('payment-sjtu-tickets')
+
+
+def get_or_compute(cache, key, compute, timeout, lock_timeout):
+    """Get a cached value, computing it in a single process at a time.
+
+    Concurrent calls for the same key are collapsed: only one of them runs
+    ``compute`` while the others wait (up to `lock_timeout` seconds) for
+    its result.
+
+    :param cache: The scoped cache storing the value
+    :param compute: A callable returning the value; ``None`` is not cached
+    :param timeout: The cache timeout, or a callable returning the timeout
+                    for a value (``None`` if the value is not to be cached)
+    """
+    result = cache.get(key)
+    if result is not None:
+        return result
+    lock_key = f'{key}-lock'
+    if not cache.add(lock_key, True, timeout=lock_timeout):
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            result = cache.get(key)
+            if result is not None:
+                return result
+            if cache.get(lock_key) is None:
+                # the other computation failed or did not store its result
+                break
+    try:
+        result = compute()
+        if result is not None:
+            result_timeout = timeout(result) if callable(timeout) else timeout
+            if result_timeout is not None:
+                cache.set(key, result, timeout=result_timeout)
+    finally:
+        cache.delete(lock_key)
+    return result
+
+
+def _get_version(key):
+    # a timestamp never matches the version of a document cached before
+    # the version itself was evicted from the cache
+    event_cache.add(key, time.time_ns())
+    return event_cache.get(key)
+
+
+def get_event_version(event):
+    """Get the version of an event, which changes whenever the event is updated.
+
+    It is part of the keys of the documents cached for an event, such as
+    the invoice PDFs and the iCal attachment of the registration emails.
+    """
+    return _get_version(f'version-{event.id}')
+
+
+def bump_event_version(event):
+    """Invalidate the documents cached for an event."""
+    event_cache.set(f'version-{event.id}', time.time_ns())
+
+
+def get_programme_version(event):
+    """Get the version of the programme and the tracks of an event."""
+    return _get_version(f'programme-{event.id}')
+
+
+def bump_programme_version(event_id):
+    """Invalidate the documents showing the programme of an event."""
+    event_cache.set(f'programme-{event_id}', time.time_ns())
+
+
+def get_query_result(billno, query):
+    """Get the outcome of a pre-payment query for a bill.
+
+    Concurrent queries of the same bill are collapsed into one.  A "paid"
+    outcome is only stored once the payment registered by the query has
+    been committed.
+
+    :param billno: The bill number used as cache key
+    :param query: A callable returning whether the bill has been paid
+    """
+    def _query():
+        paid = query()
+        if paid:
+            call_after_commit(partial(query_cache.set, billno, True, timeout=QUERY_PAID_TTL))
+        return paid
+
+    return get_or_compute(query_cache, billno, _query, timeout=lambda paid: None if paid else QUERY_RESULT_TTL,
+                          lock_timeout=QUERY_LOCK_TIMEOUT)
+
+
+def forget_query_result(billno):
+    """Drop the outcome of the queries of a bill once the transaction is committed."""
+    call_after_commit(partial(query_cache.delete, billno))
+
+
+def get_tickets(billno, query):
+    """Get the e-tickets issued for a bill.
+
+    :param billno: The bill number used as cache key
+    :param query: A callable returning the list of tickets, or ``None`` if
+                  the portal could not be queried (which is not cached)
+    """
+    return get_or_compute(ticket_cache, billno, query,
+                          timeout=lambda tickets: TICKETS_TTL if tickets else TICKETS_NOT_ISSUED_TTL,
+                          lock_timeout=QUERY_LOCK_TIMEOUT)
+
+
+def forget_tickets(billno):
+    ticket_cache.delete(billno)
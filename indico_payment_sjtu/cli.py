@@ -0,0 +1,103 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import json
+import subprocess
+import sys
+
+import click
+from terminaltables import AsciiTable
+
+from indico.cli.core import cli_group
+from indico.core.db import db
+
+from indico_payment_sjtu.models.callbacks import CallbackState, SJTUCallback
+from indico_payment_sjtu.outbox import get_outbox_counts, replay_callbacks
+from indico_payment_sjtu.patches import PATCH_MODULE
+from indico_payment_sjtu.plugin import SJTUPaymentPlugin
+
+
+@cli_group(name='payment-sjtu')
+def cli():
+    """Manage the SJTU Pay plugin."""
+
+
+@cli.command()
+def outbox():
+    """Show the callback outbox and its dead letters."""
+    counts = get_outbox_counts()
+    click.echo(', '.join(f'{state.name}: {count}' for state, count in counts.items()))
+    failed = SJTUCallback.query.filter_by(state=CallbackState.failed).order_by(SJTUCallback.id).all()
+    if not failed:
+        return
+    table_data = [['ID', 'Registration', 'Trade', 'Received', 'Attempts', 'Error']]
+    for callback in failed:
+        table_data.append([str(callback.id), str(callback.registration_id), callback.trade_no or '',
+                           callback.received_dt.isoformat(), str(callback.attempts), callback.error or ''])
+    click.echo(AsciiTable(table_data, click.style('Dead letters', fg='red', bold=True)).table)
+
+
+@cli.command()
+@click.argument('callback_ids', nargs=-1, type=int)
+@click.option('--failed', is_flag=True, help='Replay all dead letters')
+@click.option('--now', is_flag=True, help='Drain the outbox right away instead of waiting for the next run')
+def replay(callback_ids, failed, now):
+    """Process stored callbacks again."""
+    if not callback_ids and not failed:
+        raise click.UsageError('Pass the ids of the callbacks to replay or --failed')
+    count = replay_callbacks(callback_ids, failed=failed)
+    db.session.commit()
+    click.echo(f'{count} callbacks will be processed again')
+    if now:
+        _drain()
+
+
+@cli.command()
+def drain():
+    """Drain the callback outbox."""
+    _drain()
+
+
+def _drain():
+    from indico_payment_sjtu.tasks import drain_callback_outbox
+    with SJTUPaymentPlugin.instance.plugin_context():
+        drain_callback_outbox()
+    click.echo(', '.join(f'{state.name}: {count}' for state, count in get_outbox_counts().items()))
+
+
+# runs in a fresh interpreter, so modules imported by this process do not hide the cost
+_STARTUP_PROFILE_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import indico.web.flask.app
+indico_time = time.perf_counter() - start
+start = time.perf_counter()
+import indico_payment_sjtu.plugin
+plugin_time = time.perf_counter() - start
+from indico_payment_sjtu.patches import apply_patches
+print(json.dumps({'indico': indico_time, 'plugin': plugin_time,
+                  'patches': [timing._asdict() for timing in apply_patches()]}))
+'''
+
+
+@cli.command('startup-profile')
+def startup_profile():
+    """Show how long it takes to import the plugin and to apply its patches."""
+    output = subprocess.run([sys.executable, '-c', _STARTUP_PROFILE_SCRIPT], check=True, capture_output=True,
+                            text=True).stdout
+    profile = json.loads(output.splitlines()[-1])
+    table_data = [['Step', 'Import (ms)', 'Apply (ms)'],
+                  ['Indico', f'{profile["indico"] * 1000:.1f}', ''],
+                  ['Plugin', f'{profile["plugin"] * 1000:.1f}', '']]
+    patch_total = 0
+    for timing in profile['patches']:
+        name = 'rest of the patch module' if timing['name'] == PATCH_MODULE else f'patch: {timing["name"]}'
+        table_data.append([name, f'{timing["import_seconds"] * 1000:.1f}', f'{timing["apply_seconds"] * 1000:.1f}'])
+        patch_total += timing['import_seconds'] + timing['apply_seconds']
+    click.echo(AsciiTable(table_data, click.style('Startup profile', fg='cyan', bold=True)).table)
+    click.echo(f'Plugin import: {profile["plugin"] * 1000:.1f} ms at boot, '
+               f'patches: {patch_total * 1000:.1f} ms deferred to the first request')
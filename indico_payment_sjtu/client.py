@@ -0,0 +1,91 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+POOL_SIZE = 4
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (502, 503, 504)
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD'})
+
+
+class SJTUPortalClient:
+    """Keep-alive HTTP client for the SJTU Pay portal.
+
+    All requests go through pooled :class:`requests.Session` objects, so
+    the TCP/TLS connection to the portal is reused between requests
+    handled by the same worker.  Only idempotent queries are retried;
+    requests sent with ``retry=False``, such as refunds, go through a
+    session which never retries them, not even after a read timeout.
+    """
+
+    def __init__(self, read_timeout=DEFAULT_READ_TIMEOUT, retries=DEFAULT_RETRIES, pool_size=POOL_SIZE,
+                 backoff_factor=RETRY_BACKOFF_FACTOR):
+        self.timeout = (CONNECT_TIMEOUT, read_timeout)
+        self.retries = retries
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=IDEMPOTENT_METHODS, raise_on_status=False)
+        self.session = self._make_session(pool_size, retry)
+        self.session_without_retries = self._make_session(pool_size, 0)
+
+    @staticmethod
+    def _make_session(pool_size, max_retries):
+        # pool_block keeps the number of connections per worker bounded
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=max_retries)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _get_session(self, retry):
+        return self.session if retry else self.session_without_retries
+
+    def get(self, url, params=None, retry=True):
+        return self._get_session(retry).get(url, params=params, timeout=self.timeout)
+
+    def post(self, url, data=None, retry=True):
+        return self._get_session(retry).post(url, data=data, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+        self.session_without_retries.close()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _is_current(client, read_timeout, retries):
+    return (client is not None and _client_pid == os.getpid() and
+            client.timeout[1] == read_timeout and client.retries == retries)
+
+
+def get_portal_client(read_timeout=DEFAULT_READ_TIMEOUT, retries=DEFAULT_RETRIES):
+    """Get the process-wide portal client.
+
+    The client is recreated after a fork (connections must not be shared
+    between gunicorn workers) or when the timeout/retry settings change.
+    """
+    global _client, _client_pid
+    if _is_current(_client, read_timeout, retries):
+        return _client
+    with _client_lock:
+        if _is_current(_client, read_timeout, retries):
+            return _client
+        _client = SJTUPortalClient(read_timeout=read_timeout, retries=retries)
+        _client_pid = os.getpid()
+        return _client
@@ -0,0 +1,147 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Encode and decode the XML documents exchanged with SJTU Pay.
+
+The parsers know the layout of each document and go straight from the
+XML to small records; the flat ``fields`` dicts they contain are the
+payloads stored in the transaction data.
+"""
+
+import xml.etree.ElementTree as ET
+from typing import NamedTuple
+from xml.sax.saxutils import escape
+
+XML_DECLARATION = '<?xml version="1.0" encoding="GBK"?>'
+
+
+class SJTUPayloadError(ValueError):
+    """A document received from SJTU Pay could not be decoded."""
+
+
+class PayResult(NamedTuple):
+    """A ``payResult`` sent to the success and callback URLs."""
+
+    billno: str
+    billamt: str
+    trade_no: str
+    #: all the elements of the document
+    fields: dict
+
+
+class QueryResult(NamedTuple):
+    """A ``QueryResult`` returned by the query actions of the portal."""
+
+    returncode: str
+    returnmsg: str
+    #: the ``billdetail`` entries of a bill query
+    billdetails: tuple
+    #: the ``tkinfo`` entries of a ticket query
+    tickets: tuple
+
+    @property
+    def success(self):
+        return self.returncode == '0000'
+
+
+class RefundResult(NamedTuple):
+    """A ``refundResult`` returned by the refund action of the portal."""
+
+    refund_state: str
+    error_msg: str
+
+    @property
+    def success(self):
+        return self.refund_state == '1'
+
+
+def _parse(data, root_tag):
+    # the documents come from unauthenticated requests; SJTU Pay never sends a
+    # DTD, and refusing them rules out entity expansion and external entities
+    if '<!DOCTYPE' in data:
+        raise SJTUPayloadError('Unexpected document type declaration')
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError as exc:
+        raise SJTUPayloadError(f'Invalid XML: {exc}') from exc
+    if root.tag != root_tag:
+        raise SJTUPayloadError(f'Expected <{root_tag}>, got <{root.tag}>')
+    return root
+
+
+def _flatten(element):
+    # empty elements are None, the same as with xmltodict
+    return {child.tag: child.text for child in element}
+
+
+def _text(element, path):
+    child = element.find(path)
+    return child.text if child is not None else None
+
+
+def parse_pay_result(data):
+    fields = _flatten(_parse(data, 'payResult'))
+    try:
+        return PayResult(fields['billno'], fields['billamt'], fields.get('trade_no'), fields)
+    except KeyError as exc:
+        raise SJTUPayloadError(f'Missing element: {exc}') from exc
+
+
+def parse_query_result(data):
+    root = _parse(data, 'QueryResult')
+    return QueryResult(returncode=_text(root, 'State/returncode'),
+                       returnmsg=_text(root, 'State/returnmsg'),
+                       billdetails=tuple(_flatten(el) for el in root.iterfind('Billinfo/billdetail')),
+                       tickets=tuple(_flatten(el) for el in root.iterfind('Tickets/tkinfo')))
+
+
+def parse_refund_result(data):
+    root = _parse(data, 'refundResult')
+    return RefundResult(refund_state=_text(root, 'refundState'), error_msg=_text(root, 'errorMsg'))
+
+
+def parse_billinfo(data):
+    """Parse a ``billinfo`` document into a dict of its top-level elements."""
+    return _flatten(_parse(data, 'billinfo'))
+
+
+def _serialize(tag, fields, parts):
+    parts.append(f'<{tag}>')
+    # keys are sorted to produce the same documents as dict2xml did
+    for key, value in sorted(fields.items()):
+        if isinstance(value, dict):
+            _serialize(key, value, parts)
+        else:
+            parts.append(f'<{key}>{escape(str(value)) if value is not None else ""}</{key}>')
+    parts.append(f'</{tag}>')
+
+
+def serialize(tag, fields):
+    """Serialize a document sent to SJTU Pay.
+
+    Characters which cannot be represented in GBK (the encoding declared
+    in the document) are written as character references.
+
+    :param tag: The root element, e.g. ``billinfo`` or ``refundBoll``
+    :param fields: A dict of elements; dict values become nested elements
+    """
+    parts = [XML_DECLARATION]
+    _serialize(tag, fields, parts)
+    xml = ''.join(parts)
+    try:
+        xml.encode('gbk')
+    except UnicodeEncodeError:
+        xml = xml.encode('gbk', 'xmlcharrefreplace').decode('gbk')
+    return xml
+
+
+def serialize_billinfo(fields):
+    return serialize('billinfo', fields)
+
+
+def serialize_refund(fields):
+    return serialize('refundBoll', fields)
@@ -6,41 +6,57 @@
 # see the LICENSE file for more details.
 from io import BytesIO
 from itertools import chain
-from hashlib import md5
-import base64
-import xmltodict
-from uuid import UUID
+import hmac
+import time
 import urllib.parse
 
 import requests
-from dict2xml import dict2xml
-from flask import flash, redirect, request, jsonify, session
+from flask import Response, flash, redirect, request, jsonify, session
 from flask_pluginengine import current_plugin, render_plugin_template
-from indico.legacy.pdfinterface.conference import ProgrammeToPDF
+from sqlalchemy.orm import joinedload
+from indico.core.db import db
 from indico.modules.events.controllers.base import RHDisplayEventBase
 from indico.modules.events.payment import payment_event_settings
 from indico.modules.events.registration.controllers.display import \
     RHRegistrationFormDisplayBase, RHRegistrationFormRegistrationBase
 from indico.modules.events.registration.controllers.management import \
     RHManageRegFormBase, RHManageRegistrationBase
+from indico.modules.events.registration.lists import RegistrationListGenerator
 from indico.modules.events.registration.util import get_event_regforms_registrations
 from indico.web.util import jsonify_data, jsonify_template
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, NotFound, Unauthorized
 
 from indico.modules.events.payment.models.transactions import TransactionAction
 from indico.modules.events.payment.notifications import notify_amount_inconsistency
 from indico.modules.events.payment.util import register_transaction
 from indico.modules.events.registration.models.registrations import Registration, \
     RegistrationState
+from indico.web.flask.templating import get_template_module
 from indico.web.flask.util import url_for, send_file
 from indico.web.rh import RH
 
 from indico_payment_sjtu import _
-from indico_payment_sjtu.util import uuid_to_billno
-from indico_payment_sjtu.views import WPInvoice
+from indico_payment_sjtu.billno import billno_to_uuid, is_valid_billno, uuid_to_billno, uuids_to_billnos
+from indico_payment_sjtu.cache import get_query_result, get_tickets
+from indico_payment_sjtu.client import get_portal_client
+from indico_payment_sjtu.codec import (SJTUPayloadError, parse_billinfo, parse_pay_result, parse_query_result,
+                                       parse_refund_result, serialize_refund)
+from indico_payment_sjtu.invoices import get_invoice_pdf, get_invoice_pdf_etag
+from indico_payment_sjtu.metrics import (amount_mismatches, duplicate_payments, handler_seconds, payment_lock_conflicts,
+                                         portal_request_seconds, refunds, render_metrics, sign_mismatches)
+from indico_payment_sjtu.models.bills import SJTUBill
+from indico_payment_sjtu.models.refunds import RefundState, SJTURefund, SJTURefundBatch
+from indico_payment_sjtu.models.transactions import SJTUTransaction
+from indico_payment_sjtu.outbox import enqueue_callback
+from indico_payment_sjtu.refunds import create_refund_batch, get_refundable_registrations, is_refund_started
+from indico_payment_sjtu.settings import get_event_settings, get_event_signer, get_plugin_settings
+from indico_payment_sjtu.views import WPInvoice, WPManageRegistrationSJTU
 
 IPN_VERIFY_EXTRA_PARAMS = (('cmd', '_notify-validate'),)
 
+# the paystate of a paid bill; a refunded bill is no longer reported in this state
+PAYSTATE_PAID = 4
+
 sjtu_transaction_action_mapping = {'Completed': TransactionAction.complete,
                                    'Denied': TransactionAction.reject,
                                    'Pending': TransactionAction.pending}
@@ -51,24 +67,37 @@ class RHSJTUBase(RH):
 
     CSRF_ENABLED = False
 
-    def _init_registration(self, token):
-        self.registration = Registration.query.filter_by(uuid=token).first()
+    def _do_process(self):
+        with handler_seconds.time(handler=type(self).__name__):
+            return super()._do_process()
+
+    def _init_registration(self, billno):
+        if not is_valid_billno(billno):
+            current_plugin.logger.error("Invalid bill number %s", billno)
+            raise BadRequest
+        self.registration = (Registration.query
+                             .join(SJTUBill, SJTUBill.registration_id == Registration.id)
+                             .filter(SJTUBill.billno == billno)
+                             .first())
         if not self.registration:
-            current_plugin.logger.error("Can not find registration with token %s", token)
+            # registrations created while the plugin was disabled have no stored bill number
+            self.registration = Registration.query.filter_by(uuid=billno_to_uuid(billno)).first()
+        if not self.registration:
+            current_plugin.logger.error("Can not find registration with bill number %s", billno)
             raise BadRequest
         self._init_plugin_settings()
 
     def _init_plugin_settings(self):
-        self.sysid = current_plugin.event_settings.get(
-            self.registration.registration_form.event, 'sysid')
-        self.subsysid = current_plugin.event_settings.get(
-            self.registration.registration_form.event, 'subsysid')
-        self.cert = current_plugin.settings.get('cert')
+        self.settings = get_plugin_settings()
+        self.signer = get_event_signer(self.registration.registration_form.event)
+        self.sysid = self.signer.sysid
+        self.subsysid = self.signer.subsysid
 
     def _generate_sign(self, data):
-        md5_string = self.sysid + self.subsysid + self.cert + data
-        sign = md5(md5_string.encode("utf-8")).hexdigest()
-        return sign
+        return self.signer.sign(data)
+
+    def _verify_sign(self, data, sign):
+        return self.signer.verify(data, sign)
 
     def _verify_business(self):
         expected = current_plugin.event_settings.get(
@@ -94,32 +123,69 @@ class RHSJTUBase(RH):
             "Payment doesn't match event's fee: %s %s != %s %s",
             amount, currency, expected_amount, currency)
         # notify_amount_inconsistency(self.registration, amount, currency)
+        amount_mismatches.inc()
         return False
 
+    def _lock_registration(self):
+        """Lock the registration of a payment until the end of the request.
+
+        :return: Whether the lock was acquired; if not, another request or
+                 task is registering a payment of the same registration
+        """
+        if not SJTUTransaction.try_lock_registration(self.registration.id):
+            return False
+        # a concurrent transaction may have registered a payment since the registration was loaded
+        db.session.expire(self.registration)
+        return True
+
     def _is_transaction_duplicated(self, trade_no):
+        if not trade_no:
+            return False
+        if SJTUTransaction.is_trade_registered(trade_no):
+            return True
+        # payments registered before the transaction index existed
         transaction = self.registration.transaction
         if not transaction or transaction.provider != 'sjtu':
             return False
-        return transaction.data['trade_no'] == trade_no
+        return transaction.data.get('trade_no') == trade_no
 
     def _register_transaction(self, payment_result):
         payment_status = "Completed"
-        register_transaction(registration=self.registration,
-                             amount=float(payment_result["billamt"]),
-                             currency=self.registration.currency,
-                             action=sjtu_transaction_action_mapping[payment_status],
-                             provider='sjtu',
-                             data=payment_result)
-
-    def _query_sjtu_portal(self, query_url, data, method="GET", unquote=False):
+        transaction = register_transaction(registration=self.registration,
+                                           amount=float(payment_result["billamt"]),
+                                           currency=self.registration.currency,
+                                           action=sjtu_transaction_action_mapping[payment_status],
+                                           provider='sjtu',
+                                           data=payment_result)
+        if transaction is not None:
+            db.session.add(SJTUTransaction(billno=uuid_to_billno(self.registration.uuid),
+                                           trade_no=payment_result.get("trade_no"),
+                                           registration=self.registration,
+                                           transaction=transaction))
+        return transaction
+
+    def _query_sjtu_portal(self, query_url, data, parse, method="GET", unquote=False, retry=True):
+        start = time.perf_counter()
+        outcome, result = self._send_sjtu_query(query_url, data, parse, method, unquote, retry)
+        portal_request_seconds.observe(time.perf_counter() - start, action=query_url.rpartition("/")[2],
+                                       outcome=outcome)
+        return result
+
+    def _send_sjtu_query(self, query_url, data, parse, method, unquote, retry):
         current_plugin.logger.info("Send query to %s [%s]: %s", query_url, method, data)
-        if method == "GET":
-            response = requests.get(query_url, params=data)
-        elif method == "POST":
-            response = requests.post(query_url, data=data)
-        else:
-            current_plugin.logger.error("HTTP method error: %s", method)
-            return None
+        client = get_portal_client(read_timeout=self.settings['portal_timeout'],
+                                   retries=self.settings['portal_retries'] or 0)
+        try:
+            if method == "GET":
+                response = client.get(query_url, params=data, retry=retry)
+            elif method == "POST":
+                response = client.post(query_url, data=data, retry=retry)
+            else:
+                current_plugin.logger.error("HTTP method error: %s", method)
+                return "error", None
+        except requests.RequestException as exc:
+            current_plugin.logger.error("Query to %s failed: %s", query_url, exc)
+            return "error", None
         result = response.text
         current_plugin.logger.info("Receive data: %s", result)
         at_pos = result.find("@")
@@ -128,24 +194,124 @@ class RHSJTUBase(RH):
         if unquote:
             raw_data = urllib.parse.unquote_plus(raw_data)
             current_plugin.logger.info("Unquote data: %s", raw_data)
-        my_sign = self._generate_sign(raw_data)
-        if my_sign != sign:
-            current_plugin.logger.error("Sign error: %s != %s", my_sign, sign)
-            return None
-        data = xmltodict.parse(raw_data)
+        if not self._verify_sign(raw_data, sign):
+            current_plugin.logger.error("Sign error: %s", sign)
+            return "sign_error", None
+        try:
+            data = parse(raw_data)
+        except SJTUPayloadError as exc:
+            current_plugin.logger.error("Invalid data: %s", exc)
+            return "invalid", None
         current_plugin.logger.info("Parsed data: %s", data)
-        return data
+        return "ok", data
 
     def _validate_sjtu_result(self, data):
-        if data is not None:
-            returncode = data["QueryResult"]["State"]["returncode"]
-            if returncode != "0000":
-                returnmsg = data["QueryResult"]["State"]["returnmsg"]
-                current_plugin.logger.warn("Return code error: %s %s", returncode,
-                                           returnmsg)
-                return None
+        if data is not None and not data.success:
+            current_plugin.logger.warn("Return code error: %s %s", data.returncode,
+                                       data.returnmsg)
+            return None
         return data
 
+    def _query_sjtu_bill(self, billno):
+        """Fetch the payment details of a bill from SJTU Pay.
+
+        This does not use ``self.registration``, so it can run in a worker
+        thread while the registration stays in the calling thread.
+        """
+        return self._query_sjtu_bill_details(billno) or []
+
+    def _is_sjtu_bill_refunded(self, billno):
+        """Check whether SJTU Pay has refunded a paid bill.
+
+        Like :meth:`_query_sjtu_bill` this does not use ``self.registration``.
+
+        :return: ``True`` if the bill is no longer paid, ``False`` if it
+                 still is, or ``None`` if the portal could not tell
+        """
+        details = self._query_sjtu_bill_details(billno)
+        if not details:
+            return None
+        return all(int(detail["paystate"]) != PAYSTATE_PAID for detail in details)
+
+    def _query_sjtu_bill_details(self, billno):
+        query_url = f"{self.settings['url']}/payment/portal/Query_PayQuery.action"
+        sign = self._generate_sign(billno)
+        params = {
+            "sign": sign,
+            "sysid": self.sysid,
+            "subsysid": self.subsysid,
+            "billno": billno,
+        }
+        data = self._query_sjtu_portal(query_url, params, parse_query_result)
+        data = self._validate_sjtu_result(data)
+        if data is None:
+            return None
+        return list(data.billdetails)
+
+    def _query_sjtu_tickets(self, billno):
+        """Fetch the e-tickets issued for a bill from SJTU Pay.
+
+        :return: A list of tickets, or ``None`` if the query failed
+        """
+        query_url = f"{self.settings['url']}/payment_dzp/portal/TicketQuery.action"
+        sign = self._generate_sign(billno)
+        params = {
+            "sign": sign,
+            "sysid": self.sysid,
+            "subsysid": self.subsysid,
+            "billno": billno,
+        }
+        data = self._query_sjtu_portal(query_url, params, parse_query_result)
+        data = self._validate_sjtu_result(data)
+        if data is None:
+            return None
+        return list(data.tickets)
+
+    def _refund_sjtu_bill(self, billno, billamt, feeitemid):
+        """Request the refund of a bill from SJTU Pay.
+
+        Like :meth:`_query_sjtu_bill` this does not use ``self.registration``.
+
+        :return: A :class:`~indico_payment_sjtu.codec.RefundResult`, or
+                 ``None`` if the request failed
+        """
+        query_url = f"{self.settings['url']}/payment/portal/appRefund.action"
+        data = serialize_refund({
+            "billno": billno,
+            "billamt": billamt,
+            "feeitemid": feeitemid,
+            "feeord": 1,
+            "reason": "取消参加会议"
+        })
+        sign = self._generate_sign(data)
+        params = {
+            "sign": sign,
+            "sysid": self.sysid,
+            "subsysid": self.subsysid,
+            "data": data,
+        }
+        # a refund whose answer is lost may have been carried out, it must not be sent again
+        return self._query_sjtu_portal(query_url, params, parse_refund_result, unquote=True, retry=False)
+
+    def _register_paid_bill(self, payment_results):
+        """Register the payment of a bill reported as paid by SJTU Pay.
+
+        :return: ``True`` if the bill has been paid, ``False`` if it has
+                 not, or ``None`` if its payment is being registered by
+                 someone else and its outcome is not known yet
+        """
+        for payment_result in payment_results:
+            if int(payment_result["paystate"]) == PAYSTATE_PAID and self._verify_amount(
+                    float(payment_result["billamt"])):
+                payment_result.pop("paystate")
+                if not self._lock_registration():
+                    payment_lock_conflicts.inc(handler='query')
+                    return None
+                if not self._is_transaction_duplicated(payment_result.get("trade_no")):
+                    self._register_transaction(payment_result)
+                return True
+        return False
+
 
 class RHSJTUResult(RHSJTUBase):
     def _process_args(self):
@@ -166,22 +332,28 @@ class RHSJTUResult(RHSJTUBase):
         else:
             current_plugin.logger.error("Data not found!")
             raise ValueError("data")
-        data = xmltodict.parse(self.raw_data)
-        self.payment_result = data["payResult"]
-        self.token = str(
-            UUID(bytes=base64.urlsafe_b64decode(self.payment_result["billno"])))
-        self._init_registration(self.token)
+        try:
+            self.payment_result = parse_pay_result(self.raw_data).fields
+        except SJTUPayloadError as exc:
+            current_plugin.logger.error("Invalid payment result: %s", exc)
+            raise BadRequest
+        self._init_registration(self.payment_result["billno"])
 
 
 class RHSJTUSuccess(RHSJTUResult):
     """Confirmation message after successful payment"""
 
     def _process(self):
-        if self._generate_sign(self.raw_data) != self.sign:
+        if not self._verify_sign(self.raw_data, self.sign):
+            sign_mismatches.inc(handler='success')
             flash(_('Payment sign error.'), 'error')
         elif not self._verify_amount(float(self.payment_result["billamt"])):
             flash(_('Payment amount error.'), 'error')
+        elif not self._lock_registration():
+            payment_lock_conflicts.inc(handler='success')
+            flash(_('Your payment is being processed.'), 'info')
         elif self._is_transaction_duplicated(self.payment_result["trade_no"]):
+            duplicate_payments.inc(handler='success')
             flash(_('Payment transaction duplicated.'), 'warning')
         else:
             self._register_transaction(self.payment_result)
@@ -194,12 +366,22 @@ class RHSJTUCallback(RHSJTUResult):
     def _process(self):
         current_plugin.logger.info("Callback: %s", self.payment_result)
         result = False
-        if self._generate_sign(self.raw_data) != self.sign:
+        if not self._verify_sign(self.raw_data, self.sign):
             current_plugin.logger.error("Callback: Payment sign error.")
-        if not self._verify_amount(float(self.payment_result["billamt"])):
+            sign_mismatches.inc(handler='callback')
+        elif self.settings['callback_fast_ack']:
+            callback = enqueue_callback(self.registration, self.payment_result.get("trade_no"), self.raw_data)
+            current_plugin.logger.info("Callback: Queued as %r", callback)
+            result = True
+        elif not self._verify_amount(float(self.payment_result["billamt"])):
             current_plugin.logger.error("Callback: Payment amount error.")
+        elif not self._lock_registration():
+            # answer with a failure so SJTU Pay sends the result again
+            current_plugin.logger.warn("Callback: Payment being registered by another request.")
+            payment_lock_conflicts.inc(handler='callback')
         elif self._is_transaction_duplicated(self.payment_result["trade_no"]):
             current_plugin.logger.warn("Callback: Payment transaction duplicated.")
+            duplicate_payments.inc(handler='callback')
             result = True
         else:
             current_plugin.logger.info("Callback: Your payment request has been processed.")
@@ -212,52 +394,36 @@ class RHSJTUQuery(RHSJTUBase):
     def _process_args(self):
         self.sign = request.form['sign']
         self.raw_data = request.form['data']
-        data = xmltodict.parse(self.raw_data)
-        self.billinfo = data["billinfo"]
-        self.token = str(UUID(bytes=base64.urlsafe_b64decode(self.billinfo["billno"])))
-        self._init_registration(self.token)
+        try:
+            self.billinfo = parse_billinfo(self.raw_data)
+        except SJTUPayloadError as exc:
+            current_plugin.logger.error("Invalid bill info: %s", exc)
+            raise BadRequest
+        self._init_registration(self.billinfo["billno"])
 
     def _is_transaction_success_in_sjtu(self):
-        query_url = f"{current_plugin.settings.get('url')}/payment/portal/Query_PayQuery.action"
-        billno = self.billinfo["billno"]
-        sign = self._generate_sign(billno)
-        params = {
-            "sign": sign,
-            "sysid": self.sysid,
-            "subsysid": self.subsysid,
-            "billno": billno,
-        }
-        data = self._query_sjtu_portal(query_url, params)
-        data = self._validate_sjtu_result(data)
-        if data is None:
-            return False
-        if data["QueryResult"]["Billinfo"] is None:
-            return False
-        payment_results = data["QueryResult"]["Billinfo"]["billdetail"]
-        if not isinstance(payment_results, list):
-            payment_results = [payment_results]
-        for payment_result in payment_results:
-            if int(payment_result["paystate"]) == 4 and self._verify_amount(
-                    float(payment_result["billamt"])):
-                payment_result.pop("paystate")
-                self._register_transaction(payment_result)
-                return True
-        return False
+        payment_results = self._query_sjtu_bill(self.billinfo["billno"])
+        return self._register_paid_bill(payment_results)
 
     def _process(self):
         current_plugin.logger.info("Query %s", self.billinfo["billno"])
-        new_sign = self._generate_sign(self.raw_data)
-        if new_sign != self.sign:
+        if not self._verify_sign(self.raw_data, self.sign):
             current_plugin.logger.warn("Query %s: sign error", self.billinfo["billno"])
-            current_plugin.logger.warn("Old sign: %s", self.sign)
-            current_plugin.logger.warn("New sign: %s", new_sign)
+            current_plugin.logger.warn("Sign: %s", self.sign)
             current_plugin.logger.warn("Raw data: %s", self.raw_data)
+            sign_mismatches.inc(handler='query')
             return jsonify(success=False)
         elif self.registration.state != RegistrationState.unpaid:
             current_plugin.logger.info("Query %s: already paid in system",
                                        self.billinfo["billno"])
             return jsonify(success=False)
-        elif self._is_transaction_success_in_sjtu():
+        # an outcome which is not known yet is not cached
+        paid = get_query_result(self.billinfo["billno"], self._is_transaction_success_in_sjtu)
+        if paid is None:
+            current_plugin.logger.info("Query %s: payment being registered",
+                                       self.billinfo["billno"])
+            return jsonify(success=False)
+        elif paid:
             current_plugin.logger.info("Query %s: already paid in sjtu",
                                        self.billinfo["billno"])
             return jsonify(success=False)
@@ -272,41 +438,9 @@ class RHSJTUInvoice(RHSJTUBase, RHRegistrationFormRegistrationBase):
         self._init_plugin_settings()
         current_plugin.logger.info(self.registration)
 
-    def _query_sjtu_tickets(self):
-        # query_url = f"{current_plugin.settings.get('url')}/payment_dzp/portal/TicketQuery.action"
-        # billno = uuid_to_billno(self.registration.uuid)
-        # sign = self._generate_sign(billno)
-        # params = {
-        #     "sign": sign,
-        #     "sysid": self.sysid,
-        #     "subsysid": self.subsysid,
-        #     "billno": billno,
-        # }
-        # data = self._query_sjtu_portal(query_url, params)
-        # data = self._validate_sjtu_result(data)
-        # if data is None:
-        #     return []
-        # if data["QueryResult"]["Tickets"] is None:
-        #     return []
-        # tickets = data["QueryResult"]["Tickets"]["tkinfo"]
-        # if not isinstance(tickets, list):
-        #     tickets = [tickets]
-        # return tickets
-        ticket = {
-            'type_no': "1002",
-            'tk_typename': "中央非税收入统一票据_电子票",
-            'taxtickettype': "00010118",
-            'ticket_no': "0180906170950",
-            'key': "7704tf",
-            'feeitemdeford': "1169",
-            'feeitemname': "本科生学费",
-            'payamt': "90",
-        }
-        fake_data = [ticket, ticket]
-        return fake_data
-
     def _process(self):
-        sjtu_tickets = self._query_sjtu_tickets()
+        billno = uuid_to_billno(self.registration.uuid)
+        sjtu_tickets = get_tickets(billno, lambda: self._query_sjtu_tickets(billno)) or []
         personal_data = {}
         if len(self.registration.sections_with_answered_fields) > 0:
             d = {field.title: field.id for field in self.registration.sections_with_answered_fields[0].children}
@@ -340,8 +474,15 @@ class RHSJTUInvoicePDF(RHSJTUBase, RHRegistrationFormRegistrationBase):
         current_plugin.logger.info(self.registration)
 
     def _process(self):
-        pdf = ProgrammeToPDF(self.event)
-        return send_file('program.pdf', BytesIO(pdf.getPDFBin()), 'application/pdf')
+        etag = get_invoice_pdf_etag(self.registration)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            pdf = get_invoice_pdf(self.registration)
+            response = send_file('program.pdf', BytesIO(pdf), 'application/pdf')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
 
 
 
@@ -372,46 +513,158 @@ class RHSJTUSetRefund(RHSJTUBase, RHManageRegFormBase):
 
 class RHSJTURefund(RHSJTUBase, RHRegistrationFormRegistrationBase):
 
-    def generate_refund_data(self):
-        d = {
-            "billno": uuid_to_billno(self.registration.uuid),
-            "billamt": self.registration.transaction.data["billamt"],
-            "feeitemid": current_plugin.event_settings.get(
-                self.registration.registration_form.event, 'feeitemid'),
-            "feeord": 1,
-            "reason": "取消参加会议"
-        }
-        xml = dict2xml(d, wrap='refundBoll', indent="").replace("\n", "")
-        return f"""<?xml version="1.0" encoding="GBK"?>{xml}"""
-
     def _process_GET(self):
         return jsonify_template('payment_sjtu:display/refund_transaction.html')
 
     def _process_POST(self):
-        self._init_plugin_settings()
-        query_url = f"{current_plugin.settings.get('url')}/payment/portal/appRefund.action"
-        data = self.generate_refund_data()
-        sign = self._generate_sign(data)
-        params = {
-            "sign": sign,
-            "sysid": self.sysid,
-            "subsysid": self.subsysid,
-            "data": data,
-        }
-        data = self._query_sjtu_portal(query_url, params, unquote=True)
         redirect_url = url_for("event_registration.display_regform", self.registration.locator.registrant)
+        if is_refund_started(self.registration):
+            # a bulk refund is paying the bill back
+            flash(_("This registration is being refunded or has been refunded already."), 'warning')
+            return jsonify_data(flash=True, redirect=redirect_url, success=False)
+        self._init_plugin_settings()
+        data = self._refund_sjtu_bill(uuid_to_billno(self.registration.uuid),
+                                      self.registration.transaction.data["billamt"],
+                                      get_event_settings(self.registration.registration_form.event)['feeitemid'])
         base_error_msg = _("Refund failed, please contact an event manager. Reason: ")
         if data is None:
             flash(base_error_msg + _("API failed"), 'error')
             success = False
-        elif data["refundResult"]["refundState"] == "1":
+            refunds.inc(outcome='api_error')
+        elif data.success:
             flash(_("Refund successful."), 'info')
             success = True
+            refunds.inc(outcome='success')
         else:
-            flash(base_error_msg + data["refundResult"]["errorMsg"], 'error')
+            flash(base_error_msg + (data.error_msg or ""), 'error')
             success = False
+            refunds.inc(outcome='rejected')
         return jsonify_data(flash=True, redirect=redirect_url, success=success)
 
+
+class RHSJTUBulkRefund(RHManageRegFormBase):
+    """Refund the selected registrations"""
+
+    def _process_args(self):
+        RHManageRegFormBase._process_args(self)
+        registration_ids = set(request.form.getlist('registration_id', type=int))
+        self.registrations = get_refundable_registrations(self.regform, registration_ids)
+        self.num_skipped = len(registration_ids) - len(self.registrations)
+
+    def _process(self):
+        if 'confirmed' not in request.form or not self.registrations:
+            return jsonify_template('payment_sjtu:management/bulk_refund.html', regform=self.regform,
+                                    registrations=self.registrations, num_skipped=self.num_skipped)
+        from indico_payment_sjtu.tasks import run_refund_batch
+        batch = create_refund_batch(self.regform, self.registrations, session.user)
+        current_plugin.logger.info("Bulk refund of %d registrations started by %s: %r", len(self.registrations),
+                                   session.user, batch)
+        # the task must see the batch
+        db.session.commit()
+        run_refund_batch.delay(batch.id)
+        return jsonify_data(flash=False, redirect=url_for('plugin_payment_sjtu.refund_batch', batch))
+
+
+def _get_sjtu_trade_no(registration):
+    transaction = registration.transaction
+    if transaction is not None and transaction.provider == 'sjtu' and transaction.data:
+        return transaction.data.get('trade_no')
+    return None
+
+
+class RHSJTURegistrationListPage(RHManageRegFormBase):
+    """Return the next page of the registration list"""
+
+    def _process_args(self):
+        RHManageRegFormBase._process_args(self)
+        self.after = (Registration.query.with_parent(self.regform)
+                      .filter_by(id=request.args.get('after', type=int))
+                      .first_or_404())
+
+    def _process(self):
+        reg_list_kwargs = RegistrationListGenerator(regform=self.regform).get_list_page_kwargs(after=self.after)
+        registrations = reg_list_kwargs['registrations']
+        tpl = get_template_module('payment_sjtu:management/_reglist.html')
+        html = tpl.render_registration_rows(self.regform, registrations, reg_list_kwargs['dynamic_columns'],
+                                            reg_list_kwargs['static_columns'])
+        billnos = uuids_to_billnos([registration.uuid for registration in registrations])
+        return jsonify(html=html,
+                       next_cursor=reg_list_kwargs['next_cursor'],
+                       rows=[{'id': registration.id,
+                              'friendly_id': registration.friendly_id,
+                              'full_name': registration.display_full_name,
+                              'billno': billno,
+                              'trade_no': _get_sjtu_trade_no(registration)}
+                             for registration, billno in zip(registrations, billnos)])
+
+
+class RHSJTURefundBatchBase(RHManageRegFormBase):
+    def _process_args(self):
+        RHManageRegFormBase._process_args(self)
+        self.batch = (SJTURefundBatch.query
+                      .filter_by(id=request.view_args['batch_id'], regform=self.regform)
+                      .first_or_404())
+
+
+class RHSJTURefundBatch(RHSJTURefundBatchBase):
+    """Show the progress of a bulk refund"""
+
+    def _process(self):
+        return WPManageRegistrationSJTU.render_template('payment_sjtu:management/refund_batch.html', self.event,
+                                                        regform=self.regform, batch=self.batch)
+
+
+class RHSJTURefundBatchStatus(RHSJTURefundBatchBase):
+    """Return the outcome of each refund of a bulk refund"""
+
+    def _process(self):
+        counts = self.batch.get_state_counts()
+        refunds = (SJTURefund.query
+                   .filter_by(batch=self.batch)
+                   .options(joinedload(SJTURefund.registration))
+                   .order_by(SJTURefund.id))
+        return jsonify(finished=self.batch.is_finished,
+                       counts={state.name: count for state, count in counts.items()},
+                       refunds=[{'id': refund.id,
+                                 'name': refund.registration.full_name,
+                                 'billamt': refund.billamt,
+                                 'state': refund.state.name,
+                                 'state_title': refund.state.title,
+                                 'error': refund.error}
+                                for refund in refunds])
+
+
+class RHSJTURefundBatchRetry(RHSJTURefundBatchBase):
+    """Submit the failed refunds of a bulk refund again"""
+
+    def _process(self):
+        from indico_payment_sjtu.tasks import run_refund_batch
+        # failed refunds were rejected by SJTU Pay; submitted ones are settled by the batch itself
+        SJTURefund.query.filter_by(batch=self.batch, state=RefundState.failed).update(
+            {'state': RefundState.pending, 'error': None}, synchronize_session='fetch')
+        self.batch.finished_dt = None
+        db.session.commit()
+        run_refund_batch.delay(self.batch.id)
+        return jsonify(success=True)
+
+
+class RHSJTUMetrics(RH):
+    """Expose the metrics of this process in the Prometheus text format"""
+
+    CSRF_ENABLED = False
+
+    def _check_access(self):
+        token = get_plugin_settings()['metrics_token']
+        if not token:
+            raise NotFound
+        auth = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(auth.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+            raise Unauthorized
+
+    def _process(self):
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 # class RHSJTUCancel(RHSJTUIPN):
 #     """Cancellation message"""
 #
@@ -0,0 +1,105 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Queue of the registration emails.
+
+The requests render the notifications, so they show the registration as
+it was when they were sent, and store them; a task adds the ticket and
+iCal attachments and hands them to the mail queue.  It sends at most
+:data:`EMAILS_PER_SECOND` emails, so a bulk operation on a large event
+neither waits for the emails nor floods the mail queue.
+"""
+
+from flask import current_app, g
+
+from indico.core.cache import make_scoped_cache
+from indico.core.db import db
+
+from indico_payment_sjtu.models.emails import SJTUQueuedEmail
+from indico_payment_sjtu.util import call_after_commit
+
+# number of emails sent in one transaction
+EMAIL_BATCH_SIZE = 50
+# an email failing this many times is not retried anymore
+EMAIL_MAX_ATTEMPTS = 3
+# emails queued within this many seconds are sent by a single task
+EMAIL_SEND_DELAY = 2
+# the rate and the number of emails handed to the mail queue by one task,
+# the rest is left to the next one
+EMAILS_PER_SECOND = 10
+MAX_EMAILS_PER_RUN = 1000
+# a task which did not report for this long is replaced by another one
+EMAIL_LOCK_TIMEOUT = 300
+# the recipients of an email returned by `make_email`
+_EMAIL_SETS = ('to', 'cc', 'bcc', 'reply_to')
+
+email_cache = make_scoped_cache('payment-sjtu-emails')
+
+
+def dump_email(email):
+    """Convert an email returned by `make_email` to JSON."""
+    return {key: sorted(value) if isinstance(value, set) else value for key, value in email.items()}
+
+
+def load_email(data):
+    """Convert an email stored by :func:`dump_email` back for `send_email`."""
+    return {key: set(value) if key in _EMAIL_SETS else value for key, value in data.items()}
+
+
+def get_notification_template_module(template_name, **context):
+    """Get the module of a notification template, like `get_template_module`.
+
+    The template is only looked up once per request, which sends the
+    same notification to many registrations in bulk operations.
+    """
+    templates = g.setdefault('sjtu_notification_templates', {})
+    try:
+        template = templates[template_name]
+    except KeyError:
+        template = templates[template_name] = current_app.jinja_env.get_template(template_name)
+    current_app.update_template_context(context)
+    return template.make_module(context)
+
+
+def get_notification_recipients(registration, to_managers):
+    """Get the recipients and the sender address of a registration notification."""
+    regform = registration.registration_form
+    if to_managers:
+        return regform.manager_notification_recipients, None
+    return registration.email, regform.notification_sender_address
+
+
+def _schedule_sending():
+    from indico_payment_sjtu.tasks import send_queued_emails
+    if email_cache.add('send-scheduled', True, timeout=EMAIL_SEND_DELAY):
+        send_queued_emails.apply_async(countdown=EMAIL_SEND_DELAY)
+
+
+def queue_registration_email(registration, email, *, user=None, attach_ticket=False, attach_ical=False):
+    """Store an email without its attachments and schedule its sending.
+
+    The sending is scheduled once the request has been committed.
+    """
+    queued = SJTUQueuedEmail(registration=registration, user=user, email=dump_email(email),
+                             attach_ticket=attach_ticket, attach_ical=attach_ical)
+    db.session.add(queued)
+    db.session.flush()
+    call_after_commit(_schedule_sending)
+    return queued
+
+
+def lock_email_queue():
+    """Claim the sending of the queued emails; returns whether it succeeded."""
+    return email_cache.add('sending', True, timeout=EMAIL_LOCK_TIMEOUT)
+
+
+def refresh_email_queue_lock():
+    email_cache.set('sending', True, timeout=EMAIL_LOCK_TIMEOUT)
+
+
+def unlock_email_queue():
+    email_cache.delete('sending')
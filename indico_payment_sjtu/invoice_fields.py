@@ -0,0 +1,186 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""The invoice data fields added to every registration form."""
+
+from functools import partial
+
+from sqlalchemy import event as sa_event
+from indico.core.cache import make_scoped_cache
+from indico.core.db import db
+from indico.modules.events.registration.models.form_fields import RegistrationFormFieldData, RegistrationFormField
+from indico.modules.events.registration.models.forms import RegistrationForm
+from indico.modules.events.registration.models.items import RegistrationFormItem, RegistrationFormItemType, \
+    RegistrationFormSection
+from indico.util.decorators import strict_classproperty
+from indico.util.enum import IndicoEnum
+
+from indico_payment_sjtu.util import call_after_commit
+
+INVOICE_SECTION_TITLE = '普通增值税发票付款单位信息'
+
+
+class InvoiceDataType(int, IndicoEnum):
+    """
+    Description of the invoice data items that exist on every registration form.
+    """
+
+    __titles__ = [
+        None,
+        # '普通增值税发票需求',
+        '付款单位全称',
+        '统一社会信用代码（税号）',
+        '手机号',
+    ]
+    __description__ = [
+        None,
+        # 'The receipt is only valid for Chinese Mainland. For receipt / invoice outside of China, '
+        # 'you will be automatically obtained in the email received after registration is completed.',
+        'Full name of your affiliation in Chinese. '
+        'Please make sure to fill it out correctly to avoid any impact on reimbursement. '
+        'If you do not need an invoice, please leave it blank. '
+        '请务必填写正确，以免影响报销。如无需发票，请留空。',
+        'Unified Social Credit Identifier (Tax Identification Number)',
+        '11-digit mobile phone number (for receiving receipt information). '
+        'Invoice will be sent to your email box, too. '
+        '11位手机号（用于接收发票信息）。发票也将发到电子邮箱。',
+    ]
+    # receipt = 1
+    receipt_title = 1
+    receipt_number = 2
+    receipt_phone = 3
+
+    def get_title(self):
+        return self.__titles__[self]
+
+    def get_description(self):
+        return self.__description__[self]
+
+    @strict_classproperty
+    @classmethod
+    def FIELD_DATA(cls):
+        # title_item = {'price': 0,
+        #               'places_limit': 0,
+        #               'is_enabled': True}
+        return [
+            # (cls.receipt, {
+            #     'title': cls.receipt.get_title(),
+            #     'description': cls.receipt.get_description(),
+            #     'input_type': 'single_choice',
+            #     'position': 1,
+            #     'data': {
+            #         'item_type': 'dropdown',
+            #         'with_extra_slots': False,
+            #         'choices': [
+            #             dict(**title_item, id='Yes', caption='Yes 是'),
+            #             dict(**title_item, id='No', caption='No 否'),
+            #         ]
+            #     }
+            # }),
+
+            (cls.receipt_title, {
+                'title': cls.receipt_title.get_title(),
+                'description': cls.receipt_title.get_description(),
+                'input_type': 'text',
+                'position': 1
+            }),
+            (cls.receipt_number, {
+                'title': cls.receipt_number.get_title(),
+                'description': cls.receipt_number.get_description(),
+                'input_type': 'text',
+                'position': 2
+            }),
+            (cls.receipt_phone, {
+                'title': cls.receipt_phone.get_title(),
+                'description': cls.receipt_phone.get_description(),
+                'input_type': 'text',
+                'position': 3
+            }),
+        ]
+
+    @property
+    def is_required(self):
+        return self in {}
+
+    @property
+    def column(self):
+        """
+        The Registration column in which the value is stored in
+        addition to the regular registration data entry.
+        """
+        if self in {
+            # InvoiceDataType.receipt,
+            InvoiceDataType.receipt_title,
+            InvoiceDataType.receipt_number,
+            InvoiceDataType.receipt_phone,
+        }:
+            return self.name
+        else:
+            return None
+
+
+def create_invoice_data_fields(regform: RegistrationForm):
+    """Create the special section/fields for invoice data."""
+    description = 'Invoice Payer Data. Only valid for Chinese Mainland affiliations.'
+    section = next(
+        (s for s in regform.sections if s.type == RegistrationFormItemType.section and s.title == INVOICE_SECTION_TITLE),
+        None)
+    if section is None:
+        section = RegistrationFormSection(registration_form=regform, title=INVOICE_SECTION_TITLE,
+                                          description=description)
+        missing = set(InvoiceDataType)
+    else:
+        existing = {x.type for x in section.children if x.type == RegistrationFormItemType.field}
+        missing = set(InvoiceDataType) - existing
+    for pd_type, data in InvoiceDataType.FIELD_DATA:
+        if pd_type not in missing:
+            continue
+        field = RegistrationFormField(registration_form=regform, parent_id=section.id,
+                                      type=RegistrationFormItemType.field, is_required=pd_type.is_required)
+        for key, value in data.items():
+            setattr(field, key, value)
+        field.data, versioned_data = field.field_impl.process_field_data(data.pop('data', {}))
+        field.current_data = RegistrationFormFieldData(versioned_data=versioned_data)
+        section.children.append(field)
+
+
+# the index is dropped once a change of an item of the form is committed, this
+# only bounds how long a stale index cached by a concurrent request may be used
+INVOICE_FIELD_IDS_TTL = 3600
+
+invoice_field_cache = make_scoped_cache('payment-sjtu-invoice-fields')
+
+
+def get_invoice_field_ids(regform):
+    """Get the ids of the invoice data fields of a registration form.
+
+    :return: A dict mapping :class:`InvoiceDataType` to field ids
+    """
+    field_ids = invoice_field_cache.get(str(regform.id))
+    if field_ids is None:
+        types = {pd_type.get_title(): pd_type for pd_type in InvoiceDataType}
+        # fields with the same titles may exist in other sections of the form
+        section = db.aliased(RegistrationFormSection)
+        query = (db.session.query(RegistrationFormField.title, RegistrationFormField.id)
+                 .join(section, RegistrationFormField.parent_id == section.id)
+                 .filter(RegistrationFormField.registration_form_id == regform.id,
+                         RegistrationFormField.title.in_(types),
+                         ~RegistrationFormField.is_deleted,
+                         section.title == INVOICE_SECTION_TITLE,
+                         ~section.is_deleted))
+        field_ids = {types[title].name: field_id for title, field_id in query}
+        invoice_field_cache.set(str(regform.id), field_ids, timeout=INVOICE_FIELD_IDS_TTL)
+    return {InvoiceDataType[name]: field_id for name, field_id in field_ids.items()}
+
+
+def _forget_invoice_field_ids(mapper, connection, target):
+    # a request reading the index before the commit would cache the old one again
+    call_after_commit(partial(invoice_field_cache.delete, str(target.registration_form_id)))
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    sa_event.listen(RegistrationFormItem, _event_name, _forget_invoice_field_ids, propagate=True)
@@ -0,0 +1,73 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Cache of the invoice PDFs.
+
+The PDF only shows the programme of the event, so it is stored once per
+event under the version of the event and the version of its programme
+and tracks (see :func:`~indico_payment_sjtu.cache.get_event_version` and
+:func:`~indico_payment_sjtu.cache.get_programme_version`).  Indico does not
+send a signal when the programme or a track changes, so the programme
+version is bumped from the changes of their rows.  The ETag of the
+download also covers the registration and its payment transaction.
+"""
+
+import hashlib
+from functools import partial
+
+from sqlalchemy import event as sa_event
+
+from indico.core.cache import make_scoped_cache
+from indico.legacy.pdfinterface.conference import ProgrammeToPDF
+from indico.modules.events.models.settings import EventSetting
+from indico.modules.events.tracks.models.groups import TrackGroup
+from indico.modules.events.tracks.models.tracks import Track
+
+from indico_payment_sjtu.cache import bump_programme_version, get_event_version, get_or_compute, get_programme_version
+from indico_payment_sjtu.util import call_after_commit
+
+INVOICE_PDF_TTL = 7 * 86400
+INVOICE_PDF_LOCK_TIMEOUT = 60
+
+invoice_cache = make_scoped_cache('payment-sjtu-invoice')
+
+
+def _get_invoice_pdf_key(event):
+    return f'pdf-{event.id}-{get_event_version(event)}-{get_programme_version(event)}'
+
+
+def get_invoice_pdf_etag(registration):
+    transaction = registration.transaction
+    version = (f'{_get_invoice_pdf_key(registration.registration_form.event)}-{registration.id}-'
+               f'{transaction.id if transaction else 0}')
+    return hashlib.sha1(version.encode()).hexdigest()
+
+
+def render_invoice_pdf(event):
+    return ProgrammeToPDF(event).getPDFBin()
+
+
+def get_invoice_pdf(registration):
+    """Get the invoice PDF of a registration, rendering it if needed.
+
+    Concurrent requests for the PDF of the same event wait for a single
+    rendering.
+    """
+    event = registration.registration_form.event
+    return get_or_compute(invoice_cache, _get_invoice_pdf_key(event), lambda: render_invoice_pdf(event),
+                          timeout=INVOICE_PDF_TTL, lock_timeout=INVOICE_PDF_LOCK_TIMEOUT)
+
+
+def _programme_changed(mapper, connection, target):
+    if isinstance(target, EventSetting) and target.module != 'tracks':
+        return
+    call_after_commit(partial(bump_programme_version, target.event_id))
+
+
+for _model in (Track, TrackGroup, EventSetting):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        sa_event.listen(_model, _event_name, _programme_changed)
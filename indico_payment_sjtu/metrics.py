@@ -0,0 +1,178 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Counters and histograms of the portal calls and payment outcomes.
+
+The values are kept per process and exposed in the Prometheus text
+format by the ``payment_sjtu.metrics`` endpoint.  When a statsd address
+is configured in the plugin settings, every observation is also sent
+there, which aggregates the values of all worker processes.
+"""
+
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from flask_pluginengine import current_plugin
+
+from indico_payment_sjtu.settings import get_plugin_settings
+
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATSD_PREFIX = 'payment_sjtu'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(f'{name}="{_escape(value)}"' for name, value in labels))
+
+
+@lru_cache
+def _parse_address(address):
+    host, __, port = address.rpartition(':')
+    return host, int(port)
+
+
+class StatsdSink:
+    """Send observations to statsd over UDP, without ever failing."""
+
+    def __init__(self):
+        self._socket = None
+
+    def _get_address(self):
+        if not current_plugin:
+            return None
+        address = get_plugin_settings().get('statsd_address')
+        return _parse_address(address) if address else None
+
+    def send(self, name, labels, value, kind):
+        try:
+            address = self._get_address()
+            if address is None:
+                return
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            metric = '.'.join([STATSD_PREFIX, name, *(str(value) for __, value in labels)])
+            self._socket.sendto(f'{metric}:{value:g}|{kind}'.encode(), address)
+        except (OSError, ValueError):
+            pass
+
+
+statsd = StatsdSink()
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects the labels {self.labelnames}, got {tuple(labels)}')
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        statsd.send(self.name, key, amount, 'c')
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        yield f'{self.name}{_format_labels(key)} {value:g}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self._values[key] = (counts, total + value)
+        statsd.send(self.name, key, value * 1000, 'ms')
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of a block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_count(self, **labels):
+        value = self._values.get(self._key(labels))
+        return value[0][-1] if value else 0
+
+    def _render_value(self, key, value):
+        counts, total = value
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            le = bound if isinstance(bound, str) else f'{bound:g}'
+            yield f'{self.name}_bucket{_format_labels((*key, ("le", le)))} {count}'
+        yield f'{self.name}_sum{_format_labels(key)} {total:g}'
+        yield f'{self.name}_count{_format_labels(key)} {counts[-1]}'
+
+
+portal_request_seconds = Histogram('sjtu_portal_request_seconds',
+                                   'Latency of the requests to the SJTU Pay portal.', ('action', 'outcome'))
+sign_mismatches = Counter('sjtu_sign_mismatches_total',
+                          'Payment results and queries with an invalid sign.', ('handler',))
+amount_mismatches = Counter('sjtu_amount_mismatches_total',
+                            "Payments whose amount doesn't match the registration fee.")
+duplicate_payments = Counter('sjtu_duplicate_payments_total',
+                             'Payment results received for an already registered transaction.', ('handler',))
+payment_lock_conflicts = Counter('sjtu_payment_lock_conflicts_total',
+                                 'Payment results received while another one of the registration was being '
+                                 'registered.', ('handler',))
+refunds = Counter('sjtu_refunds_total', 'Refunds requested from the SJTU Pay portal.', ('outcome',))
+handler_seconds = Histogram('sjtu_handler_seconds', 'Wall time of the request handlers.', ('handler',))
+
+REGISTRY = (portal_request_seconds, sign_mismatches, amount_mismatches, duplicate_payments, payment_lock_conflicts,
+            refunds, handler_seconds)
+
+
+def render_metrics():
+    """Render all metrics of this process in the Prometheus text format."""
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
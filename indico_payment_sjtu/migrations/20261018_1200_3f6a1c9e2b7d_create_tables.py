@@ -0,0 +1,42 @@
+"""Create tables
+
+Revision ID: 3f6a1c9e2b7d
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.sql.ddl import CreateSchema, DropSchema
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a1c9e2b7d'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(CreateSchema('plugin_payment_sjtu'))
+    op.create_table(
+        'transactions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('billno', sa.String(), nullable=False),
+        sa.Column('trade_no', sa.String(), nullable=True),
+        sa.Column('registration_id', sa.Integer(), nullable=False),
+        sa.Column('transaction_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['registration_id'], ['event_registration.registrations.id']),
+        sa.ForeignKeyConstraint(['transaction_id'], ['events.payment_transactions.id']),
+        sa.PrimaryKeyConstraint('id'),
+        schema='plugin_payment_sjtu'
+    )
+    op.create_index(None, 'transactions', ['billno'], schema='plugin_payment_sjtu')
+    op.create_index(None, 'transactions', ['trade_no'], unique=True, schema='plugin_payment_sjtu')
+    op.create_index(None, 'transactions', ['registration_id'], schema='plugin_payment_sjtu')
+    op.create_index(None, 'transactions', ['transaction_id'], schema='plugin_payment_sjtu')
+
+
+def downgrade():
+    op.drop_table('transactions', schema='plugin_payment_sjtu')
+    op.execute(DropSchema('plugin_payment_sjtu'))
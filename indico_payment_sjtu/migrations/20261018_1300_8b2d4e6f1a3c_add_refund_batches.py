@@ -0,0 +1,67 @@
+"""Add refund batches
+
+Revision ID: 8b2d4e6f1a3c
+Revises: 3f6a1c9e2b7d
+Create Date: 2026-10-18 13:00:00.000000
+"""
+
+from enum import Enum
+
+import sqlalchemy as sa
+from alembic import op
+
+from indico.core.db.sqlalchemy import PyIntEnum, UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2d4e6f1a3c'
+down_revision = '3f6a1c9e2b7d'
+branch_labels = None
+depends_on = None
+
+
+class _RefundState(int, Enum):
+    pending = 1
+    submitted = 2
+    succeeded = 3
+    failed = 4
+
+
+def upgrade():
+    op.create_table(
+        'refund_batches',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('regform_id', sa.Integer(), nullable=False),
+        sa.Column('created_by_id', sa.Integer(), nullable=False),
+        sa.Column('created_dt', UTCDateTime, nullable=False),
+        sa.Column('finished_dt', UTCDateTime, nullable=True),
+        sa.ForeignKeyConstraint(['regform_id'], ['event_registration.forms.id']),
+        sa.ForeignKeyConstraint(['created_by_id'], ['users.users.id']),
+        sa.PrimaryKeyConstraint('id'),
+        schema='plugin_payment_sjtu'
+    )
+    op.create_index(None, 'refund_batches', ['regform_id'], schema='plugin_payment_sjtu')
+    op.create_index(None, 'refund_batches', ['created_by_id'], schema='plugin_payment_sjtu')
+    op.create_table(
+        'refunds',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('batch_id', sa.Integer(), nullable=False),
+        sa.Column('registration_id', sa.Integer(), nullable=False),
+        sa.Column('billno', sa.String(), nullable=False),
+        sa.Column('billamt', sa.String(), nullable=False),
+        sa.Column('state', PyIntEnum(_RefundState), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('modified_dt', UTCDateTime, nullable=False),
+        sa.ForeignKeyConstraint(['batch_id'], ['plugin_payment_sjtu.refund_batches.id']),
+        sa.ForeignKeyConstraint(['registration_id'], ['event_registration.registrations.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('batch_id', 'registration_id'),
+        schema='plugin_payment_sjtu'
+    )
+    op.create_index(None, 'refunds', ['batch_id'], schema='plugin_payment_sjtu')
+    op.create_index(None, 'refunds', ['registration_id'], schema='plugin_payment_sjtu')
+
+
+def downgrade():
+    op.drop_table('refunds', schema='plugin_payment_sjtu')
+    op.drop_table('refund_batches', schema='plugin_payment_sjtu')
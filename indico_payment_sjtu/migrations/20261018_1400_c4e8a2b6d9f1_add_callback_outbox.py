@@ -0,0 +1,52 @@
+"""Add callback outbox
+
+Revision ID: c4e8a2b6d9f1
+Revises: 8b2d4e6f1a3c
+Create Date: 2026-10-18 14:00:00.000000
+"""
+
+from enum import Enum
+
+import sqlalchemy as sa
+from alembic import op
+
+from indico.core.db.sqlalchemy import PyIntEnum, UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2b6d9f1'
+down_revision = '8b2d4e6f1a3c'
+branch_labels = None
+depends_on = None
+
+
+class _CallbackState(int, Enum):
+    pending = 1
+    processed = 2
+    duplicate = 3
+    failed = 4
+
+
+def upgrade():
+    op.create_table(
+        'callbacks',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('registration_id', sa.Integer(), nullable=False),
+        sa.Column('trade_no', sa.String(), nullable=True),
+        sa.Column('raw_data', sa.Text(), nullable=False),
+        sa.Column('received_dt', UTCDateTime, nullable=False),
+        sa.Column('state', PyIntEnum(_CallbackState), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('processed_dt', UTCDateTime, nullable=True),
+        sa.ForeignKeyConstraint(['registration_id'], ['event_registration.registrations.id']),
+        sa.PrimaryKeyConstraint('id'),
+        schema='plugin_payment_sjtu'
+    )
+    op.create_index(None, 'callbacks', ['registration_id'], schema='plugin_payment_sjtu')
+    op.create_index(None, 'callbacks', ['trade_no'], schema='plugin_payment_sjtu')
+    op.create_index(None, 'callbacks', ['id'], schema='plugin_payment_sjtu', postgresql_where=sa.text('state = 1'))
+
+
+def downgrade():
+    op.drop_table('callbacks', schema='plugin_payment_sjtu')
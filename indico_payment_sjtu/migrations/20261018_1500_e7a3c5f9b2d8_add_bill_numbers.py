@@ -0,0 +1,38 @@
+"""Add bill numbers
+
+Revision ID: e7a3c5f9b2d8
+Revises: c4e8a2b6d9f1
+Create Date: 2026-10-18 15:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a3c5f9b2d8'
+down_revision = 'c4e8a2b6d9f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'bills',
+        sa.Column('registration_id', sa.Integer(), nullable=False),
+        sa.Column('billno', sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(['registration_id'], ['event_registration.registrations.id']),
+        sa.PrimaryKeyConstraint('registration_id'),
+        schema='plugin_payment_sjtu'
+    )
+    op.create_index(None, 'bills', ['billno'], unique=True, schema='plugin_payment_sjtu')
+    # the url-safe base64 encoding of the uuid bytes, see `uuid_to_billno`
+    op.execute('''
+        INSERT INTO plugin_payment_sjtu.bills (registration_id, billno)
+        SELECT id, translate(encode(decode(replace(uuid::text, '-', ''), 'hex'), 'base64'), '+/', '-_')
+        FROM event_registration.registrations
+    ''')
+
+
+def downgrade():
+    op.drop_table('bills', schema='plugin_payment_sjtu')
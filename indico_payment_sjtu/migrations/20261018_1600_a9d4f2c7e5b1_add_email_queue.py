@@ -0,0 +1,55 @@
+"""Add email queue
+
+Revision ID: a9d4f2c7e5b1
+Revises: e7a3c5f9b2d8
+Create Date: 2026-10-18 16:00:00.000000
+"""
+
+from enum import Enum
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+from indico.core.db.sqlalchemy import PyIntEnum, UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d4f2c7e5b1'
+down_revision = 'e7a3c5f9b2d8'
+branch_labels = None
+depends_on = None
+
+
+class _EmailState(int, Enum):
+    pending = 1
+    sent = 2
+    failed = 3
+
+
+def upgrade():
+    op.create_table(
+        'emails',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('registration_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('email', postgresql.JSON(), nullable=False),
+        sa.Column('attach_ticket', sa.Boolean(), nullable=False),
+        sa.Column('attach_ical', sa.Boolean(), nullable=False),
+        sa.Column('created_dt', UTCDateTime, nullable=False),
+        sa.Column('state', PyIntEnum(_EmailState), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('sent_dt', UTCDateTime, nullable=True),
+        sa.ForeignKeyConstraint(['registration_id'], ['event_registration.registrations.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.users.id']),
+        sa.PrimaryKeyConstraint('id'),
+        schema='plugin_payment_sjtu'
+    )
+    op.create_index(None, 'emails', ['registration_id'], schema='plugin_payment_sjtu')
+    op.create_index(None, 'emails', ['user_id'], schema='plugin_payment_sjtu')
+    op.create_index(None, 'emails', ['id'], schema='plugin_payment_sjtu', postgresql_where=sa.text('state = 1'))
+
+
+def downgrade():
+    op.drop_table('emails', schema='plugin_payment_sjtu')
@@ -0,0 +1,27 @@
+"""Index only known trade numbers
+
+Revision ID: 668dadfc13fa
+Revises: a9d4f2c7e5b1
+Create Date: 2026-10-18 17:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '668dadfc13fa'
+down_revision = 'a9d4f2c7e5b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index('ix_uq_transactions_trade_no', table_name='transactions', schema='plugin_payment_sjtu')
+    op.create_index(None, 'transactions', ['trade_no'], unique=True, schema='plugin_payment_sjtu',
+                    postgresql_where=sa.text('trade_no IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_uq_transactions_trade_no', table_name='transactions', schema='plugin_payment_sjtu')
+    op.create_index(None, 'transactions', ['trade_no'], unique=True, schema='plugin_payment_sjtu')
@@ -0,0 +1,41 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from indico.core.db import db
+from indico.util.string import format_repr
+
+
+class SJTUBill(db.Model):
+    """The SJTU Pay bill number of a registration.
+
+    Bill numbers are derived from the registration uuid, storing them
+    lets the payment handlers look up a registration by its bill number
+    without decoding it.
+    """
+
+    __tablename__ = 'bills'
+    __table_args__ = {'schema': 'plugin_payment_sjtu'}
+
+    registration_id = db.Column(
+        db.Integer,
+        db.ForeignKey('event_registration.registrations.id'),
+        primary_key=True
+    )
+    billno = db.Column(
+        db.String,
+        nullable=False,
+        unique=True,
+        index=True
+    )
+
+    registration = db.relationship(
+        'Registration',
+        lazy=True
+    )
+
+    def __repr__(self):
+        return format_repr(self, 'registration_id', 'billno')
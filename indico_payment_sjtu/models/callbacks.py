@@ -0,0 +1,88 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from indico.core.db import db
+from indico.core.db.sqlalchemy import PyIntEnum, UTCDateTime
+from indico.util.date_time import now_utc
+from indico.util.enum import RichIntEnum
+from indico.util.string import format_repr
+
+from indico_payment_sjtu import _
+
+
+class CallbackState(RichIntEnum):
+    __titles__ = [None, _('Pending'), _('Processed'), _('Duplicate'), _('Failed')]
+    pending = 1
+    processed = 2
+    #: the trade had already been registered
+    duplicate = 3
+    #: dead letter, only processed again when it is replayed
+    failed = 4
+
+
+class SJTUCallback(db.Model):
+    """A payment result received on the callback URL.
+
+    In fast-ack mode the callback handler only verifies the sign and stores
+    the payload here; the payments are registered by a worker draining the
+    pending callbacks.
+    """
+
+    __tablename__ = 'callbacks'
+    __table_args__ = (db.Index(None, 'id', postgresql_where=db.text('state = 1')),
+                      {'schema': 'plugin_payment_sjtu'})
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    registration_id = db.Column(
+        db.Integer,
+        db.ForeignKey('event_registration.registrations.id'),
+        nullable=False,
+        index=True
+    )
+    trade_no = db.Column(
+        db.String,
+        nullable=True,
+        index=True
+    )
+    raw_data = db.Column(
+        db.Text,
+        nullable=False
+    )
+    received_dt = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=now_utc
+    )
+    state = db.Column(
+        PyIntEnum(CallbackState),
+        nullable=False,
+        default=CallbackState.pending
+    )
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+    error = db.Column(
+        db.String,
+        nullable=True
+    )
+    processed_dt = db.Column(
+        UTCDateTime,
+        nullable=True
+    )
+
+    registration = db.relationship(
+        'Registration',
+        lazy=True
+    )
+
+    def __repr__(self):
+        return format_repr(self, 'id', 'registration_id', 'trade_no', state=None)
@@ -0,0 +1,101 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from indico.core.db import db
+from indico.core.db.sqlalchemy import PyIntEnum, UTCDateTime
+from indico.util.date_time import now_utc
+from indico.util.enum import RichIntEnum
+from indico.util.string import format_repr
+
+from indico_payment_sjtu import _
+
+
+class EmailState(RichIntEnum):
+    __titles__ = [None, _('Pending'), _('Sent'), _('Failed')]
+    pending = 1
+    sent = 2
+    failed = 3
+
+
+class SJTUQueuedEmail(db.Model):
+    """A registration email waiting to be sent.
+
+    The email is rendered by the request sending it, a worker generates
+    the ticket and iCal attachments and sends it.
+    """
+
+    __tablename__ = 'emails'
+    __table_args__ = (db.Index(None, 'id', postgresql_where=db.text('state = 1')),
+                      {'schema': 'plugin_payment_sjtu'})
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    registration_id = db.Column(
+        db.Integer,
+        db.ForeignKey('event_registration.registrations.id'),
+        nullable=False,
+        index=True
+    )
+    #: the user who triggered the email, for the event log
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.users.id'),
+        nullable=True,
+        index=True
+    )
+    #: the email as returned by `make_email`, without attachments
+    email = db.Column(
+        db.JSON,
+        nullable=False
+    )
+    attach_ticket = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False
+    )
+    attach_ical = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False
+    )
+    created_dt = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=now_utc
+    )
+    state = db.Column(
+        PyIntEnum(EmailState),
+        nullable=False,
+        default=EmailState.pending
+    )
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+    error = db.Column(
+        db.String,
+        nullable=True
+    )
+    sent_dt = db.Column(
+        UTCDateTime,
+        nullable=True
+    )
+
+    registration = db.relationship(
+        'Registration',
+        lazy=True
+    )
+    user = db.relationship(
+        'User',
+        lazy=True
+    )
+
+    def __repr__(self):
+        return format_repr(self, 'id', 'registration_id', state=None)
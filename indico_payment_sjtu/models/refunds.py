@@ -0,0 +1,151 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from indico.core.db import db
+from indico.core.db.sqlalchemy import PyIntEnum, UTCDateTime
+from indico.util.date_time import now_utc
+from indico.util.enum import RichIntEnum
+from indico.util.locators import locator_property
+from indico.util.string import format_repr
+
+from indico_payment_sjtu import _
+
+
+class RefundState(RichIntEnum):
+    __titles__ = [None, _('Pending'), _('Submitted'), _('Refunded'), _('Failed')]
+    pending = 1
+    #: sent to SJTU Pay, the outcome is not known yet
+    submitted = 2
+    succeeded = 3
+    failed = 4
+
+
+class SJTURefundBatch(db.Model):
+    """A bulk refund started by an event manager."""
+
+    __tablename__ = 'refund_batches'
+    __table_args__ = {'schema': 'plugin_payment_sjtu'}
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    regform_id = db.Column(
+        db.Integer,
+        db.ForeignKey('event_registration.forms.id'),
+        nullable=False,
+        index=True
+    )
+    created_by_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.users.id'),
+        nullable=False,
+        index=True
+    )
+    created_dt = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=now_utc
+    )
+    finished_dt = db.Column(
+        UTCDateTime,
+        nullable=True
+    )
+
+    regform = db.relationship(
+        'RegistrationForm',
+        lazy=True
+    )
+    created_by = db.relationship(
+        'User',
+        lazy=True
+    )
+    refunds = db.relationship(
+        'SJTURefund',
+        lazy=True,
+        back_populates='batch',
+        order_by='SJTURefund.id'
+    )
+
+    def __repr__(self):
+        return format_repr(self, 'id', 'regform_id', finished_dt=None)
+
+    @locator_property
+    def locator(self):
+        return dict(self.regform.locator, batch_id=self.id)
+
+    @property
+    def is_finished(self):
+        return self.finished_dt is not None
+
+    def get_state_counts(self):
+        counts = dict.fromkeys(RefundState, 0)
+        counts.update(db.session.query(SJTURefund.state, db.func.count())
+                      .filter(SJTURefund.batch_id == self.id)
+                      .group_by(SJTURefund.state))
+        return counts
+
+
+class SJTURefund(db.Model):
+    """The refund of a single registration in a :class:`SJTURefundBatch`."""
+
+    __tablename__ = 'refunds'
+    __table_args__ = (db.UniqueConstraint('batch_id', 'registration_id'),
+                      {'schema': 'plugin_payment_sjtu'})
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    batch_id = db.Column(
+        db.Integer,
+        db.ForeignKey('plugin_payment_sjtu.refund_batches.id'),
+        nullable=False,
+        index=True
+    )
+    registration_id = db.Column(
+        db.Integer,
+        db.ForeignKey('event_registration.registrations.id'),
+        nullable=False,
+        index=True
+    )
+    billno = db.Column(
+        db.String,
+        nullable=False
+    )
+    billamt = db.Column(
+        db.String,
+        nullable=False
+    )
+    state = db.Column(
+        PyIntEnum(RefundState),
+        nullable=False,
+        default=RefundState.pending
+    )
+    error = db.Column(
+        db.String,
+        nullable=True
+    )
+    modified_dt = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=now_utc,
+        onupdate=now_utc
+    )
+
+    batch = db.relationship(
+        'SJTURefundBatch',
+        lazy=True,
+        back_populates='refunds'
+    )
+    registration = db.relationship(
+        'Registration',
+        lazy=True
+    )
+
+    def __repr__(self):
+        return format_repr(self, 'id', 'batch_id', 'registration_id', state=None)
@@ -0,0 +1,94 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from sqlalchemy import select
+
+from indico.core.db import db
+from indico.util.string import format_repr
+
+# the first key of the advisory locks taken by the plugin ("SJTU")
+ADVISORY_LOCK_NAMESPACE = 0x534A5455
+
+
+class SJTUTransaction(db.Model):
+    """Index of the payments received through SJTU Pay.
+
+    Maps the SJTU Pay bill and trade numbers to the registration and the
+    payment transaction, so they can be looked up without scanning the
+    JSON data of all transactions.
+    """
+
+    __tablename__ = 'transactions'
+    __table_args__ = (db.Index(None, 'trade_no', unique=True, postgresql_where=db.text('trade_no IS NOT NULL')),
+                      {'schema': 'plugin_payment_sjtu'})
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    billno = db.Column(
+        db.String,
+        nullable=False,
+        index=True
+    )
+    #: missing from the payment results of some bills
+    trade_no = db.Column(
+        db.String,
+        nullable=True
+    )
+    registration_id = db.Column(
+        db.Integer,
+        db.ForeignKey('event_registration.registrations.id'),
+        nullable=False,
+        index=True
+    )
+    transaction_id = db.Column(
+        db.Integer,
+        db.ForeignKey('events.payment_transactions.id'),
+        nullable=False,
+        index=True
+    )
+
+    registration = db.relationship(
+        'Registration',
+        lazy=True
+    )
+    transaction = db.relationship(
+        'PaymentTransaction',
+        lazy=True
+    )
+
+    def __repr__(self):
+        return format_repr(self, 'id', 'billno', 'trade_no', 'registration_id', 'transaction_id')
+
+    @classmethod
+    def is_trade_registered(cls, trade_no):
+        # a missing trade number identifies no trade (and would match every row without one)
+        if not trade_no:
+            return False
+        return cls.query.filter_by(trade_no=trade_no).has_rows()
+
+    @classmethod
+    def find_by_trade_no(cls, trade_no):
+        if not trade_no:
+            return None
+        return cls.query.filter_by(trade_no=trade_no).first()
+
+    @classmethod
+    def try_lock_registration(cls, registration_id, connection=None):
+        """Try to become the only transaction registering a payment of a registration.
+
+        The same payment can be reported at the same moment by the return
+        URL, the callback and the reconciliation.  This takes a PostgreSQL
+        advisory lock, which is released at the end of the transaction,
+        without waiting for another transaction holding it.
+
+        :param connection: The connection to lock on instead of the session
+        :return: Whether the lock was acquired
+        """
+        query = select(db.func.pg_try_advisory_xact_lock(ADVISORY_LOCK_NAMESPACE, registration_id))
+        return (connection or db.session).execute(query).scalar()
@@ -2,23 +2,27 @@
 In this file, a few classes and functions in indico are monkey patched
 to support some customized features.
 The patched indico version is 3.2.3.
+
+Importing this module does not patch anything, the `patch_*` functions
+are applied through :mod:`indico_payment_sjtu.patches`.
 """
 from datetime import timedelta
 from uuid import uuid4
 
-from flask import redirect, session, flash
+from flask import redirect, request, session, flash
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, selectinload
 from indico.core import signals
-from indico.core.config import config
 from indico.core.db import db
-from indico.core.notifications import make_email, send_email
+from indico.core.notifications import make_email
+from indico.core.plugins.controllers import RHPluginDetails
 from indico.modules.core.captcha import get_captcha_settings
-from indico.modules.core.settings import core_settings
 from indico.modules.designer import TemplateType
 from indico.modules.designer.util import get_inherited_templates
 from indico.modules.events.features.util import set_feature_enabled
-from indico.modules.events.ical import MIMECalendar, event_to_ical
 from indico.modules.events.models.events import EventType, Event
 from indico.modules.events.payment import payment_event_settings, payment_settings
+from indico.modules.events.payment.controllers import RHPaymentPluginEdit
 from indico.modules.events.payment.models.transactions import TransactionStatus
 from indico.modules.events.registration.controllers.management.regforms import RHManageParticipants, \
     _get_regform_creation_log_data, RHRegistrationFormCreate, RHRegistrationFormModify
@@ -28,11 +32,10 @@ from indico.modules.events.registration.controllers.display import RHRegistratio
 from indico.modules.events.registration.controllers.management.reglists import \
     RHRegistrationsExportCSV, RHRegistrationsExportExcel, RHRegistrationsListManage
 from indico.modules.events.registration import logger
-from indico.modules.events.registration.models.form_fields import RegistrationFormFieldData, RegistrationFormField
+from indico.modules.events.registration.models.form_fields import RegistrationFormFieldData
 from indico.modules.events.registration.models.forms import RegistrationForm
-from indico.modules.events.registration.models.items import RegistrationFormItemType, RegistrationFormSection
 from indico.modules.events.registration.models.registrations import RegistrationState, PublishRegistrationsMode, \
-    RegistrationData
+    Registration, RegistrationData
 from indico.modules.events.registration.util import get_flat_section_submission_data, \
     get_initial_form_values, get_user_data, create_personal_data_fields, get_flat_section_setup_data
 from indico.modules.events.registration.views import \
@@ -40,35 +43,77 @@ from indico.modules.events.registration.views import \
 from indico.modules.logs import EventLogRealm, LogKind
 from indico.modules.users.models.affiliations import Affiliation
 from indico.util.date_time import format_date
-from indico.util.decorators import strict_classproperty
-from indico.util.enum import IndicoEnum
 from indico.util.signals import make_interceptable, values_from_signal
-from indico.util.spreadsheets import send_csv, send_xlsx, unique_col
+from indico.util.spreadsheets import unique_col
 from indico.util.string import camelize_keys
 from indico.web.flask.templating import get_template_module
 from indico.web.flask.util import url_for
 
 from indico_payment_sjtu import _
-from indico_payment_sjtu.util import uuid_to_billno
+from indico_payment_sjtu.billno import uuid_to_billno
+from indico_payment_sjtu.emails import (get_notification_recipients, get_notification_template_module,
+                                        queue_registration_email)
+from indico_payment_sjtu.invoice_fields import create_invoice_data_fields
+from indico_payment_sjtu.settings import settings_changed
+from indico_payment_sjtu.spreadsheets import send_csv_stream, send_xlsx_stream
 from indico_payment_sjtu.views import WPDisplayRegistrationFormConferenceSJTU, \
     WPManageRegistrationSJTU
 
 
-def registration_list_generator_getattribute(self, item):
-    result = super(RegistrationListGenerator, self).__getattribute__(item)
-    if item == "static_items" and not hasattr(self, "monkey_patched"):
-        self.monkey_patched = True
-        result["billno"] = {
-            'title': _('Bill Number'),
-        }
-        result["trade_no"] = {
-            'title': _('Trade Number')
-        }
-    return result
+_registration_list_generator_init = RegistrationListGenerator.__init__
+
+
+def registration_list_generator_init(self, regform):
+    _registration_list_generator_init(self, regform)
+    self.static_items["billno"] = {
+        'title': _('Bill Number'),
+    }
+    self.static_items["trade_no"] = {
+        'title': _('Trade Number')
+    }
+
+
+# number of registrations rendered at once in the registration list
+REGLIST_PAGE_SIZE = 100
+
+
+def registration_list_generator_get_list_page_kwargs(self, after=None):
+    """Get the arguments of the registration list template for one page.
+
+    Unlike `get_list_kwargs`, only :data:`REGLIST_PAGE_SIZE` registrations
+    are loaded. They are sorted by name and a page starts right after the
+    registration `after` (keyset pagination), so a page does not get
+    slower as the registration form gets more registrations.
+    """
+    reg_list_config = self._get_config()
+    registrations_query = self._build_query()
+    total_registrations = registrations_query.count()
+    filtered_query = self._filter_list_entries(registrations_query, reg_list_config['filters'])
+    filtered_registrations = filtered_query.count()
+    # the id makes the sort key unique, so no registration is skipped or repeated between two pages
+    sort_key = (*Registration.order_by_name, Registration.id)
+    page_query = filtered_query.order_by(None).order_by(*sort_key)
+    if after is not None:
+        after_key = db.session.query(*sort_key).filter(Registration.id == after.id).one()
+        page_query = page_query.filter(tuple_(*sort_key) > tuple_(*after_key))
+    registrations = page_query.limit(REGLIST_PAGE_SIZE + 1).all()
+    has_more = len(registrations) > REGLIST_PAGE_SIZE
+    registrations = registrations[:REGLIST_PAGE_SIZE]
+    dynamic_item_ids, static_item_ids = self._split_item_ids(reg_list_config['items'], 'dynamic')
+    return {
+        'regform': self.regform,
+        'registrations': registrations,
+        'total_registrations': total_registrations,
+        'filtered_registrations': filtered_registrations,
+        'static_columns': self._get_static_columns(static_item_ids),
+        'dynamic_columns': self._get_sorted_regform_items(dynamic_item_ids),
+        'filtering_enabled': total_registrations != filtered_registrations,
+        'next_cursor': registrations[-1].id if has_more else None,
+    }
 
 
 def registration_list_generator_render_list(self):
-    reg_list_kwargs = self.get_list_kwargs()
+    reg_list_kwargs = self.get_list_page_kwargs()
     tpl = get_template_module('payment_sjtu:management/_reglist.html')
     filtering_enabled = reg_list_kwargs.pop('filtering_enabled')
     return {
@@ -77,8 +122,13 @@ def registration_list_generator_render_list(self):
     }
 
 
-RegistrationListGenerator.__getattribute__ = registration_list_generator_getattribute
-RegistrationListGenerator.render_list = registration_list_generator_render_list
+_registration_list_generator_build_query = RegistrationListGenerator._build_query
+
+
+def registration_list_generator_build_query(self):
+    # the bill/trade number and tags columns would otherwise load them for each row
+    return _registration_list_generator_build_query(self).options(joinedload(Registration.transaction),
+                                                                  selectinload(Registration.tags))
 
 
 def rh_registrations_list_manage_process(self):
@@ -86,117 +136,177 @@ def rh_registrations_list_manage_process(self):
 
     if self.list_generator.static_link_used:
         return redirect(self.list_generator.get_list_url())
-    reg_list_kwargs = self.list_generator.get_list_kwargs()
+    reg_list_kwargs = self.list_generator.get_list_page_kwargs()
     badge_templates = [tpl for tpl in
                        set(self.event.designer_templates) | get_inherited_templates(
                            self.event)
                        if tpl.type == TemplateType.badge]
     has_tickets = any(tpl.is_ticket for tpl in badge_templates)
     has_badges = any(not tpl.is_ticket for tpl in badge_templates)
+    has_pending_registrations = (Registration.query.with_parent(self.regform)
+                                 .filter(Registration.state == RegistrationState.pending, ~Registration.is_deleted)
+                                 .has_rows())
     return WPManageRegistrationSJTU.render_template(
         'payment_sjtu:management/regform_reglist.html',
         self.event,
         has_badges=has_badges,
         has_tickets=has_tickets,
+        has_pending_registrations=has_pending_registrations,
         **reg_list_kwargs)
 
 
-RHRegistrationsListManage._process = rh_registrations_list_manage_process
+def patch_registration_list():
+    RegistrationListGenerator.__init__ = registration_list_generator_init
+    RegistrationListGenerator.get_list_page_kwargs = registration_list_generator_get_list_page_kwargs
+    RegistrationListGenerator.render_list = registration_list_generator_render_list
+    RegistrationListGenerator._build_query = registration_list_generator_build_query
+    RHRegistrationsListManage._process = rh_registrations_list_manage_process
+
+
+def _get_payment_date(registration, data):
+    transaction = registration.transaction
+    if transaction is not None and transaction.status == TransactionStatus.successful:
+        return transaction.timestamp
+    return ''
+
+
+def _get_trade_no(registration, data):
+    transaction = registration.transaction
+    if (transaction is not None and transaction.provider == 'sjtu' and
+            transaction.status == TransactionStatus.successful):
+        return transaction.data['trade_no']
+    return ''
+
+
+# number of registrations loaded at once by the exports
+EXPORT_CHUNK_SIZE = 500
+
+# static item id -> (column title, extractor); extractors take the registration
+# and its `data_by_field` dict
+special_item_mapping = {
+    'reg_date': ('Registration date', lambda x, data: x.submitted_dt),
+    'state': ('Registration state', lambda x, data: x.state.title),
+    'price': ('Price', lambda x, data: x.render_price()),
+    'checked_in': ('Checked in', lambda x, data: x.checked_in),
+    'checked_in_date': ('Check-in date', lambda x, data: x.checked_in_dt if x.checked_in else ''),
+    'payment_date': ('Payment date', _get_payment_date),
+    'tags_present': ('Tags', lambda x, data: [t.title for t in x.tags] if x.tags else ''),
+    'billno': ('Bill Number', lambda x, data: uuid_to_billno(x.uuid)),
+    'trade_no': ('Trade Number', _get_trade_no),
+}
+
+
+def _make_field_extractor(field_id):
+    def _extract(registration, data):
+        return data[field_id].friendly_data if field_id in data else ''
+    return _extract
+
+
+def _make_accommodation_extractor(field_id, key):
+    def _extract(registration, data):
+        if field_id not in data:
+            return ''
+        value = data[field_id].friendly_data.get(key)
+        if key == 'choice':
+            return value
+        return format_date(value) if value else ''
+    return _extract
+
+
+def compile_column_plan(regform_items, static_items):
+    """Compile the columns of a registration export.
+
+    :param regform_items: The registration form items to be used as columns
+    :param static_items: Registration form information as extra columns
+    :return: An ordered tuple of ``(column key, extractor)`` pairs
+    """
+    plan = [('ID', lambda x, data: x.friendly_id),
+            ('Name', lambda x, data: f'{x.first_name} {x.last_name}')]
+    for item in regform_items:
+        if item.input_type == 'accommodation':
+            plan.append((unique_col(item.title, item.id), _make_accommodation_extractor(item.id, 'choice')))
+            plan.append((unique_col('{} ({})'.format(item.title, 'Arrival'), item.id),
+                         _make_accommodation_extractor(item.id, 'arrival_date')))
+            plan.append((unique_col('{} ({})'.format(item.title, 'Departure'), item.id),
+                         _make_accommodation_extractor(item.id, 'departure_date')))
+        else:
+            plan.append((unique_col(item.title, item.id), _make_field_extractor(item.id)))
+    plan.extend((title, fn) for name, (title, fn) in special_item_mapping.items() if name in static_items)
+    return tuple(plan)
 
 
 def generate_spreadsheet_from_registrations(registrations, regform_items, static_items):
     """Generate a spreadsheet data from a given registration list.
 
+    The column plan is compiled once and the rows are generated lazily,
+    one tuple per registration in the same order as the headers.
+
     :param registrations: The list of registrations to include in the file
     :param regform_items: The registration form items to be used as columns
     :param static_items: Registration form information as extra columns
+    :return: The column headers and an iterator over the rows
     """
-    logger.info(static_items)
-    field_names = ['ID', 'Name']
-    special_item_mapping = {
-        'reg_date': ('Registration date', lambda x: x.submitted_dt),
-        'state': ('Registration state', lambda x: x.state.title),
-        'price': ('Price', lambda x: x.render_price()),
-        'checked_in': ('Checked in', lambda x: x.checked_in),
-        'checked_in_date': (
-            'Check-in date', lambda x: x.checked_in_dt if x.checked_in else ''),
-        'payment_date': ('Payment date', lambda x: (x.transaction.timestamp
-                                                    if (x.transaction is not None and
-                                                        x.transaction.status == TransactionStatus.successful)
-                                                    else '')),
-        'tags_present': ('Tags', lambda x: [t.title for t in x.tags] if x.tags else ''),
-        'billno': ('Bill Number', lambda x: uuid_to_billno(x.uuid)),
-        'trade_no': ('Trade Number', lambda x: x.transaction.data['trade_no'] if (
-                x.transaction is not None and x.transaction.provider == 'sjtu' and
-                x.transaction.status == TransactionStatus.successful) else '')
-    }
-    for item in regform_items:
-        field_names.append(unique_col(item.title, item.id))
-        if item.input_type == 'accommodation':
-            field_names.append(
-                unique_col('{} ({})'.format(item.title, 'Arrival'), item.id))
-            field_names.append(
-                unique_col('{} ({})'.format(item.title, 'Departure'), item.id))
-    field_names.extend(title for name, (title, fn) in special_item_mapping.items() if
-                       name in static_items)
-    rows = []
+    plan = compile_column_plan(regform_items, static_items)
+    field_names = [key for key, fn in plan]
+    return field_names, _generate_registration_rows(registrations, tuple(fn for key, fn in plan))
+
+
+def _generate_registration_rows(registrations, extractors):
     for registration in registrations:
         data = registration.data_by_field
-        registration_dict = {
-            'ID': registration.friendly_id,
-            'Name': f'{registration.first_name} {registration.last_name}'
-        }
-        for item in regform_items:
-            key = unique_col(item.title, item.id)
-            if item.input_type == 'accommodation':
-                registration_dict[key] = data[item.id].friendly_data.get(
-                    'choice') if item.id in data else ''
-                key = unique_col('{} ({})'.format(item.title, 'Arrival'), item.id)
-                arrival_date = data[item.id].friendly_data.get(
-                    'arrival_date') if item.id in data else None
-                registration_dict[key] = format_date(
-                    arrival_date) if arrival_date else ''
-                key = unique_col('{} ({})'.format(item.title, 'Departure'), item.id)
-                departure_date = data[item.id].friendly_data.get(
-                    'departure_date') if item.id in data else None
-                registration_dict[key] = format_date(
-                    departure_date) if departure_date else ''
-            else:
-                registration_dict[key] = data[
-                    item.id].friendly_data if item.id in data else ''
-        for name, (title, fn) in special_item_mapping.items():
-            if name not in static_items:
-                continue
-            value = fn(registration)
-            registration_dict[title] = value
-        rows.append(registration_dict)
-    return field_names, rows
+        yield tuple([fn(registration, data) for fn in extractors])
 
 
 # util.generate_spreadsheet_from_registrations = generate_spreadsheet_from_registrations
 
+def query_registrations_for_export(registration_ids):
+    """Query registrations with everything needed by the export.
+
+    The registrations are loaded while the query is iterated, in chunks
+    of :data:`EXPORT_CHUNK_SIZE` together with their data, current
+    transaction and tags, so the number of SQL queries depends neither on
+    the number of registrations nor on a commit having expired them, and
+    only one chunk is kept in memory.
+    """
+    return (Registration.query
+            .filter(Registration.id.in_(registration_ids))
+            .options(selectinload(Registration.data)
+                     .joinedload(RegistrationData.field_data)
+                     .joinedload(RegistrationFormFieldData.field),
+                     joinedload(Registration.transaction),
+                     selectinload(Registration.tags))
+            .order_by(*Registration.order_by_name)
+            .yield_per(EXPORT_CHUNK_SIZE))
+
+
+def _pop_export_registration_ids(rh):
+    # the registrations loaded by the RH are released, the export loads them again chunk by chunk
+    registration_ids = [registration.id for registration in rh.registrations]
+    rh.registrations = None
+    return registration_ids
+
+
 def rh_registrations_list_export_csv_process(self):
     headers, rows = generate_spreadsheet_from_registrations(
-        self.registrations,
+        query_registrations_for_export(_pop_export_registration_ids(self)),
         self.export_config['regform_items'],
         self.export_config['static_item_ids']
     )
-    return send_csv('registrations.csv', headers, rows)
-
-
-RHRegistrationsExportCSV._process = rh_registrations_list_export_csv_process
+    return send_csv_stream('registrations.csv', headers, rows)
 
 
 def rh_registrations_list_export_xlsx_process(self):
     headers, rows = generate_spreadsheet_from_registrations(
-        self.registrations,
+        query_registrations_for_export(_pop_export_registration_ids(self)),
         self.export_config['regform_items'],
         self.export_config['static_item_ids']
     )
-    return send_xlsx('registrations.xlsx', headers, rows, tz=self.event.tzinfo)
+    return send_xlsx_stream('registrations.xlsx', headers, rows, tz=self.event.tzinfo)
 
 
-RHRegistrationsExportExcel._process = rh_registrations_list_export_xlsx_process
+def patch_registration_export():
+    RHRegistrationsExportCSV._process = rh_registrations_list_export_csv_process
+    RHRegistrationsExportExcel._process = rh_registrations_list_export_xlsx_process
 
 
 def rh_registration_form_process_get(self):
@@ -228,40 +338,33 @@ def rh_registration_form_process_get(self):
         captcha_settings=get_captcha_settings())
 
 
-RHRegistrationForm._process_GET = rh_registration_form_process_get
+def patch_registration_form():
+    RHRegistrationForm._process_GET = rh_registration_form_process_get
 
 
 @make_interceptable
 def _notify_registration(registration, template_name, to_managers=False, attach_rejection_reason=False,
                          diff=None, old_price=None):
-    from indico.modules.events.registration.util import get_ticket_attachments
-    attachments = []
     regform = registration.registration_form
     tickets_handled = values_from_signal(signals.event.is_ticketing_handled.send(regform), single_value=True)
-    if (not to_managers and
-            regform.tickets_enabled and
-            regform.ticket_on_email and
-            not any(tickets_handled) and
-            registration.state == RegistrationState.complete):
-        attachments += get_ticket_attachments(registration)
-    if not to_managers and registration.registration_form.attach_ical:
-        event_ical = event_to_ical(registration.event, method='REQUEST', skip_access_check=True,
-                                   organizer=(core_settings.get('site_title'), config.NO_REPLY_EMAIL))
-        attachments.append(MIMECalendar('event.ics', event_ical))
-    to_list = (
-        registration.email if not to_managers else registration.registration_form.manager_notification_recipients
-    )
-    from_address = registration.registration_form.notification_sender_address if not to_managers else None
+    attach_ticket = (not to_managers and
+                     regform.tickets_enabled and
+                     regform.ticket_on_email and
+                     not any(tickets_handled) and
+                     registration.state == RegistrationState.complete)
+    attach_ical = not to_managers and regform.attach_ical
+    to_list, from_address = get_notification_recipients(registration, to_managers)
     with registration.event.force_event_locale(registration.user if not to_managers else None):
-        tpl = get_template_module(f'{template_name}', registration=registration,
-                                  attach_rejection_reason=attach_rejection_reason, diff=diff, old_price=old_price)
-        mail = make_email(to_list=to_list, template=tpl, html=True, from_address=from_address, attachments=attachments)
+        tpl = get_notification_template_module(template_name, registration=registration,
+                                               attach_rejection_reason=attach_rejection_reason, diff=diff,
+                                               old_price=old_price)
+        mail = make_email(to_list=to_list, template=tpl, html=True, from_address=from_address)
     user = session.user if session else None
     signals.core.before_notification_send.send('notify-registration', email=mail, registration=registration,
                                                template_name=template_name, to_managers=to_managers,
                                                attach_rejection_reason=attach_rejection_reason)
-    send_email(mail, event=registration.registration_form.event, module='Registration', user=user,
-               log_metadata={'registration_id': registration.id})
+    # sent by a task, along with its attachments
+    queue_registration_email(registration, mail, user=user, attach_ticket=attach_ticket, attach_ical=attach_ical)
 
 
 def notify_registration_creation(registration, notify_user=True):
@@ -293,136 +396,14 @@ def notify_registration_state_update(registration, attach_rejection_reason=False
                              to_managers=True)
 
 
-import indico.modules.events.payment.util
-
-indico.modules.events.registration.util.notify_registration_creation = notify_registration_creation
-indico.modules.events.registration.util.notify_registration_modification = notify_registration_modification
-indico.modules.events.registration.controllers.display.notify_registration_state_update = notify_registration_state_update
-indico.modules.events.registration.controllers.management.reglists.notify_registration_state_update = notify_registration_state_update
-indico.modules.events.payment.util.notify_registration_state_update = notify_registration_state_update
-
-
-class InvoiceDataType(int, IndicoEnum):
-    """
-    Description of the invoice data items that exist on every registration form.
-    """
+def patch_notifications():
+    import indico.modules.events.payment.util
 
-    __titles__ = [
-        None,
-        # '普通增值税发票需求',
-        '付款单位全称',
-        '统一社会信用代码（税号）',
-        '手机号',
-    ]
-    __description__ = [
-        None,
-        # 'The receipt is only valid for Chinese Mainland. For receipt / invoice outside of China, '
-        # 'you will be automatically obtained in the email received after registration is completed.',
-        'Full name of your affiliation in Chinese. '
-        'Please make sure to fill it out correctly to avoid any impact on reimbursement. '
-        'If you do not need an invoice, please leave it blank. '
-        '请务必填写正确，以免影响报销。如无需发票，请留空。',
-        'Unified Social Credit Identifier (Tax Identification Number)',
-        '11-digit mobile phone number (for receiving receipt information). '
-        'Invoice will be sent to your email box, too. '
-        '11位手机号（用于接收发票信息）。发票也将发到电子邮箱。',
-    ]
-    # receipt = 1
-    receipt_title = 1
-    receipt_number = 2
-    receipt_phone = 3
-
-    def get_title(self):
-        return self.__titles__[self]
-
-    def get_description(self):
-        return self.__description__[self]
-
-    @strict_classproperty
-    @classmethod
-    def FIELD_DATA(cls):
-        # title_item = {'price': 0,
-        #               'places_limit': 0,
-        #               'is_enabled': True}
-        return [
-            # (cls.receipt, {
-            #     'title': cls.receipt.get_title(),
-            #     'description': cls.receipt.get_description(),
-            #     'input_type': 'single_choice',
-            #     'position': 1,
-            #     'data': {
-            #         'item_type': 'dropdown',
-            #         'with_extra_slots': False,
-            #         'choices': [
-            #             dict(**title_item, id='Yes', caption='Yes 是'),
-            #             dict(**title_item, id='No', caption='No 否'),
-            #         ]
-            #     }
-            # }),
-
-            (cls.receipt_title, {
-                'title': cls.receipt_title.get_title(),
-                'description': cls.receipt_title.get_description(),
-                'input_type': 'text',
-                'position': 1
-            }),
-            (cls.receipt_number, {
-                'title': cls.receipt_number.get_title(),
-                'description': cls.receipt_number.get_description(),
-                'input_type': 'text',
-                'position': 2
-            }),
-            (cls.receipt_phone, {
-                'title': cls.receipt_phone.get_title(),
-                'description': cls.receipt_phone.get_description(),
-                'input_type': 'text',
-                'position': 3
-            }),
-        ]
-
-    @property
-    def is_required(self):
-        return self in {}
-
-    @property
-    def column(self):
-        """
-        The Registration column in which the value is stored in
-        addition to the regular registration data entry.
-        """
-        if self in {
-            # InvoiceDataType.receipt,
-            InvoiceDataType.receipt_title,
-            InvoiceDataType.receipt_number,
-            InvoiceDataType.receipt_phone,
-        }:
-            return self.name
-        else:
-            return None
-
-
-def create_invoice_data_fields(regform: RegistrationForm):
-    """Create the special section/fields for invoice data."""
-    title = '普通增值税发票付款单位信息'
-    description = 'Invoice Payer Data. Only valid for Chinese Mainland affiliations.'
-    section = next(
-        (s for s in regform.sections if s.type == RegistrationFormItemType.section and s.title == title), None)
-    if section is None:
-        section = RegistrationFormSection(registration_form=regform, title=title, description=description)
-        missing = set(InvoiceDataType)
-    else:
-        existing = {x.type for x in section.children if x.type == RegistrationFormItemType.field}
-        missing = set(InvoiceDataType) - existing
-    for pd_type, data in InvoiceDataType.FIELD_DATA:
-        if pd_type not in missing:
-            continue
-        field = RegistrationFormField(registration_form=regform, parent_id=section.id,
-                                      type=RegistrationFormItemType.field, is_required=pd_type.is_required)
-        for key, value in data.items():
-            setattr(field, key, value)
-        field.data, versioned_data = field.field_impl.process_field_data(data.pop('data', {}))
-        field.current_data = RegistrationFormFieldData(versioned_data=versioned_data)
-        section.children.append(field)
+    indico.modules.events.registration.util.notify_registration_creation = notify_registration_creation
+    indico.modules.events.registration.util.notify_registration_modification = notify_registration_modification
+    indico.modules.events.registration.controllers.display.notify_registration_state_update = notify_registration_state_update
+    indico.modules.events.registration.controllers.management.reglists.notify_registration_state_update = notify_registration_state_update
+    indico.modules.events.payment.util.notify_registration_state_update = notify_registration_state_update
 
 
 def rh_manage_participants_process(self):
@@ -463,9 +444,6 @@ def rh_manage_participants_process(self):
     return redirect(url_for('event_registration.manage_regform', regform))
 
 
-RHManageParticipants._process = rh_manage_participants_process
-
-
 def rh_registration_form_create_process(self):
     participant_visibility = (PublishRegistrationsMode.hide_all
                               if self.event.type_ == EventType.conference
@@ -495,9 +473,6 @@ def rh_registration_form_create_process(self):
                                                 form=form, regform=None)
 
 
-RHRegistrationFormCreate._process = rh_registration_form_create_process
-
-
 def rh_registration_form_modify_process(self):
     form_data = get_flat_section_setup_data(self.regform)
     logger.info(form_data)
@@ -521,4 +496,21 @@ def rh_registration_form_modify_process(self):
                                                 has_predefined_affiliations=Affiliation.query.has_rows())
 
 
-RHRegistrationFormModify._process = rh_registration_form_modify_process
+def patch_registration_form_management():
+    RHManageParticipants._process = rh_manage_participants_process
+    RHRegistrationFormCreate._process = rh_registration_form_create_process
+    RHRegistrationFormModify._process = rh_registration_form_modify_process
+
+
+def _send_settings_changed(process):
+    def _process(self):
+        rv = process(self)
+        if request.method == 'POST' and self.plugin.name == 'payment_sjtu':
+            settings_changed.send(self.plugin, event=getattr(self, 'event', None))
+        return rv
+    return _process
+
+
+def patch_settings_changed():
+    RHPluginDetails._process = _send_settings_changed(RHPluginDetails._process)
+    RHPaymentPluginEdit._process = _send_settings_changed(RHPaymentPluginEdit._process)
@@ -0,0 +1,65 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Durable outbox of the payment results received on the callback URL."""
+
+from indico.core.cache import make_scoped_cache
+from indico.core.db import db
+
+from indico_payment_sjtu.models.callbacks import CallbackState, SJTUCallback
+from indico_payment_sjtu.util import call_after_commit
+
+# number of callbacks registered in one transaction
+OUTBOX_BATCH_SIZE = 100
+# a callback failing this many times is moved to the dead letters
+OUTBOX_MAX_ATTEMPTS = 5
+# callbacks received within this many seconds are drained by a single task
+OUTBOX_DRAIN_DELAY = 2
+
+outbox_cache = make_scoped_cache('payment-sjtu-outbox')
+
+
+def _schedule_drain():
+    from indico_payment_sjtu.tasks import drain_callback_outbox
+    if outbox_cache.add('drain-scheduled', True, timeout=OUTBOX_DRAIN_DELAY):
+        drain_callback_outbox.apply_async(countdown=OUTBOX_DRAIN_DELAY)
+
+
+def enqueue_callback(registration, trade_no, raw_data):
+    """Store a verified payment result and schedule the draining of the outbox.
+
+    The draining is scheduled once the request has been committed.
+    """
+    callback = SJTUCallback(registration=registration, trade_no=trade_no, raw_data=raw_data)
+    db.session.add(callback)
+    db.session.flush()
+    call_after_commit(_schedule_drain)
+    return callback
+
+
+def replay_callbacks(callback_ids=None, *, failed=False):
+    """Mark callbacks as pending so they are processed again.
+
+    :param callback_ids: The ids of the callbacks to replay
+    :param failed: Replay all dead letters
+    :return: The number of callbacks to be replayed
+    """
+    query = SJTUCallback.query
+    if callback_ids:
+        query = query.filter(SJTUCallback.id.in_(callback_ids))
+    elif failed:
+        query = query.filter(SJTUCallback.state == CallbackState.failed)
+    else:
+        return 0
+    return query.update({'state': CallbackState.pending, 'attempts': 0, 'error': None, 'processed_dt': None},
+                        synchronize_session=False)
+
+
+def get_outbox_counts():
+    counts = dict.fromkeys(CallbackState, 0)
+    counts.update(db.session.query(SJTUCallback.state, db.func.count()).group_by(SJTUCallback.state))
+    return counts
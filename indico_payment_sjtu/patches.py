@@ -0,0 +1,91 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Registry of the monkey patches applied to Indico.
+
+Nothing is patched when the plugin is imported. The plugin applies the
+patches once the Indico application has been created, which happens in
+every web worker, Celery worker and CLI process, so no process sends
+unpatched notifications or renders unpatched templates. The time spent
+importing and applying each patch is recorded and shown by
+``indico payment-sjtu startup-profile``.
+"""
+
+import threading
+import time
+from importlib import import_module
+from typing import NamedTuple
+
+
+PATCH_MODULE = 'indico_payment_sjtu.monkey_patch'
+
+
+class Patch(NamedTuple):
+    name: str
+    #: the Indico modules modified by the patch
+    modules: tuple
+    #: the function applying the patch in :data:`PATCH_MODULE`
+    func: str
+
+
+class PatchTiming(NamedTuple):
+    name: str
+    import_seconds: float
+    apply_seconds: float
+
+
+PATCHES = (
+    Patch('registration-list', ('indico.modules.events.registration.lists',
+                                'indico.modules.events.registration.controllers.management.reglists'),
+          'patch_registration_list'),
+    Patch('registration-export', ('indico.modules.events.registration.controllers.management.reglists',),
+          'patch_registration_export'),
+    Patch('registration-form', ('indico.modules.events.registration.controllers.display',),
+          'patch_registration_form'),
+    Patch('registration-form-management', ('indico.modules.events.registration.controllers.management.regforms',),
+          'patch_registration_form_management'),
+    Patch('notifications', ('indico.modules.events.registration.util',
+                            'indico.modules.events.registration.controllers.display',
+                            'indico.modules.events.registration.controllers.management.reglists',
+                            'indico.modules.events.payment.util'),
+          'patch_notifications'),
+    Patch('settings-changed', ('indico.core.plugins.controllers', 'indico.modules.events.payment.controllers'),
+          'patch_settings_changed'),
+)
+
+_lock = threading.Lock()
+_timings = []
+
+
+def _timed(func):
+    start = time.perf_counter()
+    rv = func()
+    return rv, time.perf_counter() - start
+
+
+def apply_patches():
+    """Apply all patches, unless that already happened in this process.
+
+    :return: A list of :class:`PatchTiming`; modules already imported by
+             an earlier patch are not counted again. The import of the
+             rest of :data:`PATCH_MODULE` is recorded as a separate entry.
+    """
+    if _timings:
+        return _timings
+    with _lock:
+        if _timings:
+            return _timings
+        import_times = {}
+        for patch in PATCHES:
+            import_times[patch.name] = sum(_timed(lambda: import_module(module))[1] for module in patch.modules)
+        module, module_import_time = _timed(lambda: import_module(PATCH_MODULE))
+        timings = [PatchTiming(PATCH_MODULE, module_import_time, 0)]
+        for patch in PATCHES:
+            __, apply_time = _timed(getattr(module, patch.func))
+            timings.append(PatchTiming(patch.name, import_times[patch.name], apply_time))
+        _timings[:] = timings
+    return _timings
@@ -5,28 +5,38 @@
 # them and/or modify them under the terms of the MIT License;
 # see the LICENSE file for more details.
 
-from hashlib import md5
 import base64
-from dict2xml import dict2xml
+from functools import partial
 from urllib.parse import urlparse, urljoin
 from uuid import UUID
 
-from flask_pluginengine import current_plugin, render_plugin_template
+from flask_pluginengine import render_plugin_template
 from flask import session
 from indico.modules.events.layout.util import MenuEntryData
-from wtforms.fields import StringField, URLField
-from wtforms.validators import DataRequired, Optional
+from wtforms.fields import BooleanField, IntegerField, StringField, URLField
+from wtforms.validators import DataRequired, NumberRange, Optional
 
 from indico.core.plugins import IndicoPlugin, url_for_plugin
 from indico.core import signals
+from indico.core.db import db
+from indico.modules.events.models.events import Event
 from indico.modules.events.payment import (PaymentEventSettingsFormBase, PaymentPluginMixin,
                                            PaymentPluginSettingsFormBase)
+from indico.modules.events.registration.models.registrations import RegistrationState
 from indico.util.string import remove_accents, str_to_ascii
 from indico.web.forms.validators import UsedIf
+from indico.web.forms.widgets import SwitchWidget
 
 from indico_payment_sjtu import _
+from indico_payment_sjtu.billno import uuid_to_billno
 from indico_payment_sjtu.blueprint import blueprint
-from indico_payment_sjtu.util import uuid_to_billno
+from indico_payment_sjtu.cache import TICKETS_PREFETCH_DELAY, bump_event_version, forget_query_result
+from indico_payment_sjtu.codec import serialize_billinfo
+from indico_payment_sjtu.invoice_fields import InvoiceDataType, get_invoice_field_ids
+from indico_payment_sjtu.models.bills import SJTUBill
+from indico_payment_sjtu.patches import apply_patches
+from indico_payment_sjtu.settings import get_event_signer
+from indico_payment_sjtu.util import call_after_commit
 
 
 class PluginSettingsForm(PaymentPluginSettingsFormBase):
@@ -38,6 +48,20 @@ class PluginSettingsForm(PaymentPluginSettingsFormBase):
                            description=_('The subsysid parameter of SJTU Pay.'))
     feeitemid = StringField(_('Fee Item Id'), [Optional()],
                             description=_('The feeitemid from SJTU Pay.'))
+    portal_timeout = IntegerField(_('API Timeout'), [DataRequired(), NumberRange(min=1)],
+                                  description=_('Read timeout (in seconds) for requests to the SJTU HTTP API.'))
+    portal_retries = IntegerField(_('API Retries'), [Optional(), NumberRange(min=0)],
+                                  description=_('How many times a failed query to the SJTU HTTP API is retried. '
+                                                'Refunds are never retried.'))
+    callback_fast_ack = BooleanField(_('Fast Callback Acknowledgement'), widget=SwitchWidget(),
+                                     description=_('Acknowledge payment results on the callback URL as soon as their '
+                                                   'sign has been verified and register the payments in a '
+                                                   'background worker.'))
+    metrics_token = StringField(_('Metrics Token'), [Optional()],
+                                description=_('Bearer token required to read /payment/sjtu/metrics. The endpoint is '
+                                              'disabled when empty.'))
+    statsd_address = StringField(_('Statsd Address'), [Optional()],
+                                 description=_('host:port of a statsd server receiving the metrics.'))
 
 
 class EventSettingsForm(PaymentEventSettingsFormBase):
@@ -62,7 +86,12 @@ class SJTUPaymentPlugin(PaymentPluginMixin, IndicoPlugin):
                         'cert': '',
                         'sysid': '',
                         'subsysid': '',
-                        'feeitemid': ''}
+                        'feeitemid': '',
+                        'portal_timeout': 10,
+                        'portal_retries': 2,
+                        'callback_fast_ack': False,
+                        'metrics_token': '',
+                        'statsd_address': ''}
     default_event_settings = {'enabled': False,
                               'method_name': None,
                               'sysid': None,
@@ -72,8 +101,48 @@ class SJTUPaymentPlugin(PaymentPluginMixin, IndicoPlugin):
 
     def init(self):
         super().init()
+        self.connect(signals.core.app_created, self._app_created)
+        self.connect(signals.core.import_tasks, self._import_tasks)
+        self.connect(signals.event.registration_created, self._registration_created)
+        self.connect(signals.event.registration_state_updated, self._registration_state_updated)
+        self.connect(signals.event.updated, self._event_updated)
+        self.connect(signals.event.times_changed, self._event_times_changed, sender=Event)
+        self.connect(signals.plugin.cli, self._extend_indico_cli)
         # self.template_hook('event-manage-payment-plugin-before-form', self._get_encoding_warning)
 
+    def _app_created(self, app, **kwargs):
+        # every process (web, celery and cli) creates the application, and
+        # all of them may send the patched notifications or render the
+        # patched templates
+        apply_patches()
+
+    def _import_tasks(self, sender, **kwargs):
+        import indico_payment_sjtu.tasks  # noqa: F401
+
+    def _registration_created(self, registration, **kwargs):
+        db.session.add(SJTUBill(registration=registration, billno=uuid_to_billno(registration.uuid)))
+
+    def _registration_state_updated(self, registration, **kwargs):
+        forget_query_result(uuid_to_billno(registration.uuid))
+        transaction = registration.transaction
+        if (registration.state == RegistrationState.complete and transaction is not None and
+                transaction.provider == 'sjtu'):
+            from indico_payment_sjtu.tasks import prefetch_sjtu_tickets, prerender_invoice_pdf
+            # the tasks must see the paid registration
+            call_after_commit(partial(prerender_invoice_pdf.delay, registration.id))
+            call_after_commit(partial(prefetch_sjtu_tickets.apply_async, (registration.id,),
+                                      countdown=TICKETS_PREFETCH_DELAY))
+
+    def _event_updated(self, event, **kwargs):
+        bump_event_version(event)
+
+    def _event_times_changed(self, sender, obj, **kwargs):
+        bump_event_version(obj)
+
+    def _extend_indico_cli(self, sender, **kwargs):
+        from indico_payment_sjtu.cli import cli
+        return cli
+
     @property
     def logo_url(self):
         return url_for_plugin(self.name + '.static', filename='images/logo.png')
@@ -87,30 +156,20 @@ class SJTUPaymentPlugin(PaymentPluginMixin, IndicoPlugin):
         # remove query parameter with some magic
         return urljoin(url_with_query, urlparse(url_with_query).path)
 
-    @staticmethod
-    def get_registration_form_fields(data):
-        registration_form_fields = {}
-        for section in data["registration"].registration_form.sections:
-            for field in section.fields:
-                # current_plugin.logger.info(field.__dict__)
-                registration_form_fields[field.current_data_id] = field.title
-        registration_form_data = {}
-        for registration_data in data["registration"].data:
-            # current_plugin.logger.info(registration_data.__dict__)
-            current_data_id = registration_data.field_data_id
-            if current_data_id in registration_form_fields:
-                registration_form_data[registration_form_fields[current_data_id]] = registration_data.data
-        current_plugin.logger.info(registration_form_data)
-        return registration_form_data
-
     @staticmethod
     def generate_invoice_data(data):
-        registration_form_data = SJTUPaymentPlugin.get_registration_form_fields(data)
-        zz_unit = registration_form_data.get("付款单位全称", "")
+        registration = data["registration"]
+        field_ids = get_invoice_field_ids(registration.registration_form)
+
+        def _get_value(pd_type):
+            registration_data = registration.data_by_field.get(field_ids.get(pd_type))
+            return (registration_data.data if registration_data is not None else None) or ""
+
+        zz_unit = _get_value(InvoiceDataType.receipt_title)
         if zz_unit:
-            tax_code = registration_form_data.get("统一社会信用代码（税号）", "")
-            zz_mobile = registration_form_data.get("手机号", "")
-            zz_email = data["registration"].email
+            tax_code = _get_value(InvoiceDataType.receipt_number)
+            zz_mobile = _get_value(InvoiceDataType.receipt_phone)
+            zz_email = registration.email
             type_no = "3001"
         else:
             tax_code = ""
@@ -161,17 +220,7 @@ class SJTUPaymentPlugin(PaymentPluginMixin, IndicoPlugin):
                 "unit": "项",
             }
         }
-        xml = dict2xml(d, wrap='billinfo', indent="").replace("\n", "")
-        return f"""<?xml version="1.0" encoding="GBK"?>{xml}"""
-
-    @staticmethod
-    def generate_sign(data, body):
-        sysid = data["event_settings"]["sysid"]
-        subsysid = data["event_settings"]["subsysid"]
-        cert = data["settings"]["cert"]
-        # print(sysid, subsysid, cert, body)
-        md5_string = sysid + subsysid + cert + body
-        return md5(md5_string.encode("utf-8")).hexdigest()
+        return serialize_billinfo(d)
 
     def adjust_payment_form_data(self, data):
         event = data['event']
@@ -186,8 +235,8 @@ class SJTUPaymentPlugin(PaymentPluginMixin, IndicoPlugin):
         # data['cancel_url'] = url_for_plugin('payment_sjtu.cancel', _external=True)
         # data['notify_url'] = url_for_plugin('payment_sjtu.notify', _external=True)
         data['payment_data'] = self.generate_payment_data(data)
-        data['payment_sign'] = self.generate_sign(data, data['payment_data'])
-        data['query_sign'] = self.generate_sign(data, data['billno'])
+        signer = get_event_signer(event)
+        data['payment_sign'], data['query_sign'] = signer.sign_many((data['payment_data'], data['billno']))
         data['payment_data_base64'] = base64.b64encode(data['payment_data'].encode("utf-8")).decode("ascii")
 
     def _get_encoding_warning(self, plugin=None, event=None):
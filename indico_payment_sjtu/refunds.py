@@ -0,0 +1,107 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Bulk refunds started by event managers.
+
+A batch stores one row per registration, so its progress survives a
+crash of the worker running it: the refunds still pending are sent when
+the batch is resumed. A refund submitted without a recorded answer may
+have been carried out, so it stays submitted until the state of its bill
+on SJTU Pay tells: it has succeeded once the bill is no longer paid, and
+is only sent again while the bill is still paid.
+"""
+
+import threading
+import time
+
+from indico.core.cache import make_scoped_cache
+from indico.core.db import db
+from indico.modules.events.payment.models.transactions import TransactionStatus
+from indico.modules.events.registration.models.registrations import Registration, RegistrationState
+
+from indico_payment_sjtu.billno import uuid_to_billno
+from indico_payment_sjtu.models.refunds import RefundState, SJTURefund, SJTURefundBatch
+
+MAX_CONCURRENT_REFUNDS = 4
+REFUNDS_PER_SECOND = 2
+# number of refunds submitted between two commits
+REFUND_CHUNK_SIZE = 20
+# a batch whose worker did not report for this long is resumed by another one
+REFUND_LOCK_TIMEOUT = 300
+
+refund_cache = make_scoped_cache('payment-sjtu-refunds')
+
+
+class RateLimiter:
+    """Space out calls from many threads to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def get_refundable_registrations(regform, registration_ids):
+    """Get the registrations among `registration_ids` which can be refunded.
+
+    These are the complete registrations paid with SJTU Pay which have not
+    been refunded by a previous batch yet.
+    """
+    refunded = _query_refunded_registration_ids()
+    registrations = (Registration.query.with_parent(regform)
+                     .filter(Registration.id.in_(registration_ids),
+                             Registration.state == RegistrationState.complete,
+                             ~Registration.id.in_(refunded))
+                     .order_by(Registration.id)
+                     .all())
+    return [registration for registration in registrations
+            if (registration.transaction is not None and registration.transaction.provider == 'sjtu' and
+                registration.transaction.status == TransactionStatus.successful)]
+
+
+def _query_refunded_registration_ids():
+    # a failed refund was rejected by SJTU Pay, all others may (still) pay the bill back
+    return (db.session.query(SJTURefund.registration_id)
+            .filter(SJTURefund.state != RefundState.failed))
+
+
+def is_refund_started(registration):
+    """Check whether a batch is refunding or has refunded a registration."""
+    return db.session.query(_query_refunded_registration_ids()
+                            .filter(SJTURefund.registration_id == registration.id)
+                            .exists()).scalar()
+
+
+def create_refund_batch(regform, registrations, user):
+    batch = SJTURefundBatch(regform=regform, created_by=user)
+    for registration in registrations:
+        batch.refunds.append(SJTURefund(registration=registration, billno=uuid_to_billno(registration.uuid),
+                                        billamt=registration.transaction.data['billamt']))
+    db.session.add(batch)
+    db.session.flush()
+    return batch
+
+
+def lock_refund_batch(batch_id):
+    """Claim a batch for the calling worker; returns whether it succeeded."""
+    return refund_cache.add(f'batch-{batch_id}', True, timeout=REFUND_LOCK_TIMEOUT)
+
+
+def refresh_refund_batch_lock(batch_id):
+    refund_cache.set(f'batch-{batch_id}', True, timeout=REFUND_LOCK_TIMEOUT)
+
+
+def unlock_refund_batch(batch_id):
+    refund_cache.delete(f'batch-{batch_id}')
@@ -0,0 +1,77 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import time
+from types import MappingProxyType
+
+from blinker import Namespace
+from flask_pluginengine import current_plugin
+
+from indico_payment_sjtu.signing import SJTUSigner
+
+SETTINGS_TTL = 60
+
+_signals = Namespace()
+
+settings_changed = _signals.signal('settings-changed', """
+Called when the global or event settings of the plugin have been saved.
+The *sender* is the plugin, the event is passed in the `event` kwarg
+(`None` for the global settings).
+""")
+
+
+class SettingsCache:
+    """In-process cache for plugin settings.
+
+    Entries expire after ``ttl`` seconds; this is how other worker
+    processes pick up a change, since :data:`settings_changed` is only
+    received by the process which saved the settings.
+    """
+
+    def __init__(self, ttl=SETTINGS_TTL):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key, load):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = load()
+        self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+settings_cache = SettingsCache()
+
+
+@settings_changed.connect
+def _clear_settings_cache(sender, **kwargs):
+    settings_cache.clear()
+
+
+def get_plugin_settings():
+    """Get a read-only view of the global plugin settings."""
+    return settings_cache.get('settings', lambda: MappingProxyType(current_plugin.settings.get_all()))
+
+
+def get_event_settings(event):
+    """Get a read-only view of the plugin settings of an event."""
+    return settings_cache.get(('event_settings', event.id),
+                              lambda: MappingProxyType(current_plugin.event_settings.get_all(event)))
+
+
+def get_event_signer(event):
+    """Get the signer holding the SJTU Pay credentials of an event."""
+    def _load():
+        event_settings = get_event_settings(event)
+        return SJTUSigner(event_settings['sysid'], event_settings['subsysid'], get_plugin_settings()['cert'])
+
+    return settings_cache.get(('signer', event.id), _load)
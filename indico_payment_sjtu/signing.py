@@ -0,0 +1,63 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import hmac
+from hashlib import md5
+
+
+class SJTUSigner:
+    """Sign and verify messages exchanged with SJTU Pay.
+
+    A signature is ``md5(sysid + subsysid + cert + data)``.  The constant
+    prefix is hashed once when the signer is created; every message only
+    hashes a copy of that state with the message appended.
+    """
+
+    __slots__ = ('sysid', 'subsysid', 'cert', '_prefix')
+
+    def __init__(self, sysid, subsysid, cert):
+        object.__setattr__(self, 'sysid', sysid)
+        object.__setattr__(self, 'subsysid', subsysid)
+        object.__setattr__(self, 'cert', cert)
+        object.__setattr__(self, '_prefix', md5((sysid + subsysid + cert).encode("utf-8")))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __repr__(self):
+        return f'<SJTUSigner({self.sysid!r}, {self.subsysid!r})>'
+
+    def sign(self, data):
+        md5_hash = self._prefix.copy()
+        md5_hash.update(data.encode("utf-8"))
+        return md5_hash.hexdigest()
+
+    def verify(self, data, sign):
+        """Check a signature received from SJTU Pay in constant time."""
+        if not sign:
+            return False
+        return hmac.compare_digest(self.sign(data).encode("ascii"), sign.encode("utf-8"))
+
+    def sign_many(self, messages):
+        """Sign many messages, e.g. all bill numbers of an event."""
+        prefix = self._prefix
+        signs = []
+        for data in messages:
+            md5_hash = prefix.copy()
+            md5_hash.update(data.encode("utf-8"))
+            signs.append(md5_hash.hexdigest())
+        return signs
+
+    def verify_many(self, signed_messages):
+        """Verify many ``(data, sign)`` pairs.
+
+        :return: A list of booleans in the same order as the pairs
+        """
+        signed_messages = list(signed_messages)
+        signs = self.sign_many(data for data, __ in signed_messages)
+        return [bool(sign) and hmac.compare_digest(expected.encode("ascii"), sign.encode("utf-8"))
+                for expected, (__, sign) in zip(signs, signed_messages)]
@@ -0,0 +1,133 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Streaming variants of :func:`indico.util.spreadsheets.send_csv` and
+:func:`indico.util.spreadsheets.send_xlsx`.
+
+Rows are consumed lazily from an iterable, so memory usage does not
+depend on the number of rows.
+"""
+
+import codecs
+import csv
+import re
+import tempfile
+from datetime import date, datetime
+from io import StringIO
+
+import xlsxwriter
+from flask import Response, stream_with_context
+
+from indico.web.flask.util import send_file
+
+CSV_CHUNK_ROWS = 500
+
+_linebreak_re = re.compile(r'(\r?\n)+')
+_dangerous_chars_re = re.compile(r'^[=+@-]+')
+
+
+def _header_title(header):
+    # columns created with `unique_col` are (title, id) tuples
+    return header[0] if isinstance(header, tuple) else header
+
+
+def _prepare_value(value):
+    if value is None:
+        return ''
+    elif isinstance(value, (list, tuple)):
+        return '; '.join(map(str, value))
+    elif isinstance(value, set):
+        return '; '.join(sorted(map(str, value), key=str.lower))
+    elif isinstance(value, dict):
+        return '; '.join(f'{k}: {v}' for k, v in sorted(value.items()))
+    elif isinstance(value, bool):
+        return 'Yes' if value else 'No'
+    return value
+
+
+def _prepare_csv_value(value):
+    value = str(_prepare_value(value))
+    value = _linebreak_re.sub('    ', value)
+    # avoid formula injection when the file is opened in a spreadsheet application
+    return _dangerous_chars_re.sub('', value)
+
+
+def _prepare_xlsx_value(value, tz=None):
+    value = _prepare_value(value)
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return (value.astimezone(tz) if tz else value).replace(tzinfo=None)
+    elif isinstance(value, (str, int, float, date)):
+        return value
+    return str(value)
+
+
+def _iter_rows(headers, rows):
+    for row in rows:
+        if isinstance(row, dict):
+            yield [row.get(header, '') for header in headers]
+        else:
+            yield row
+
+
+def _generate_csv(headers, rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([_header_title(header) for header in headers])
+    yield codecs.BOM_UTF8
+    for i, row in enumerate(_iter_rows(headers, rows), 1):
+        writer.writerow([_prepare_csv_value(value) for value in row])
+        if i % CSV_CHUNK_ROWS == 0:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
+def send_csv_stream(filename, headers, rows):
+    """Send a CSV file as a chunked response while the rows are generated.
+
+    :param headers: The column headers
+    :param rows: An iterable of rows, either dicts keyed by header or
+                 sequences in the same order as `headers`
+    """
+    return Response(stream_with_context(_generate_csv(headers, rows)), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+def send_xlsx_stream(filename, headers, rows, tz=None):
+    """Send an XLSX file written in constant memory mode.
+
+    Rows are flushed to a temporary file as soon as they are written, so
+    only the current row is kept in memory.
+
+    :param headers: The column headers
+    :param rows: An iterable of rows, either dicts keyed by header or
+                 sequences in the same order as `headers`
+    :param tz: The timezone used for datetime values
+    """
+    fd = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(fd, {'constant_memory': True,
+                                        'strings_to_formulas': False,
+                                        'strings_to_numbers': False,
+                                        'strings_to_urls': False})
+    header_format = workbook.add_format({'bold': True})
+    datetime_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+    sheet = workbook.add_worksheet()
+    sheet.write_row(0, 0, [_header_title(header) for header in headers], header_format)
+    for row_num, row in enumerate(_iter_rows(headers, rows), 1):
+        for col_num, value in enumerate(row):
+            value = _prepare_xlsx_value(value, tz=tz)
+            if isinstance(value, datetime):
+                sheet.write_datetime(row_num, col_num, value, datetime_format)
+            elif isinstance(value, date):
+                sheet.write_datetime(row_num, col_num, value, date_format)
+            else:
+                sheet.write(row_num, col_num, value)
+    workbook.close()
+    fd.seek(0)
+    return send_file(filename, fd, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -0,0 +1,447 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from concurrent.futures import ThreadPoolExecutor
+
+from celery.schedules import crontab
+from flask import current_app
+from flask_pluginengine import current_plugin
+from sqlalchemy.orm import selectinload
+
+from indico.core.cache import make_scoped_cache
+from indico.core.celery import celery
+from indico.core.db import db
+from indico.core.notifications import send_email
+from indico.modules.events.models.events import Event
+from indico.modules.events.registration.models.registrations import Registration, RegistrationState
+from indico.util.date_time import now_utc
+
+from indico_payment_sjtu.attachments import RegistrationAttachments
+from indico_payment_sjtu.billno import uuid_to_billno
+from indico_payment_sjtu.cache import TICKETS_NOT_ISSUED_TTL, forget_tickets, get_tickets
+from indico_payment_sjtu.codec import SJTUPayloadError, parse_pay_result
+from indico_payment_sjtu.controllers import RHSJTUBase
+from indico_payment_sjtu.emails import (EMAIL_BATCH_SIZE, EMAIL_MAX_ATTEMPTS, EMAIL_SEND_DELAY, EMAILS_PER_SECOND,
+                                        MAX_EMAILS_PER_RUN, load_email, lock_email_queue, refresh_email_queue_lock,
+                                        unlock_email_queue)
+from indico_payment_sjtu.invoices import get_invoice_pdf
+from indico_payment_sjtu.metrics import duplicate_payments, payment_lock_conflicts
+from indico_payment_sjtu.metrics import refunds as refund_outcomes
+from indico_payment_sjtu.models.callbacks import CallbackState, SJTUCallback
+from indico_payment_sjtu.models.emails import EmailState, SJTUQueuedEmail
+from indico_payment_sjtu.models.refunds import RefundState, SJTURefund, SJTURefundBatch
+from indico_payment_sjtu.outbox import OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS
+from indico_payment_sjtu.refunds import (MAX_CONCURRENT_REFUNDS, REFUND_CHUNK_SIZE, REFUNDS_PER_SECOND, RateLimiter,
+                                         lock_refund_batch, refresh_refund_batch_lock, unlock_refund_batch)
+from indico_payment_sjtu.settings import get_event_settings
+
+# number of registrations of one event checked in a single run
+BATCH_SIZE = 200
+# number of portal queries in a single run (across all events)
+MAX_QUERIES_PER_RUN = 2000
+MAX_CONCURRENT_QUERIES = 4
+# an unpaid bill is queried again after BACKOFF_BASE * 2**attempts seconds
+BACKOFF_BASE = 600
+BACKOFF_MAX = 86400
+ATTEMPTS_TTL = 30 * 86400
+# how many times the e-tickets of a paid bill are fetched until they are issued
+TICKET_PREFETCH_ATTEMPTS = 6
+
+reconcile_cache = make_scoped_cache('payment-sjtu-reconcile')
+
+
+class SJTUReconciler(RHSJTUBase):
+    """Query SJTU Pay about a registration outside of a request."""
+
+    def __init__(self, registration):
+        super().__init__()
+        self.registration = registration
+        self.billno = uuid_to_billno(registration.uuid)
+        self._init_plugin_settings()
+
+
+def _get_sjtu_events():
+    event_ids = {event_id for event_id, in (db.session.query(Registration.event_id)
+                                            .filter(Registration.state == RegistrationState.unpaid,
+                                                    ~Registration.is_deleted)
+                                            .distinct())}
+    events = Event.query.filter(Event.id.in_(event_ids), ~Event.is_deleted).order_by(Event.id)
+    return [event for event in events if get_event_settings(event)['enabled']]
+
+
+def _rotate_events(events, cursor):
+    """Start with the event after the last one visited by the previous run."""
+    start = next((i for i, event in enumerate(events) if event.id > cursor), 0)
+    return events[start:] + events[:start]
+
+
+def _get_unpaid_registrations(event, cursor, limit):
+    return (Registration.query
+            .filter(Registration.event_id == event.id,
+                    Registration.id > cursor,
+                    Registration.state == RegistrationState.unpaid,
+                    ~Registration.is_deleted)
+            .order_by(Registration.id)
+            .limit(limit)
+            .all())
+
+
+def _map_in_threads(func, items, max_workers):
+    """Run `func` on many items in a bounded number of threads.
+
+    `func` runs in the app and plugin context but must not use the
+    database session of the calling thread.
+    """
+    app = current_app._get_current_object()
+    plugin = current_plugin._get_current_object()
+
+    def _call(item):
+        with app.app_context(), plugin.plugin_context():
+            return func(item)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_call, items))
+
+
+def _query_bills(reconcilers):
+    """Query the portal for many bills with a bounded number of threads."""
+    def _query(reconciler):
+        try:
+            return reconciler._query_sjtu_bill(reconciler.billno)
+        except Exception:
+            current_plugin.logger.exception('Reconcile: querying %s failed', reconciler.billno)
+            return []
+
+    return _map_in_threads(_query, reconcilers, MAX_CONCURRENT_QUERIES)
+
+
+def _back_off(registration):
+    attempts = reconcile_cache.get(f'attempts-{registration.id}') or 0
+    delay = min(BACKOFF_BASE * 2 ** attempts, BACKOFF_MAX)
+    reconcile_cache.set(f'backoff-{registration.id}', True, timeout=delay)
+    reconcile_cache.set(f'attempts-{registration.id}', attempts + 1, timeout=ATTEMPTS_TTL)
+
+
+def _reconcile_event(event, limit):
+    cursor_key = f'cursor-{event.id}'
+    cursor = reconcile_cache.get(cursor_key) or 0
+    registrations = _get_unpaid_registrations(event, cursor, limit)
+    # once the end is reached the next run starts over from the first registration
+    reconcile_cache.set(cursor_key, registrations[-1].id if len(registrations) == limit else 0)
+    backoff = reconcile_cache.get_many(*(f'backoff-{reg.id}' for reg in registrations))
+    registrations = [reg for reg, skip in zip(registrations, backoff) if not skip]
+    if not registrations:
+        return 0
+    reconcilers = [SJTUReconciler(reg) for reg in registrations]
+    paid = 0
+    for reconciler, payment_results in zip(reconcilers, _query_bills(reconcilers)):
+        try:
+            with db.session.begin_nested():
+                outcome = reconciler._register_paid_bill(payment_results)
+        except Exception:
+            current_plugin.logger.exception('Reconcile: registering the payment of %s failed', reconciler.billno)
+            _back_off(reconciler.registration)
+            continue
+        if outcome is None:
+            # the payment is being registered by someone else, the next run sees its outcome
+            continue
+        elif outcome:
+            db.session.commit()
+            reconcile_cache.delete(f'attempts-{reconciler.registration.id}')
+            paid += 1
+        else:
+            _back_off(reconciler.registration)
+    current_plugin.logger.info('Reconcile: event %d, %d bills queried, %d paid', event.id, len(reconcilers), paid)
+    return len(reconcilers)
+
+
+@celery.periodic_task(run_every=crontab(minute='*/10'), plugin='payment_sjtu')
+def reconcile_unpaid_registrations():
+    """Register payments of unpaid registrations which SJTU Pay never reported."""
+    budget = MAX_QUERIES_PER_RUN
+    # the events left over when the budget runs out are visited first by the next run
+    for event in _rotate_events(_get_sjtu_events(), reconcile_cache.get('event-cursor') or 0):
+        if budget <= 0:
+            break
+        budget -= _reconcile_event(event, min(BATCH_SIZE, budget))
+        reconcile_cache.set('event-cursor', event.id)
+    db.session.commit()
+
+
+@celery.task(plugin='payment_sjtu')
+def prerender_invoice_pdf(registration_id):
+    """Render the invoice PDF of a paid registration before it is downloaded."""
+    registration = Registration.get(registration_id, is_deleted=False)
+    if registration is None or registration.state != RegistrationState.complete:
+        return
+    get_invoice_pdf(registration)
+
+
+@celery.task(bind=True, plugin='payment_sjtu', max_retries=TICKET_PREFETCH_ATTEMPTS - 1)
+def prefetch_sjtu_tickets(self, registration_id):
+    """Fetch the e-tickets of a paid registration before the invoice is opened."""
+    registration = Registration.get(registration_id, is_deleted=False)
+    if registration is None or registration.state != RegistrationState.complete:
+        return
+    reconciler = SJTUReconciler(registration)
+    # replace a "not issued yet" answer cached by the invoice page
+    forget_tickets(reconciler.billno)
+    tickets = get_tickets(reconciler.billno, lambda: reconciler._query_sjtu_tickets(reconciler.billno))
+    if tickets:
+        return
+    if self.request.retries >= self.max_retries:
+        # the invoice page keeps asking the portal once the "not issued yet" answer expires
+        current_plugin.logger.info('Tickets: none issued for %s after %d attempts', reconciler.billno,
+                                   self.request.retries + 1)
+        return
+    raise self.retry(countdown=TICKETS_NOT_ISSUED_TTL)
+
+
+def _submit_refunds(refunds, feeitemid, limiter):
+    jobs = [(SJTUReconciler(refund.registration), refund.billno, refund.billamt) for refund in refunds]
+
+    def _submit(job):
+        reconciler, billno, billamt = job
+        limiter.wait()
+        try:
+            return reconciler._refund_sjtu_bill(billno, billamt, feeitemid)
+        except Exception:
+            current_plugin.logger.exception('Refund: refunding %s failed', billno)
+            return None
+
+    return _map_in_threads(_submit, jobs, MAX_CONCURRENT_REFUNDS)
+
+
+def _query_refunded_bills(refunds, limiter):
+    jobs = [(SJTUReconciler(refund.registration), refund.billno) for refund in refunds]
+
+    def _query(job):
+        reconciler, billno = job
+        limiter.wait()
+        try:
+            return reconciler._is_sjtu_bill_refunded(billno)
+        except Exception:
+            current_plugin.logger.exception('Refund: querying %s failed', billno)
+            return None
+
+    return _map_in_threads(_query, jobs, MAX_CONCURRENT_REFUNDS)
+
+
+def _settle_refund(refund, refunded):
+    if refunded is None:
+        # still unknown, settled by a later run
+        return
+    elif refunded:
+        refund.state = RefundState.succeeded
+        refund.error = None
+        refund_outcomes.inc(outcome='settled')
+    else:
+        # the submission never reached SJTU Pay
+        refund.state = RefundState.pending
+
+
+def _record_refund(refund, result):
+    if result is None:
+        # the refund may have been carried out; it stays submitted until its bill is queried
+        refund.error = 'API failed'
+        refund_outcomes.inc(outcome='api_error')
+    elif result.success:
+        refund.state = RefundState.succeeded
+        refund.error = None
+        refund_outcomes.inc(outcome='success')
+    else:
+        refund.state = RefundState.failed
+        refund.error = result.error_msg or ''
+        refund_outcomes.inc(outcome='rejected')
+
+
+def _query_unfinished_refunds(batch):
+    return SJTURefund.query.filter(SJTURefund.batch_id == batch.id,
+                                   SJTURefund.state.in_([RefundState.pending, RefundState.submitted]))
+
+
+def _get_unfinished_refunds(batch, after_id):
+    return (_query_unfinished_refunds(batch)
+            .filter(SJTURefund.id > after_id)
+            .order_by(SJTURefund.id)
+            .limit(REFUND_CHUNK_SIZE)
+            .all())
+
+
+@celery.task(plugin='payment_sjtu')
+def run_refund_batch(batch_id):
+    """Submit the unfinished refunds of a batch to SJTU Pay."""
+    if not lock_refund_batch(batch_id):
+        # another worker is running the batch
+        return
+    try:
+        batch = SJTURefundBatch.get(batch_id)
+        if batch is None or batch.is_finished:
+            return
+        feeitemid = get_event_settings(batch.regform.event)['feeitemid']
+        limiter = RateLimiter(REFUNDS_PER_SECOND)
+        after_id = 0
+        while refunds := _get_unfinished_refunds(batch, after_id):
+            after_id = refunds[-1].id
+            # refunds submitted without a recorded answer may have gone through
+            submitted = [refund for refund in refunds if refund.state == RefundState.submitted]
+            for refund, refunded in zip(submitted, _query_refunded_bills(submitted, limiter)):
+                _settle_refund(refund, refunded)
+            pending = [refund for refund in refunds if refund.state == RefundState.pending]
+            for refund in pending:
+                refund.state = RefundState.submitted
+            db.session.commit()
+            for refund, result in zip(pending, _submit_refunds(pending, feeitemid, limiter)):
+                _record_refund(refund, result)
+            db.session.commit()
+            refresh_refund_batch_lock(batch_id)
+        if _query_unfinished_refunds(batch).has_rows():
+            # the batch is resumed until the portal tells what became of them
+            current_plugin.logger.info('Refund: batch %d has unsettled refunds', batch_id)
+            return
+        batch.finished_dt = now_utc()
+        db.session.commit()
+        current_plugin.logger.info('Refund: batch %d finished', batch_id)
+    finally:
+        unlock_refund_batch(batch_id)
+
+
+@celery.periodic_task(run_every=crontab(minute='*/5'), plugin='payment_sjtu')
+def resume_refund_batches():
+    """Resume the refund batches interrupted by a crashed worker."""
+    for batch_id, in db.session.query(SJTURefundBatch.id).filter(SJTURefundBatch.finished_dt.is_(None)):
+        run_refund_batch.delay(batch_id)
+
+
+class _DeadLetter(Exception):
+    """A callback which will never be processed successfully."""
+
+
+def _process_callback(callback, seen_trades):
+    try:
+        payment_result = parse_pay_result(callback.raw_data).fields
+    except SJTUPayloadError as exc:
+        raise _DeadLetter(f'Invalid payment result: {exc}') from exc
+    trade_no = payment_result.get('trade_no')
+    reconciler = SJTUReconciler(callback.registration)
+    if trade_no not in seen_trades and not reconciler._lock_registration():
+        # retried by the next run, once the payment has been registered
+        payment_lock_conflicts.inc(handler='outbox')
+        return CallbackState.pending
+    if trade_no in seen_trades or reconciler._is_transaction_duplicated(trade_no):
+        duplicate_payments.inc(handler='outbox')
+        return CallbackState.duplicate
+    if not reconciler._verify_amount(float(payment_result['billamt'])):
+        raise _DeadLetter('Payment amount error')
+    reconciler._register_transaction(payment_result)
+    seen_trades.add(trade_no)
+    return CallbackState.processed
+
+
+def _drain_callback(callback, seen_trades):
+    callback.attempts += 1
+    try:
+        with db.session.begin_nested():
+            callback.state = _process_callback(callback, seen_trades)
+    except _DeadLetter as exc:
+        callback.state = CallbackState.failed
+        callback.error = str(exc)
+    except Exception as exc:
+        current_plugin.logger.exception('Outbox: processing %r failed', callback)
+        callback.error = repr(exc)
+        if callback.attempts >= OUTBOX_MAX_ATTEMPTS:
+            callback.state = CallbackState.failed
+    else:
+        callback.error = None
+    if callback.state != CallbackState.pending:
+        callback.processed_dt = now_utc()
+
+
+def _get_pending_callbacks(after_id):
+    # locked rows are being drained by another worker
+    return (SJTUCallback.query
+            .filter(SJTUCallback.state == CallbackState.pending,
+                    SJTUCallback.id > after_id)
+            .order_by(SJTUCallback.id)
+            .limit(OUTBOX_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+            .all())
+
+
+@celery.periodic_task(run_every=crontab(minute='*'), plugin='payment_sjtu')
+def drain_callback_outbox():
+    """Register the payments of the callbacks stored in fast-ack mode."""
+    last_id = 0
+    # callbacks failing temporarily are retried by the next run
+    while callbacks := _get_pending_callbacks(last_id):
+        seen_trades = set()
+        for callback in callbacks:
+            _drain_callback(callback, seen_trades)
+        last_id = callbacks[-1].id
+        db.session.commit()
+        current_plugin.logger.info('Outbox: %d callbacks drained', len(callbacks))
+
+
+def _send_queued_email(queued, attachments, limiter):
+    queued.attempts += 1
+    try:
+        with db.session.begin_nested():
+            registration = queued.registration
+            mail = load_email(queued.email)
+            mail['attachments'] = attachments.get(registration, ticket=queued.attach_ticket,
+                                                  ical=queued.attach_ical)
+            limiter.wait()
+            send_email(mail, event=registration.event, module='Registration', user=queued.user,
+                       log_metadata={'registration_id': registration.id})
+    except Exception as exc:
+        current_plugin.logger.exception('Emails: sending %r failed', queued)
+        queued.error = repr(exc)
+        if queued.attempts >= EMAIL_MAX_ATTEMPTS:
+            queued.state = EmailState.failed
+    else:
+        queued.state = EmailState.sent
+        queued.error = None
+        queued.sent_dt = now_utc()
+
+
+def _get_pending_emails(after_id, limit):
+    # locked rows are being sent by another worker
+    return (SJTUQueuedEmail.query
+            .filter(SJTUQueuedEmail.state == EmailState.pending,
+                    SJTUQueuedEmail.id > after_id)
+            .order_by(SJTUQueuedEmail.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .options(selectinload(SJTUQueuedEmail.registration))
+            .all())
+
+
+@celery.periodic_task(run_every=crontab(minute='*'), plugin='payment_sjtu')
+def send_queued_emails():
+    """Add the attachments to the queued registration emails and send them."""
+    if not lock_email_queue():
+        # another worker is sending the emails
+        return
+    try:
+        attachments = RegistrationAttachments()
+        limiter = RateLimiter(EMAILS_PER_SECOND)
+        budget = MAX_EMAILS_PER_RUN
+        last_id = 0
+        # emails failing temporarily are retried by the next run
+        while budget > 0 and (emails := _get_pending_emails(last_id, min(EMAIL_BATCH_SIZE, budget))):
+            for queued in emails:
+                _send_queued_email(queued, attachments, limiter)
+            last_id = emails[-1].id
+            budget -= len(emails)
+            db.session.commit()
+            refresh_email_queue_lock()
+            current_plugin.logger.info('Emails: %d queued emails sent', len(emails))
+    finally:
+        unlock_email_queue()
+    if budget <= 0:
+        # leave the worker to other tasks before sending the rest
+        send_queued_emails.apply_async(countdown=EMAIL_SEND_DELAY)
@@ -0,0 +1,82 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Pytest fixtures for testing the plugin against the portal simulator."""
+
+import itertools
+
+import pytest
+
+from indico.modules.events.registration.models.registrations import Registration, RegistrationState
+
+from indico_payment_sjtu.patches import apply_patches
+from indico_payment_sjtu.plugin import SJTUPaymentPlugin
+from indico_payment_sjtu.settings import settings_cache
+from indico_payment_sjtu.testing.portal import SJTUPortalSimulator
+
+
+__all__ = ('sjtu_patches', 'sjtu_tasks', 'sjtu_portal', 'sjtu_event', 'create_sjtu_registration', 'sjtu_registration')
+
+SJTU_TASKS = ('prerender_invoice_pdf', 'prefetch_sjtu_tickets', 'run_refund_batch', 'drain_callback_outbox',
+              'send_queued_emails')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def sjtu_patches():
+    """Apply the monkey patches, which the plugin only does when the application is created."""
+    return apply_patches()
+
+
+@pytest.fixture(autouse=True)
+def sjtu_tasks(mocker):
+    """Record the background tasks queued by the plugin instead of sending them to celery.
+
+    :return: A dict mapping task names to the mocked ``apply_async``
+    """
+    return {name: mocker.patch(f'indico_payment_sjtu.tasks.{name}.apply_async') for name in SJTU_TASKS}
+
+
+@pytest.fixture
+def sjtu_portal():
+    """A local SJTU Pay portal simulator running in a background thread."""
+    portal = SJTUPortalSimulator(sysid='sysid', subsysid='subsysid', cert='cert')
+    with portal.serve():
+        yield portal
+
+
+@pytest.fixture
+def sjtu_event(db, dummy_event, sjtu_portal):
+    """An event with SJTU Pay enabled, using the portal simulator."""
+    SJTUPaymentPlugin.settings.set_multi({'url': sjtu_portal.url, 'cert': 'cert', 'portal_retries': 0})
+    SJTUPaymentPlugin.event_settings.set_multi(dummy_event, {'enabled': True, 'sysid': 'sysid',
+                                                             'subsysid': 'subsysid', 'feeitemid': '1'})
+    settings_cache.clear()
+    yield dummy_event
+    settings_cache.clear()
+
+
+@pytest.fixture
+def create_sjtu_registration(db, sjtu_event, dummy_regform):
+    """Return a callable creating unpaid registrations of 100 CNY."""
+    counter = itertools.count(1)
+
+    def _create():
+        num = next(counter)
+        registration = Registration(registration_form=dummy_regform, first_name='Guinea', last_name=f'Pig {num}',
+                                    email=f'guinea.pig{num}@example.com', currency='CNY', base_price=100,
+                                    state=RegistrationState.unpaid)
+        db.session.add(registration)
+        db.session.flush()
+        return registration
+
+    return _create
+
+
+@pytest.fixture
+def sjtu_registration(create_sjtu_registration):
+    """An unpaid registration of 100 CNY in an event using SJTU Pay."""
+    return create_sjtu_registration()
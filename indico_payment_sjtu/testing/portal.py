@@ -0,0 +1,287 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""A stand-in for the SJTU Pay portal.
+
+It implements the actions used by the plugin (``pay.action``,
+``Query_PayQuery.action``, ``appRefund.action`` and ``TicketQuery.action``),
+signs its responses with the same MD5 scheme and sends the payment result
+to the success and callback URLs, so the payment flow can be tested and
+load-tested without the real portal.
+
+Use :meth:`SJTUPortalSimulator.serve` in tests, or run it standalone::
+
+    python -m indico_payment_sjtu.testing.portal --port 8001 --cert secret \\
+        --callback-url https://indico.example.com/payment/sjtu/callback
+"""
+
+import argparse
+import random
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import requests
+
+from indico_payment_sjtu.codec import serialize
+from indico_payment_sjtu.signing import SJTUSigner
+
+PAY_PATH = '/payment/pay/pay.action'
+QUERY_PATH = '/payment/portal/Query_PayQuery.action'
+REFUND_PATH = '/payment/portal/appRefund.action'
+TICKET_PATH = '/payment_dzp/portal/TicketQuery.action'
+
+PAYSTATE_UNPAID = '1'
+PAYSTATE_PAID = '4'
+# the plugin only relies on a refunded bill no longer being reported as paid
+PAYSTATE_REFUNDED = '5'
+
+
+class Bill:
+    __slots__ = ('billno', 'billamt', 'paystate', 'trade_no')
+
+    def __init__(self, billno, billamt):
+        self.billno = billno
+        self.billamt = billamt
+        self.paystate = PAYSTATE_UNPAID
+        self.trade_no = None
+
+    @property
+    def paid(self):
+        return self.paystate == PAYSTATE_PAID
+
+    @property
+    def refunded(self):
+        return self.paystate == PAYSTATE_REFUNDED
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class SJTUPortalSimulator:
+    """WSGI application simulating the SJTU Pay portal.
+
+    :param sysid: The sysid accepted by the portal
+    :param subsysid: The subsysid accepted by the portal
+    :param cert: The cert used to sign requests and responses
+    :param latency: Seconds added to every response; a ``(min, max)``
+                    tuple picks a random latency in that range
+    :param error_rate: Fraction of requests answered with a HTTP 500
+    :param duplicate_callbacks: How many extra times the payment result of
+                                a bill is sent to `callback_url`
+    :param callback_url: The URL notified about payments (the plugin's
+                         ``payment_sjtu.callback`` endpoint)
+    :param seed: Seed for the random latency and errors
+    """
+
+    def __init__(self, sysid='sysid', subsysid='subsysid', cert='cert', latency=0, error_rate=0,
+                 duplicate_callbacks=0, callback_url=None, seed=None):
+        self.sysid = sysid
+        self.subsysid = subsysid
+        self.signer = SJTUSigner(sysid, subsysid, cert)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.duplicate_callbacks = duplicate_callbacks
+        self.callback_url = callback_url
+        self.bills = {}
+        #: number of requests received per action path
+        self.requests = Counter()
+        #: HTTP status codes (or exceptions) of the callbacks sent
+        self.callback_results = []
+        self.url = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._trade_counter = 0
+        self._routes = {
+            PAY_PATH: self._pay_action,
+            QUERY_PATH: self._query_action,
+            REFUND_PATH: self._refund_action,
+            TICKET_PATH: self._ticket_action,
+        }
+
+    # state
+
+    def add_bill(self, billno, billamt):
+        with self._lock:
+            return self.bills.setdefault(billno, Bill(billno, billamt))
+
+    def pay(self, billno, billamt):
+        """Mark a bill as paid.
+
+        :return: The ``(sign, data)`` pair of the payment result, as it is
+                 sent to the success and callback URLs
+        """
+        bill = self.add_bill(billno, billamt)
+        with self._lock:
+            if bill.paystate == PAYSTATE_UNPAID:
+                self._trade_counter += 1
+                bill.paystate = PAYSTATE_PAID
+                bill.trade_no = f'{datetime.now():%Y%m%d}{self._trade_counter:08d}'
+        data = serialize('payResult', {'billno': bill.billno, 'billamt': bill.billamt, 'trade_no': bill.trade_no,
+                                       'paytime': f'{datetime.now():%Y%m%d%H%M%S}'})
+        return self.signer.sign(data), data
+
+    def send_callbacks(self, sign, data):
+        """Send a payment result to the callback URL (including duplicates)."""
+        for __ in range(1 + self.duplicate_callbacks):
+            try:
+                response = requests.post(self.callback_url, data={'sign': sign, 'data': urllib.parse.quote_plus(data)},
+                                         timeout=10)
+                self.callback_results.append(response.status_code)
+            except requests.RequestException as exc:
+                self.callback_results.append(exc)
+
+    # wsgi
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        handler = self._routes.get(path)
+        if handler is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+        self.requests[path] += 1
+        self._sleep()
+        if self.error_rate and self._random.random() < self.error_rate:
+            start_response('500 Internal Server Error', [('Content-Type', 'text/plain')])
+            return [b'Internal Server Error']
+        params = dict(urllib.parse.parse_qsl(environ.get('QUERY_STRING', '')))
+        if environ.get('REQUEST_METHOD') == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            params.update(urllib.parse.parse_qsl(environ['wsgi.input'].read(length).decode('utf-8')))
+        status, headers, body = handler(params)
+        start_response(status, headers)
+        return [body.encode('utf-8')]
+
+    def _sleep(self):
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = self._random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def _check_sign(self, params, data):
+        return (params.get('sysid') == self.sysid and params.get('subsysid') == self.subsysid and
+                self.signer.verify(data, params.get('sign')))
+
+    def _signed_response(self, xml, quote=False):
+        body = f'{self.signer.sign(xml)}@{urllib.parse.quote_plus(xml) if quote else xml}'
+        return '200 OK', [('Content-Type', 'text/plain; charset=utf-8')], body
+
+    def _query_result(self, returncode, returnmsg, **extra):
+        return serialize('QueryResult', {'State': {'returncode': returncode, 'returnmsg': returnmsg}, **extra})
+
+    def _pay_action(self, params):
+        data = params.get('data', '')
+        if not self._check_sign(params, data):
+            return '400 Bad Request', [('Content-Type', 'text/plain')], 'sign error'
+        billinfo = ET.fromstring(data)
+        sign, result = self.pay(billinfo.findtext('billno'), billinfo.findtext('billdtl/amt'))
+        if self.callback_url:
+            threading.Thread(target=self.send_callbacks, args=(sign, result), daemon=True).start()
+        location = '{}?{}'.format(billinfo.findtext('returnURL'), urllib.parse.urlencode({'sign': sign,
+                                                                                        'data': result}))
+        return '302 Found', [('Location', location)], ''
+
+    def _query_action(self, params):
+        billno = params.get('billno', '')
+        if not self._check_sign(params, billno):
+            return self._signed_response(self._query_result('9999', 'sign error'))
+        bill = self.bills.get(billno)
+        if bill is None:
+            return self._signed_response(self._query_result('0000', 'success', Billinfo=''))
+        detail = {'billno': bill.billno, 'billamt': bill.billamt, 'paystate': bill.paystate}
+        if bill.trade_no:
+            detail['trade_no'] = bill.trade_no
+        return self._signed_response(self._query_result('0000', 'success', Billinfo={'billdetail': detail}))
+
+    def _refund_action(self, params):
+        data = params.get('data', '')
+        if not self._check_sign(params, data):
+            return self._signed_response(serialize('refundResult', {'refundState': '0', 'errorMsg': 'sign error'}),
+                                         quote=True)
+        refund = ET.fromstring(data)
+        bill = self.bills.get(refund.findtext('billno'))
+        if bill is not None and bill.refunded:
+            error = 'bill already refunded'
+        elif bill is None or not bill.paid:
+            error = 'bill not paid'
+        elif float(refund.findtext('billamt')) != float(bill.billamt):
+            error = 'amount error'
+        else:
+            bill.paystate = PAYSTATE_REFUNDED
+            error = None
+        result = {'refundState': '0' if error else '1', 'errorMsg': error or ''}
+        return self._signed_response(serialize('refundResult', result), quote=True)
+
+    def _ticket_action(self, params):
+        billno = params.get('billno', '')
+        if not self._check_sign(params, billno):
+            return self._signed_response(self._query_result('9999', 'sign error'))
+        bill = self.bills.get(billno)
+        if bill is None or not bill.paid:
+            return self._signed_response(self._query_result('0000', 'success', Tickets=''))
+        ticket = {'type_no': '1002', 'tk_typename': '中央非税收入统一票据_电子票', 'taxtickettype': '00010118',
+                  'ticket_no': bill.trade_no, 'key': 'abc123', 'feeitemdeford': '1', 'feeitemname': '会议费',
+                  'payamt': bill.billamt}
+        return self._signed_response(self._query_result('0000', 'success', Tickets={'tkinfo': ticket}))
+
+    @contextmanager
+    def serve(self, host='127.0.0.1', port=0):
+        """Run the portal in a background thread.
+
+        :return: A context manager yielding the base URL of the portal
+        """
+        server = make_server(host, port, self, server_class=_ThreadingWSGIServer,
+                             handler_class=_QuietRequestHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.url = f'http://{host}:{server.server_port}'
+        try:
+            yield self.url
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local SJTU Pay portal simulator.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--sysid', default='sysid')
+    parser.add_argument('--subsysid', default='subsysid')
+    parser.add_argument('--cert', default='cert')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with HTTP 500')
+    parser.add_argument('--duplicate-callbacks', type=int, default=0)
+    parser.add_argument('--callback-url', help='the URL of the payment_sjtu.callback endpoint')
+    args = parser.parse_args()
+    portal = SJTUPortalSimulator(args.sysid, args.subsysid, args.cert, latency=args.latency,
+                                 error_rate=args.error_rate, duplicate_callbacks=args.duplicate_callbacks,
+                                 callback_url=args.callback_url)
+    with portal.serve(args.host, args.port) as url:
+        print(f'SJTU Pay simulator running on {url}')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,12 @@
 # see the LICENSE file for more details.
 
 import re
-from uuid import UUID
-import base64
 
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from wtforms import ValidationError
 
+from indico.core.db import db
 from indico.util.string import is_valid_mail
 
 from indico_payment_sjtu import _
@@ -25,9 +26,27 @@ def validate_business(form, field):
         raise ValidationError(_('Invalid email address / paypal ID'))
 
 
-def uuid_to_billno(token):
-    # we use base64 encode here because sjtu payment only supports billno <= 30 characters,
-    # but uuid is longer than the limit
-    token = UUID(token)
-    b64_token = base64.urlsafe_b64encode(token.bytes).decode("ascii")
-    return b64_token
+
+def call_after_commit(func):
+    """Call `func` once the current transaction has been committed.
+
+    Tasks processing the rows written by a request are queued that way,
+    so they cannot run before the rows are visible to them.  Nothing is
+    called if the transaction is rolled back, and a function registered
+    several times in a transaction is only called once.
+    """
+    callbacks = db.session().info.setdefault('payment_sjtu_after_commit', [])
+    if func not in callbacks:
+        callbacks.append(func)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for func in session.info.pop('payment_sjtu_after_commit', []):
+        func()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('payment_sjtu_after_commit', None)
@@ -0,0 +1,61 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import uuid
+
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from indico_payment_sjtu.billno import (InvalidBillNumber, billno_to_uuid, billnos_to_uuids, is_valid_billno,
+                                        uuid_to_billno, uuids_to_billnos)
+from indico_payment_sjtu.controllers import RHSJTUBase
+from indico_payment_sjtu.models.bills import SJTUBill
+from indico_payment_sjtu.plugin import SJTUPaymentPlugin
+
+
+def test_billno_round_trip():
+    tokens = [str(uuid.uuid4()) for __ in range(100)]
+    billnos = uuids_to_billnos(tokens)
+    assert all(len(billno) == 24 and is_valid_billno(billno) for billno in billnos)
+    assert billnos_to_uuids(billnos) == tokens
+    assert uuid_to_billno(uuid.UUID(tokens[0])) == billnos[0]
+
+
+@pytest.mark.parametrize('billno', (
+    None,
+    '',
+    'abc',
+    'AAAAAAAAAAAAAAAAAAAAAA',
+    'AAAAAAAAAAAAAAAAAAAAAA=',
+    'AAAAAAAAAAAAAAAAAAAAAA===',
+    'AAAAAAAAAAAAAAAAAAAA+A==',
+    'AAAAAAAAAAAAAAAAAAAAA/==',
+    # unused bits set, this would decode to the same uuid as AAAAAAAAAAAAAAAAAAAAAA==
+    'AAAAAAAAAAAAAAAAAAAAAB==',
+))
+def test_invalid_billno(billno):
+    assert not is_valid_billno(billno)
+    with pytest.raises(InvalidBillNumber):
+        billno_to_uuid(billno)
+
+
+@pytest.mark.usefixtures('request_context')
+def test_init_registration(db, sjtu_registration, create_sjtu_registration):
+    rh = RHSJTUBase()
+    with SJTUPaymentPlugin.instance.plugin_context():
+        # no stored bill number, the registration is found by its uuid
+        rh._init_registration(uuid_to_billno(sjtu_registration.uuid))
+        assert rh.registration == sjtu_registration
+        other = create_sjtu_registration()
+        db.session.add(SJTUBill(registration=other, billno=uuid_to_billno(other.uuid)))
+        db.session.flush()
+        rh._init_registration(uuid_to_billno(other.uuid))
+        assert rh.registration == other
+        with pytest.raises(BadRequest):
+            rh._init_registration(uuid_to_billno(str(uuid.uuid4())))
+        with pytest.raises(BadRequest):
+            rh._init_registration('not a bill number')
@@ -0,0 +1,69 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import pytest
+
+from indico_payment_sjtu.codec import (SJTUPayloadError, parse_pay_result, parse_query_result, parse_refund_result,
+                                       serialize_billinfo, serialize_refund)
+
+
+def test_parse_pay_result():
+    result = parse_pay_result('<?xml version="1.0" encoding="GBK"?><payResult><billno>abc</billno>'
+                              '<billamt>12.00</billamt><trade_no>T1</trade_no><remark/></payResult>')
+    assert result.billno == 'abc'
+    assert result.billamt == '12.00'
+    assert result.trade_no == 'T1'
+    assert result.fields == {'billno': 'abc', 'billamt': '12.00', 'trade_no': 'T1', 'remark': None}
+
+
+@pytest.mark.parametrize('data', (
+    '<payResult><billno>abc</billno>',
+    '<payResult><billamt>1</billamt></payResult>',
+    '<QueryResult></QueryResult>',
+))
+def test_parse_pay_result_invalid(data):
+    with pytest.raises(SJTUPayloadError):
+        parse_pay_result(data)
+
+
+@pytest.mark.parametrize('data', (
+    '<!DOCTYPE payResult [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>'
+    '<payResult><billno>&b;</billno><billamt>1</billamt></payResult>',
+    '<?xml version="1.0" encoding="GBK"?><!DOCTYPE payResult [<!ENTITY x SYSTEM "file:///etc/passwd">]>'
+    '<payResult><billno>&x;</billno><billamt>1</billamt></payResult>',
+))
+def test_parse_pay_result_entities(data):
+    with pytest.raises(SJTUPayloadError):
+        parse_pay_result(data)
+
+
+@pytest.mark.parametrize(('billinfo', 'count'), (
+    ('<Billinfo/>', 0),
+    ('<Billinfo><billdetail><billno>a</billno><paystate>4</paystate></billdetail></Billinfo>', 1),
+    ('<Billinfo><billdetail><billno>a</billno></billdetail><billdetail><billno>a</billno></billdetail></Billinfo>', 2),
+))
+def test_parse_query_result(billinfo, count):
+    result = parse_query_result('<QueryResult><State><returncode>0000</returncode><returnmsg>ok</returnmsg></State>'
+                                f'{billinfo}</QueryResult>')
+    assert result.success
+    assert len(result.billdetails) == count
+    assert all(detail['billno'] == 'a' for detail in result.billdetails)
+    assert result.tickets == ()
+
+
+def test_parse_refund_result():
+    result = parse_refund_result('<refundResult><refundState>0</refundState><errorMsg>退款失败</errorMsg></refundResult>')
+    assert not result.success
+    assert result.error_msg == '退款失败'
+
+
+def test_serialize():
+    xml = serialize_billinfo({'billno': 'a&b', 'billdtl': {'unit': '项', 'amt': 1.5}, 'tax_code': ''})
+    assert xml == ('<?xml version="1.0" encoding="GBK"?><billinfo><billdtl><amt>1.5</amt><unit>项</unit></billdtl>'
+                   '<billno>a&amp;b</billno><tax_code></tax_code></billinfo>')
+    # characters which do not exist in GBK become character references
+    assert serialize_refund({'reason': '😀'}) == '<?xml version="1.0" encoding="GBK"?><refundBoll><reason>&#128512;</reason></refundBoll>'
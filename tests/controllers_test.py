@@ -5,101 +5,271 @@
 # them and/or modify them under the terms of the MIT License;
 # see the LICENSE file for more details.
 
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock
 
 import pytest
 from flask import request
 
 from indico.modules.events.payment.models.transactions import PaymentTransaction
+from indico.modules.events.registration.models.registrations import RegistrationState
 
-from indico_payment_sjtu.controllers import RHSJTUIPN
+from indico_payment_sjtu.billno import uuid_to_billno
+from indico_payment_sjtu.cache import forget_tickets, get_query_result, get_tickets, query_cache
+from indico_payment_sjtu.controllers import RHSJTUBase, RHSJTUCallback, RHSJTUQuery, RHSJTURefund
+from indico_payment_sjtu.models.callbacks import CallbackState, SJTUCallback
+from indico_payment_sjtu.models.transactions import SJTUTransaction
 from indico_payment_sjtu.plugin import SJTUPaymentPlugin
+from indico_payment_sjtu.refunds import create_refund_batch
+from indico_payment_sjtu.settings import settings_cache
+from indico_payment_sjtu.tasks import drain_callback_outbox
+from indico_payment_sjtu.testing.portal import QUERY_PATH, REFUND_PATH, TICKET_PATH
+from indico_payment_sjtu.util import _after_commit
+
+
+@pytest.mark.usefixtures('request_context')
+@pytest.mark.parametrize(('amount', 'expected'), (
+    (13.37, True),
+    (10.00, False),
+    (0,     False),
+))
+def test_verify_amount(amount, expected):
+    rh = RHSJTUBase()
+    rh.registration = MagicMock(price=13.37, currency='CNY')
+    with SJTUPaymentPlugin.instance.plugin_context():
+        assert rh._verify_amount(amount) == expected
 
 
 @pytest.mark.usefixtures('db', 'request_context')
-@pytest.mark.parametrize(('formdata', 'expected'), (
-    ({'business': 'test'},       True),
-    ({'receiver_id': 'test'},    True),
-    ({'receiver_email': 'test'}, True),
-    ({'business': 'foo'},        False),
-    ({},                         False)
+@pytest.mark.parametrize(('trade_no', 'expected'), (
+    ('12345',  True),
+    ('123456', False),
+    (None,     False),
+    ('',       False),
 ))
-def test_ipn_verify_business(formdata, expected, dummy_event):
-    rh = RHSJTUIPN()
+def test_is_transaction_duplicated(trade_no, expected):
+    rh = RHSJTUBase()
     rh.registration = MagicMock()
-    rh.registration.registration_form.event = dummy_event
-    SJTUPaymentPlugin.event_settings.set(dummy_event, 'business', 'TeST')
-    request.form = formdata
+    rh.registration.transaction = None
+    assert not rh._is_transaction_duplicated(trade_no)
+    rh.registration.transaction = PaymentTransaction(provider='sjtu', data={'trade_no': '12345'})
+    assert rh._is_transaction_duplicated(trade_no) == expected
+    # legacy payment results without a trade number
+    rh.registration.transaction = PaymentTransaction(provider='sjtu', data={})
+    assert not rh._is_transaction_duplicated(trade_no)
+
+
+@pytest.mark.usefixtures('request_context')
+def test_payments_without_trade_no(db, sjtu_portal, create_sjtu_registration):
+    registrations = [create_sjtu_registration() for __ in range(2)]
     with SJTUPaymentPlugin.instance.plugin_context():
-        assert rh._verify_business() == expected
+        for registration in registrations:
+            rh = RHSJTUBase()
+            rh.registration = registration
+            rh._init_plugin_settings()
+            assert not rh._is_transaction_duplicated(None)
+            rh._register_transaction({'billno': uuid_to_billno(registration.uuid), 'billamt': '100.00'})
+            db.session.flush()
+    assert SJTUTransaction.query.filter_by(trade_no=None).count() == 2
+    assert not SJTUTransaction.is_trade_registered(None)
+    assert all(registration.state == RegistrationState.complete for registration in registrations)
 
 
 @pytest.mark.usefixtures('request_context')
-@pytest.mark.parametrize(('amount', 'currency', 'expected'), (
-    ('13.37', 'EUR', True),
-    ('13.37', 'CHF', False),
-    ('10.00', 'CHF', False),
-    ('10.00', 'CHF', False),
-))
-def test_ipn_verify_amount(mocker, amount, currency, expected):
-    nai = mocker.patch('indico_payment_sjtu.controllers.notify_amount_inconsistency')
-    rh = RHSJTUIPN()
-    rh.event = MagicMock(id=1)
-    rh.registration = MagicMock()
-    rh.registration.price = 13.37
-    rh.registration.currency = currency
-    request.form = {'mc_gross': amount, 'mc_currency': 'EUR'}
+def test_query_bill(sjtu_portal, sjtu_registration):
+    billno = uuid_to_billno(sjtu_registration.uuid)
+    rh = RHSJTUQuery()
+    rh.registration = sjtu_registration
     with SJTUPaymentPlugin.instance.plugin_context():
-        assert rh._verify_amount() == expected
-        assert nai.called == (not expected)
+        rh._init_plugin_settings()
+        assert not rh._register_paid_bill(rh._query_sjtu_bill(billno))
+        sjtu_portal.pay(billno, '100.00')
+        assert rh._register_paid_bill(rh._query_sjtu_bill(billno))
+    assert sjtu_portal.requests[QUERY_PATH] == 2
+    assert sjtu_registration.state == RegistrationState.complete
+    assert sjtu_registration.transaction.data['trade_no'] == sjtu_portal.bills[billno].trade_no
 
 
 @pytest.mark.usefixtures('request_context')
-@pytest.mark.parametrize(('txn_id', 'payment_status', 'expected'), (
-    ('12345',  'Completed', True),
-    ('12345',  'Pending',   False),
-    ('123456', 'Completed', False),
-    ('123456', 'Pending',   False),
-))
-def test_ipn_is_transaction_duplicated(txn_id, payment_status, expected):
-    request.form = {'payment_status': 'Completed', 'txn_id': '12345'}
-    rh = RHSJTUIPN()
-    rh.registration = MagicMock()
-    rh.registration.transaction = None
-    assert not rh._is_transaction_duplicated()
-    transaction = PaymentTransaction(provider='sjtu', data={'payment_status': payment_status, 'txn_id': txn_id})
-    rh.registration.transaction = transaction
-    assert rh._is_transaction_duplicated() == expected
+def test_callback(sjtu_portal, sjtu_registration):
+    sign, data = sjtu_portal.pay(uuid_to_billno(sjtu_registration.uuid), '100.00')
+    request.args = {}
+    request.form = {'sign': sign, 'data': urllib.parse.quote_plus(data)}
+    # the portal may send the same callback several times
+    for __ in range(3):
+        rh = RHSJTUCallback()
+        with SJTUPaymentPlugin.instance.plugin_context():
+            rh._process_args()
+            assert rh._process() == '1'
+    assert sjtu_registration.state == RegistrationState.complete
+    assert SJTUTransaction.query.filter_by(registration=sjtu_registration).count() == 1
 
 
-@pytest.mark.usefixtures('db', 'request_context')
-@pytest.mark.parametrize('fail', (
-    'verify',
-    'dup_txn',
-    'fail',
-    'refund',
-    'negative',
-    'status',
-    None,
-))
-def test_ipn_process(mocker, fail):
-    rt = mocker.patch('indico_payment_sjtu.controllers.register_transaction')
-    post = mocker.patch('indico_payment_sjtu.controllers.requests.post')
-    mocker.patch('indico_payment_sjtu.controllers.notify_amount_inconsistency')
-    post.return_value.text = 'INVALID' if fail == 'verify' else 'VERIFIED'
-    rh = RHSJTUIPN()
-    rh._verify_business = MagicMock()
-    rh._is_transaction_duplicated = lambda: fail == 'dup_txn'
-    rh.event = MagicMock(id=1)
-    rh.registration = MagicMock()
-    rh.registration.getTotal.return_value = 10.00
-    payment_status = {'fail': 'Failed', 'refund': 'Refunded', 'status': 'Foobar'}.get(fail, 'Completed')
-    amount = '-10.00' if fail == 'negative' else '10.00'
-    request.view_args = {'event_id': rh.event.id}
-    request.args = {'registrantId': '1'}
-    request.form = {'payment_status': payment_status, 'txn_id': '12345', 'mc_gross': amount,
-                    'mc_currency': 'EUR', 'business': 'foo@bar.com'}
+@pytest.mark.usefixtures('request_context')
+def test_refund(mocker, sjtu_portal, sjtu_registration):
+    mocker.patch('indico_payment_sjtu.controllers.url_for', return_value='/')
+    flash = mocker.patch('indico_payment_sjtu.controllers.flash')
+    billno = uuid_to_billno(sjtu_registration.uuid)
+    sjtu_portal.pay(billno, '100.00')
+    rh = RHSJTURefund()
+    rh.registration = sjtu_registration
+    with SJTUPaymentPlugin.instance.plugin_context():
+        rh._init_plugin_settings()
+        assert rh._register_paid_bill(rh._query_sjtu_bill(billno))
+        rh._process_POST()
+    assert flash.call_args[0][1] == 'info'
+
+
+@pytest.mark.usefixtures('request_context')
+def test_refund_during_bulk_refund(mocker, dummy_user, sjtu_portal, sjtu_registration):
+    mocker.patch('indico_payment_sjtu.controllers.url_for', return_value='/')
+    flash = mocker.patch('indico_payment_sjtu.controllers.flash')
+    billno = uuid_to_billno(sjtu_registration.uuid)
+    sjtu_portal.pay(billno, '100.00')
+    rh = RHSJTURefund()
+    rh.registration = sjtu_registration
+    with SJTUPaymentPlugin.instance.plugin_context():
+        rh._init_plugin_settings()
+        assert rh._register_paid_bill(rh._query_sjtu_bill(billno))
+        create_refund_batch(sjtu_registration.registration_form, [sjtu_registration], dummy_user)
+        rh._process_POST()
+    assert flash.call_args[0][1] == 'warning'
+    assert sjtu_portal.requests[REFUND_PATH] == 0
+
+
+@pytest.mark.usefixtures('request_context')
+def test_refund_timeout_not_retried(sjtu_portal, sjtu_registration):
+    SJTUPaymentPlugin.settings.set_multi({'portal_timeout': 1, 'portal_retries': 2})
+    settings_cache.clear()
+    billno = uuid_to_billno(sjtu_registration.uuid)
+    sjtu_portal.pay(billno, '100.00')
+    sjtu_portal.latency = 2
+    rh = RHSJTUBase()
+    rh.registration = sjtu_registration
+    with SJTUPaymentPlugin.instance.plugin_context():
+        rh._init_plugin_settings()
+        assert rh._refund_sjtu_bill(billno, '100.00', '1') is None
+    # the portal may still carry out a refund whose answer timed out, so it must not be sent again
+    assert sjtu_portal.requests[REFUND_PATH] == 1
+    assert sjtu_portal.bills[billno].refunded
+
+
+@pytest.mark.usefixtures('request_context')
+def test_query_tickets(sjtu_portal, sjtu_registration):
+    billno = uuid_to_billno(sjtu_registration.uuid)
+    rh = RHSJTUBase()
+    rh.registration = sjtu_registration
+    with SJTUPaymentPlugin.instance.plugin_context():
+        rh._init_plugin_settings()
+        assert get_tickets(billno, lambda: rh._query_sjtu_tickets(billno)) == []
+        sjtu_portal.pay(billno, '100.00')
+        # "not issued yet" is cached
+        assert get_tickets(billno, lambda: rh._query_sjtu_tickets(billno)) == []
+        forget_tickets(billno)
+        tickets = get_tickets(billno, lambda: rh._query_sjtu_tickets(billno))
+        assert get_tickets(billno, lambda: rh._query_sjtu_tickets(billno)) == tickets
+    assert [ticket['payamt'] for ticket in tickets] == ['100.00']
+    assert sjtu_portal.requests[TICKET_PATH] == 2
+
+
+@pytest.mark.usefixtures('request_context')
+def test_callback_fast_ack(db, sjtu_tasks, sjtu_portal, sjtu_registration):
+    SJTUPaymentPlugin.settings.set('callback_fast_ack', True)
+    settings_cache.clear()
+    sign, data = sjtu_portal.pay(uuid_to_billno(sjtu_registration.uuid), '100.00')
+    request.args = {}
+    for form in ({'sign': 'invalid', 'data': urllib.parse.quote_plus(data)},
+                 {'sign': sign, 'data': urllib.parse.quote_plus(data)},
+                 {'sign': sign, 'data': urllib.parse.quote_plus(data)}):
+        request.form = form
+        rh = RHSJTUCallback()
+        with SJTUPaymentPlugin.instance.plugin_context():
+            rh._process_args()
+            rh._process()
+    # the invalid callback is rejected before it reaches the outbox
+    assert SJTUCallback.query.count() == 2
+    assert sjtu_registration.state == RegistrationState.unpaid
+    # the draining is only scheduled once the callbacks are committed
+    assert not sjtu_tasks['drain_callback_outbox'].called
+    _after_commit(db.session())
+    assert sjtu_tasks['drain_callback_outbox'].called
+    with SJTUPaymentPlugin.instance.plugin_context():
+        drain_callback_outbox()
+    assert sjtu_registration.state == RegistrationState.complete
+    assert ({callback.state for callback in SJTUCallback.query} ==
+            {CallbackState.processed, CallbackState.duplicate})
+    assert SJTUTransaction.query.filter_by(registration=sjtu_registration).count() == 1
+
+
+@pytest.mark.usefixtures('request_context')
+def test_concurrent_callbacks(db, sjtu_portal, sjtu_registration):
+    workers = 16
+    sign, data = sjtu_portal.pay(uuid_to_billno(sjtu_registration.uuid), '100.00')
+    request.args = {}
+    request.form = {'sign': sign, 'data': urllib.parse.quote_plus(data)}
+
+    def _callback():
+        rh = RHSJTUCallback()
+        with SJTUPaymentPlugin.instance.plugin_context():
+            rh._process_args()
+            return rh._process()
+
+    # the callbacks of many workers try to lock the registration at the same moment
+    barrier = threading.Barrier(workers)
+
+    def _lock(__):
+        with db.engine.connect() as connection, connection.begin():
+            barrier.wait()
+            locked = SJTUTransaction.try_lock_registration(sjtu_registration.id, connection)
+            # keep the lock until all workers tried to get it
+            barrier.wait()
+            return locked
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        assert sorted(executor.map(_lock, range(workers))) == [False] * (workers - 1) + [True]
+
+    # a callback arriving while another worker registers the payment fails fast, so SJTU Pay sends it again
+    with db.engine.connect() as connection, connection.begin():
+        assert SJTUTransaction.try_lock_registration(sjtu_registration.id, connection)
+        assert _callback() == '0'
+        assert sjtu_registration.state == RegistrationState.unpaid
+    assert [_callback() for __ in range(3)] == ['1', '1', '1']
+    assert sjtu_registration.state == RegistrationState.complete
+    assert SJTUTransaction.query.filter_by(registration=sjtu_registration).count() == 1
+
+
+@pytest.mark.usefixtures('request_context')
+def test_query_while_payment_registered(db, sjtu_portal, sjtu_registration):
+    billno = uuid_to_billno(sjtu_registration.uuid)
+    sjtu_portal.pay(billno, '100.00')
+    rh = RHSJTUQuery()
+    rh.registration = sjtu_registration
+    rh.billinfo = {'billno': billno}
+    with SJTUPaymentPlugin.instance.plugin_context():
+        rh._init_plugin_settings()
+        # the outcome is not known while another worker registers the payment, so it is not cached
+        with db.engine.connect() as connection, connection.begin():
+            assert SJTUTransaction.try_lock_registration(sjtu_registration.id, connection)
+            assert get_query_result(billno, rh._is_transaction_success_in_sjtu) is None
+            assert query_cache.get(billno) is None
+            assert sjtu_registration.state == RegistrationState.unpaid
+        assert get_query_result(billno, rh._is_transaction_success_in_sjtu)
+    assert sjtu_registration.state == RegistrationState.complete
+
+
+@pytest.mark.usefixtures('request_context')
+def test_query_paid_cached_after_commit(db, sjtu_portal, sjtu_registration):
+    billno = uuid_to_billno(sjtu_registration.uuid)
+    sjtu_portal.pay(billno, '100.00')
+    rh = RHSJTUQuery()
+    rh.registration = sjtu_registration
+    rh.billinfo = {'billno': billno}
     with SJTUPaymentPlugin.instance.plugin_context():
-        rh._process()
-        assert post.called
-        assert rt.called == (fail is None)
+        rh._init_plugin_settings()
+        assert get_query_result(billno, rh._is_transaction_success_in_sjtu)
+        # the payment registered by the query is not committed yet
+        assert query_cache.get(billno) is None
+        _after_commit(db.session())
+    assert query_cache.get(billno) is True
@@ -0,0 +1,50 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import pytest
+
+from indico.modules.events.ical import MIMECalendar
+from indico.modules.events.registration.models.registrations import RegistrationState
+
+from indico_payment_sjtu.attachments import get_event_ical
+from indico_payment_sjtu.cache import bump_event_version
+from indico_payment_sjtu.models.emails import EmailState, SJTUQueuedEmail
+from indico_payment_sjtu.monkey_patch import notify_registration_state_update
+from indico_payment_sjtu.tasks import send_queued_emails
+from indico_payment_sjtu.util import _after_commit
+
+
+def test_event_ical_cache(mocker, sjtu_event):
+    build = mocker.patch('indico_payment_sjtu.attachments._build_event_ical', return_value=b'BEGIN:VCALENDAR')
+    assert get_event_ical(sjtu_event) == b'BEGIN:VCALENDAR'
+    assert get_event_ical(sjtu_event) == b'BEGIN:VCALENDAR'
+    assert build.call_count == 1
+    bump_event_version(sjtu_event)
+    get_event_ical(sjtu_event)
+    assert build.call_count == 2
+
+
+@pytest.mark.usefixtures('request_context')
+def test_queued_email(db, mocker, sjtu_tasks, dummy_regform, sjtu_registration):
+    mocker.patch('indico_payment_sjtu.attachments._build_event_ical', return_value=b'BEGIN:VCALENDAR')
+    send_email = mocker.patch('indico_payment_sjtu.tasks.send_email')
+    dummy_regform.attach_ical = True
+    notify_registration_state_update(sjtu_registration)
+    queued = SJTUQueuedEmail.query.filter_by(registration=sjtu_registration).one()
+    assert queued.state == EmailState.pending
+    assert not sjtu_tasks['send_queued_emails'].called
+    _after_commit(db.session())
+    assert sjtu_tasks['send_queued_emails'].called
+    # the email shows the registration as it was when the notification was sent
+    sjtu_registration.state = RegistrationState.complete
+    send_queued_emails()
+    assert queued.state == EmailState.sent
+    mail = send_email.call_args.args[0]
+    assert mail['to'] == {sjtu_registration.email}
+    assert 'unpaid' in mail['subject']
+    assert [type(attachment) for attachment in mail['attachments']] == [MIMECalendar]
+
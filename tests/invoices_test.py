@@ -0,0 +1,50 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from indico.modules.events.tracks.models.tracks import Track
+from indico.modules.events.tracks.settings import track_settings
+
+from indico_payment_sjtu.cache import bump_event_version
+from indico_payment_sjtu.invoices import get_invoice_pdf, get_invoice_pdf_etag
+from indico_payment_sjtu.util import _after_commit
+
+
+def test_invoice_pdf_cache(mocker, sjtu_event, sjtu_registration):
+    render = mocker.patch('indico_payment_sjtu.invoices.render_invoice_pdf', return_value=b'%PDF-1.4')
+    etag = get_invoice_pdf_etag(sjtu_registration)
+    assert get_invoice_pdf(sjtu_registration) == b'%PDF-1.4'
+    assert get_invoice_pdf(sjtu_registration) == b'%PDF-1.4'
+    assert render.call_count == 1
+    bump_event_version(sjtu_event)
+    assert get_invoice_pdf_etag(sjtu_registration) != etag
+    get_invoice_pdf(sjtu_registration)
+    assert render.call_count == 2
+
+
+def test_invoice_pdf_shared_by_registrations(mocker, sjtu_registration, create_sjtu_registration):
+    render = mocker.patch('indico_payment_sjtu.invoices.render_invoice_pdf', return_value=b'%PDF-1.4')
+    other_registration = create_sjtu_registration()
+    get_invoice_pdf(sjtu_registration)
+    get_invoice_pdf(other_registration)
+    assert render.call_count == 1
+    assert get_invoice_pdf_etag(sjtu_registration) != get_invoice_pdf_etag(other_registration)
+
+
+def test_invoice_pdf_programme_changed(db, mocker, sjtu_event, sjtu_registration):
+    render = mocker.patch('indico_payment_sjtu.invoices.render_invoice_pdf', return_value=b'%PDF-1.4')
+    get_invoice_pdf(sjtu_registration)
+    # neither changes sends a signal
+    track_settings.set(sjtu_event, 'program', 'New programme')
+    db.session.flush()
+    _after_commit(db.session())
+    get_invoice_pdf(sjtu_registration)
+    assert render.call_count == 2
+    db.session.add(Track(event=sjtu_event, title='Track'))
+    db.session.flush()
+    _after_commit(db.session())
+    get_invoice_pdf(sjtu_registration)
+    assert render.call_count == 3
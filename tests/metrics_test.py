@@ -0,0 +1,41 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import pytest
+
+from indico_payment_sjtu.metrics import Counter, Histogram
+
+
+def test_counter():
+    counter = Counter('sjtu_test_total', 'Test counter.', ('handler',))
+    counter.inc(handler='callback')
+    counter.inc(2, handler='callback')
+    counter.inc(handler='query')
+    assert counter.get(handler='callback') == 3
+    assert counter.render() == [
+        '# HELP sjtu_test_total Test counter.',
+        '# TYPE sjtu_test_total counter',
+        'sjtu_test_total{handler="callback"} 3',
+        'sjtu_test_total{handler="query"} 1',
+    ]
+    with pytest.raises(ValueError):
+        counter.inc(action='query')
+
+
+def test_histogram():
+    histogram = Histogram('sjtu_test_seconds', 'Test histogram.', ('action',), buckets=(0.1, 1))
+    histogram.observe(0.05, action='pay')
+    histogram.observe(0.5, action='pay')
+    histogram.observe(5, action='pay')
+    assert histogram.get_count(action='pay') == 3
+    assert histogram.render()[2:] == [
+        'sjtu_test_seconds_bucket{action="pay",le="0.1"} 1',
+        'sjtu_test_seconds_bucket{action="pay",le="1"} 2',
+        'sjtu_test_seconds_bucket{action="pay",le="+Inf"} 3',
+        'sjtu_test_seconds_sum{action="pay"} 5.55',
+        'sjtu_test_seconds_count{action="pay"} 3',
+    ]
@@ -0,0 +1,115 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from indico.modules.events.registration.lists import RegistrationListGenerator
+from indico.modules.events.registration.models.registrations import Registration, RegistrationState
+
+from indico_payment_sjtu import monkey_patch
+from indico_payment_sjtu.monkey_patch import generate_spreadsheet_from_registrations, query_registrations_for_export
+from indico_payment_sjtu.spreadsheets import send_csv_stream
+
+
+@contextmanager
+def _count_queries(db):
+    queries = []
+
+    def _before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', _before_cursor_execute)
+
+
+def _create_registrations(db, regform, start, count):
+    for i in range(start, start + count):
+        db.session.add(Registration(registration_form=regform, first_name=f'Guinea{i}', last_name='Pig',
+                                    email=f'{i}@example.com', currency='CNY', state=RegistrationState.unpaid))
+    db.session.flush()
+
+
+def _export(db, regform):
+    db.session.expire_all()
+    static_items = ['reg_date', 'state', 'price', 'payment_date', 'tags_present', 'billno', 'trade_no']
+    with _count_queries(db) as queries:
+        registrations = query_registrations_for_export([reg.id for reg in regform.registrations])
+        headers, rows = generate_spreadsheet_from_registrations(registrations, [], static_items)
+        rows = list(rows)
+    return len(rows), len(queries)
+
+
+@pytest.mark.usefixtures('request_context')
+def test_export_query_count_is_constant(db, dummy_regform):
+    _create_registrations(db, dummy_regform, 0, 3)
+    num_rows, few_queries = _export(db, dummy_regform)
+    assert num_rows == 3
+    _create_registrations(db, dummy_regform, 3, 30)
+    num_rows, many_queries = _export(db, dummy_regform)
+    assert num_rows == 33
+    assert many_queries == few_queries
+
+
+def _stream_csv_export(db, regform):
+    registration_ids = [reg.id for reg in regform.registrations]
+    static_items = ['reg_date', 'state', 'price', 'payment_date', 'tags_present', 'billno', 'trade_no']
+    headers, rows = generate_spreadsheet_from_registrations(query_registrations_for_export(registration_ids), [],
+                                                            static_items)
+    response = send_csv_stream('registrations.csv', headers, rows)
+    # the rows are generated after the request has been committed
+    db.session.expire_all()
+    with _count_queries(db) as queries:
+        csv = b''.join(response.response).decode('utf-8-sig')
+    return len(csv.splitlines()) - 1, len(queries)
+
+
+@pytest.mark.usefixtures('request_context')
+def test_csv_export_stream_query_count_is_constant(db, dummy_regform):
+    _create_registrations(db, dummy_regform, 0, 3)
+    num_rows, few_queries = _stream_csv_export(db, dummy_regform)
+    assert num_rows == 3
+    _create_registrations(db, dummy_regform, 3, 30)
+    num_rows, many_queries = _stream_csv_export(db, dummy_regform)
+    assert num_rows == 33
+    assert many_queries == few_queries
+
+
+@pytest.mark.usefixtures('request_context')
+def test_reglist_static_items(dummy_regform):
+    assert '__getattribute__' not in vars(RegistrationListGenerator)
+    static_items = RegistrationListGenerator(dummy_regform).static_items
+    assert list(static_items)[-2:] == ['billno', 'trade_no']
+
+
+@pytest.mark.usefixtures('request_context')
+def test_reglist_pages(db, monkeypatch, dummy_regform):
+    monkeypatch.setattr(monkey_patch, 'REGLIST_PAGE_SIZE', 10)
+    # a few registrations share their name, the pages must still not overlap
+    for i in range(25):
+        db.session.add(Registration(registration_form=dummy_regform, first_name='Guinea', last_name=f'Pig {i % 7}',
+                                    email=f'{i}@example.com', currency='CNY', state=RegistrationState.unpaid))
+    db.session.flush()
+    generator = RegistrationListGenerator(dummy_regform)
+    pages = []
+    after = None
+    while True:
+        kwargs = generator.get_list_page_kwargs(after=after)
+        assert kwargs['total_registrations'] == kwargs['filtered_registrations'] == 25
+        pages.append(kwargs['registrations'])
+        if kwargs['next_cursor'] is None:
+            break
+        after = Registration.query.get(kwargs['next_cursor'])
+    assert [len(page) for page in pages] == [10, 10, 5]
+    registrations = [registration for page in pages for registration in page]
+    assert registrations == sorted(dummy_regform.registrations,
+                                   key=lambda r: (r.last_name.lower(), r.first_name.lower(), r.friendly_id, r.id))
@@ -0,0 +1,19 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from indico.modules.events.registration.controllers.management.reglists import RHRegistrationsListManage
+
+from indico_payment_sjtu.monkey_patch import rh_registrations_list_manage_process
+from indico_payment_sjtu.patches import PATCH_MODULE, PATCHES, apply_patches
+
+
+def test_apply_patches():
+    timings = apply_patches()
+    assert apply_patches() is timings
+    assert [timing.name for timing in timings] == [PATCH_MODULE] + [patch.name for patch in PATCHES]
+    assert all(timing.import_seconds >= 0 and timing.apply_seconds >= 0 for timing in timings)
+    assert RHRegistrationsListManage._process is rh_registrations_list_manage_process
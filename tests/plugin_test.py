@@ -0,0 +1,48 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from indico.modules.events.registration.models.form_fields import RegistrationFormField
+from indico.modules.events.registration.models.items import RegistrationFormItemType, RegistrationFormSection
+from indico.modules.events.registration.models.registrations import RegistrationData
+
+from indico_payment_sjtu.invoice_fields import InvoiceDataType, create_invoice_data_fields, get_invoice_field_ids
+from indico_payment_sjtu.plugin import SJTUPaymentPlugin
+from indico_payment_sjtu.util import _after_commit
+
+
+def test_generate_invoice_data(db, dummy_regform, sjtu_registration):
+    create_invoice_data_fields(dummy_regform)
+    db.session.flush()
+    field_ids = get_invoice_field_ids(dummy_regform)
+    assert set(field_ids) == set(InvoiceDataType)
+    values = {InvoiceDataType.receipt_title: 'ACME', InvoiceDataType.receipt_number: '123',
+              InvoiceDataType.receipt_phone: '13800000000'}
+    fields = {field.id: field for field in dummy_regform.active_fields}
+    for pd_type, value in values.items():
+        sjtu_registration.data.append(RegistrationData(field_data=fields[field_ids[pd_type]].current_data,
+                                                       data=value))
+    db.session.flush()
+    assert SJTUPaymentPlugin.generate_invoice_data({'registration': sjtu_registration}) == (
+        'ACME', '123', '13800000000', sjtu_registration.email, '3001')
+
+
+def test_invoice_field_ids_of_invoice_section(db, dummy_regform):
+    # a field of another section which happens to have the title of an invoice field
+    section = RegistrationFormSection(registration_form=dummy_regform, title='Other')
+    section.children.append(RegistrationFormField(registration_form=dummy_regform,
+                                                  type=RegistrationFormItemType.field, input_type='text',
+                                                  title=InvoiceDataType.receipt_title.get_title()))
+    db.session.flush()
+    assert get_invoice_field_ids(dummy_regform) == {}
+    create_invoice_data_fields(dummy_regform)
+    db.session.flush()
+    # the index is only dropped once the new fields are committed
+    assert get_invoice_field_ids(dummy_regform) == {}
+    _after_commit(db.session())
+    field_ids = get_invoice_field_ids(dummy_regform)
+    assert set(field_ids) == set(InvoiceDataType)
+    assert field_ids[InvoiceDataType.receipt_title] not in {field.id for field in section.children}
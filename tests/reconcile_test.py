@@ -0,0 +1,50 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from indico.modules.events.registration.models.registrations import RegistrationState
+
+from indico_payment_sjtu.billno import uuid_to_billno
+from indico_payment_sjtu.controllers import RHSJTUBase
+from indico_payment_sjtu.plugin import SJTUPaymentPlugin
+from indico_payment_sjtu.tasks import (SJTUReconciler, _rotate_events, reconcile_cache,
+                                       reconcile_unpaid_registrations)
+
+
+@pytest.mark.parametrize(('cursor', 'expected'), (
+    (0, [1, 2, 3]),
+    (1, [2, 3, 1]),
+    (2, [3, 1, 2]),
+    (3, [1, 2, 3]),
+))
+def test_rotate_events(cursor, expected):
+    events = [MagicMock(id=event_id) for event_id in (1, 2, 3)]
+    assert [event.id for event in _rotate_events(events, cursor)] == expected
+
+
+@pytest.mark.usefixtures('request_context')
+def test_reconcile_failure_isolated(mocker, sjtu_event, sjtu_portal, create_sjtu_registration):
+    registrations = [create_sjtu_registration() for __ in range(2)]
+    for registration in registrations:
+        sjtu_portal.pay(uuid_to_billno(registration.uuid), '100.00')
+
+    def _register_paid_bill(self, payment_results):
+        if self.registration == registrations[0]:
+            raise RuntimeError('boom')
+        return RHSJTUBase._register_paid_bill(self, payment_results)
+
+    mocker.patch.object(SJTUReconciler, '_register_paid_bill', _register_paid_bill)
+    with SJTUPaymentPlugin.instance.plugin_context():
+        reconcile_unpaid_registrations()
+    # the failing registration is backed off without aborting the run
+    assert registrations[0].state == RegistrationState.unpaid
+    assert reconcile_cache.get(f'backoff-{registrations[0].id}')
+    assert registrations[1].state == RegistrationState.complete
+    assert reconcile_cache.get('event-cursor') == sjtu_event.id
@@ -0,0 +1,75 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import pytest
+
+from indico_payment_sjtu.billno import uuid_to_billno
+from indico_payment_sjtu.controllers import RHSJTUBase
+from indico_payment_sjtu.models.refunds import RefundState
+from indico_payment_sjtu.plugin import SJTUPaymentPlugin
+from indico_payment_sjtu.refunds import create_refund_batch, get_refundable_registrations
+from indico_payment_sjtu.tasks import run_refund_batch
+from indico_payment_sjtu.testing.portal import REFUND_PATH
+
+
+def _pay(portal, registration):
+    billno = uuid_to_billno(registration.uuid)
+    portal.pay(billno, '100.00')
+    rh = RHSJTUBase()
+    rh.registration = registration
+    rh._init_plugin_settings()
+    assert rh._register_paid_bill(rh._query_sjtu_bill(billno))
+
+
+@pytest.mark.usefixtures('request_context')
+def test_bulk_refund(db, dummy_user, dummy_regform, sjtu_portal, create_sjtu_registration):
+    registrations = [create_sjtu_registration() for __ in range(3)]
+    with SJTUPaymentPlugin.instance.plugin_context():
+        for registration in registrations[:2]:
+            _pay(sjtu_portal, registration)
+        refundable = get_refundable_registrations(dummy_regform, [reg.id for reg in registrations])
+        assert refundable == registrations[:2]
+        batch = create_refund_batch(dummy_regform, refundable, dummy_user)
+        run_refund_batch(batch.id)
+        assert batch.is_finished
+        assert {refund.state for refund in batch.refunds} == {RefundState.succeeded}
+        assert all(sjtu_portal.bills[refund.billno].refunded for refund in batch.refunds)
+        assert not get_refundable_registrations(dummy_regform, [reg.id for reg in registrations])
+
+        # a refund interrupted by a crash after its submission is settled by the state of its bill, not sent again
+        batch.refunds[0].state = RefundState.submitted
+        batch.finished_dt = None
+        run_refund_batch(batch.id)
+        assert batch.is_finished
+        assert batch.refunds[0].state == RefundState.succeeded
+        assert batch.refunds[0].error is None
+        assert sjtu_portal.requests[REFUND_PATH] == 2
+        assert not get_refundable_registrations(dummy_regform, [reg.id for reg in registrations])
+
+
+@pytest.mark.usefixtures('request_context')
+def test_bulk_refund_unknown_outcome(db, dummy_user, dummy_regform, sjtu_portal, create_sjtu_registration):
+    registration = create_sjtu_registration()
+    with SJTUPaymentPlugin.instance.plugin_context():
+        _pay(sjtu_portal, registration)
+        batch = create_refund_batch(dummy_regform, [registration], dummy_user)
+        refund = batch.refunds[0]
+        # the portal does not answer, neither to the refund nor to the query of the bill
+        sjtu_portal.error_rate = 1
+        run_refund_batch(batch.id)
+        assert refund.state == RefundState.submitted
+        assert not batch.is_finished
+        run_refund_batch(batch.id)
+        assert refund.state == RefundState.submitted
+        assert sjtu_portal.requests[REFUND_PATH] == 1
+        # the bill is still paid, so the refund never reached the portal and is sent again
+        sjtu_portal.error_rate = 0
+        run_refund_batch(batch.id)
+        assert refund.state == RefundState.succeeded
+        assert batch.is_finished
+        assert sjtu_portal.requests[REFUND_PATH] == 2
+        assert sjtu_portal.bills[refund.billno].refunded
@@ -0,0 +1,46 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2023 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from hashlib import md5
+
+import pytest
+
+from indico_payment_sjtu.signing import SJTUSigner
+
+
+@pytest.mark.parametrize('data', ('', 'billno', '<?xml version="1.0" encoding="GBK"?><billinfo>会议</billinfo>'))
+def test_sign(data):
+    signer = SJTUSigner('sys', 'subsys', 'cert')
+    assert signer.sign(data) == md5(f'syssubsyscert{data}'.encode()).hexdigest()
+    # the prefix state must not be consumed by signing
+    assert signer.sign(data) == signer.sign(data)
+
+
+@pytest.mark.parametrize(('sign', 'expected'), (
+    (md5(b'syssubsyscertdata').hexdigest(), True),
+    (md5(b'syssubsyscertother').hexdigest(), False),
+    ('', False),
+    (None, False),
+    ('签名', False),
+))
+def test_verify(sign, expected):
+    assert SJTUSigner('sys', 'subsys', 'cert').verify('data', sign) == expected
+
+
+def test_batch():
+    signer = SJTUSigner('sys', 'subsys', 'cert')
+    billnos = ['a', 'b', 'c']
+    signs = signer.sign_many(billnos)
+    assert signs == [signer.sign(billno) for billno in billnos]
+    assert signer.verify_many(zip(billnos, signs)) == [True, True, True]
+    assert signer.verify_many([('a', signs[1]), ('b', signs[1]), ('c', '')]) == [False, True, False]
+
+
+def test_immutable():
+    signer = SJTUSigner('sys', 'subsys', 'cert')
+    with pytest.raises(AttributeError):
+        signer.cert = 'other'
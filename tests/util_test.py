@@ -10,7 +10,7 @@ from unittest.mock import MagicMock
 import pytest
 from wtforms import ValidationError
 
-from indico_payment_sjtu.util import validate_business
+from indico_payment_sjtu.util import _after_commit, _after_soft_rollback, call_after_commit, validate_business
 
 
 @pytest.mark.parametrize(('data', 'valid'), (
@@ -29,3 +29,18 @@ def test_validate_business(data, valid):
     else:
         with pytest.raises(ValidationError):
             validate_business(None, field)
+
+
+def test_call_after_commit(db):
+    session = db.session()
+    func = MagicMock()
+    call_after_commit(func)
+    call_after_commit(func)
+    assert not func.called
+    _after_commit(session)
+    func.assert_called_once_with()
+    # the functions of a rolled back transaction are dropped
+    call_after_commit(func)
+    _after_soft_rollback(session, MagicMock(parent=None))
+    _after_commit(session)
+    assert func.call_count == 1